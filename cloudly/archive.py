@@ -0,0 +1,381 @@
+"""Write tweets to rotating gzipped archives, one JSON document per line.
+
+An `ArchiveWriter` keeps a compressed stream open between batches, instead
+of reopening the file, and adding a gzip member to it, for each batch:
+
+    writer = ArchiveWriter("/data/tweets", max_size=1024 ** 3)
+    for batch in batches:
+        writer.write(batch)
+    writer.close()
+
+Files are named after the current time, by default one per day:
+`2013-06-01.gz`. A file reaching `max_size` compressed bytes is continued in
+`2013-06-01.1.gz`, `2013-06-01.2.gz`, etc. Processes keeping writers open on
+the same directory must write to files of their own, with a `suffix` such as
+their pid: `2013-06-01-1234.gz`.
+
+A new gzip member is started every hour, and its byte offset is written to
+a side index, `2013-06-01.gz.idx`, one JSON document per line:
+
+    {"hour": "2013-06-01T13", "offset": 1048576}
+
+A reader can seek to that offset and decompress from there. The archive is
+still a valid gzip file: `zcat` and `gzip.open` read it all. Writing to a
+file again after closing it adds a gzip member, indexed only if it starts a
+new hour.
+
+`read` reads a directory of archives back, in parallel:
+
+    for batch in read("/data/tweets", attrs=['id_str', 'text']):
+        process(batch)
+"""
+import os
+import re
+import gzip
+import json
+import mmap
+import time
+import zlib
+import atexit
+import threading
+import multiprocessing
+import Queue
+from os.path import join, exists
+
+from cloudly import logger
+from cloudly.dictutils import Projector
+
+log = logger.init(__name__)
+
+INDEX_EXTENSION = ".idx"
+CHUNK_SIZE = 1024 ** 2
+_STOP = object()
+_archive_name = re.compile(r"^(.*?)(?:\.(\d+))?\.gz$")
+
+
+class ArchiveWriter(object):
+    """Write batches of tweets to gzipped archives in `directory`, cf. this
+    module's doc.
+
+        - `time_format`: strftime format of the file names, local time. A new
+          file is started whenever it changes: use "%Y-%m-%d-%H" for hourly
+          files;
+        - `suffix`: appended to the file names, before the part number;
+        - `max_size`: maximum size of a file, in compressed bytes;
+        - `flush_interval`: seconds between flushes of the compressed stream
+          to disk, so that readers see recent tweets. Each flush costs a bit
+          of compression ratio;
+        - `background`: if True, tweets are encoded, compressed and written by
+          a thread, `write` only queuing them. At most `queue_size` batches
+          are queued, `write` blocks beyond that.
+
+    Files are fsync'ed when closed: on rotation and by `close`, unless
+    given `fsync=False`.
+    """
+    def __init__(self, directory, time_format="%Y-%m-%d", max_size=None,
+                 flush_interval=5, compresslevel=6, background=False,
+                 queue_size=100, suffix=""):
+        self.directory = directory
+        self.time_format = time_format
+        self.suffix = suffix
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.compresslevel = compresslevel
+
+        self.name = None  # Current file name, without part suffix.
+        self.part = 0
+        self.path = None
+        self.file = None
+        self.stream = None
+        self.hour = None
+        self.last_flush = 0
+        self.lock = threading.Lock()
+
+        self.background = background
+        self.queue = Queue.Queue(maxsize=queue_size)
+        self.thread = None
+
+    def write(self, tweets):
+        """Write a batch of tweets."""
+        if not self.background:
+            self._write(tweets)
+            return
+        if not self.thread:
+            self.thread = threading.Thread(target=self._consume)
+            self.thread.daemon = True
+            self.thread.start()
+        self.queue.put(tweets)
+
+    def flush(self):
+        """Flush the compressed stream to disk."""
+        with self.lock:
+            self._flush()
+
+    def close(self, fsync=True):
+        """Write everything queued, then flush, fsync and close the current
+        file. The writer can still be used afterwards.
+        """
+        if self.thread:
+            self.queue.put(_STOP)
+            self.thread.join()
+            self.thread = None
+        with self.lock:
+            self._close(fsync)
+            self.name = None
+
+    def _write(self, tweets):
+        with self.lock:
+            now = time.time()
+            self._rotate(now)
+            stream = self.stream
+            for tweet in tweets:
+                stream.write(json.dumps(tweet))
+                stream.write("\n")
+            if now - self.last_flush >= self.flush_interval:
+                self._flush()
+
+    def _consume(self):
+        while True:
+            tweets = self.queue.get()
+            if tweets is _STOP:
+                return
+            try:
+                self._write(tweets)
+            except Exception:
+                log.exception("Could not archive {} tweets.".format(
+                    len(tweets)))
+
+    def _rotate(self, now):
+        """Open a new file, or a new gzip member, as needed."""
+        name = time.strftime(self.time_format, time.localtime(now)) + \
+            self.suffix
+        if name != self.name:
+            self._close()
+            self.name, self.part = name, 0
+            self._open()
+        elif self.max_size and self.file.tell() >= self.max_size:
+            self._close()
+            self.part += 1
+            self._open()
+
+        hour = time.strftime("%Y-%m-%dT%H", time.gmtime(now))
+        if self.stream is None or hour != self.hour:
+            self._start_member(hour)
+
+    def _open(self):
+        suffix = ".{}".format(self.part) if self.part else ""
+        self.path = join(self.directory,
+                         "{}{}.gz".format(self.name, suffix))
+        # Skip parts full from a previous run.
+        while self.max_size and exists(self.path) and \
+                os.path.getsize(self.path) >= self.max_size:
+            self.part += 1
+            self.path = join(self.directory,
+                             "{}.{}.gz".format(self.name, self.part))
+        self.file = open(self.path, "ab")
+        self.file.seek(0, os.SEEK_END)
+        # Carry on with the hour last indexed, if any.
+        index = read_index(self.path) if self.file.tell() else []
+        self.hour = index[-1][0] if index else None
+        log.debug("Archiving to {}".format(self.path))
+
+    def _start_member(self, hour):
+        """End the current gzip member, if any, and start a new one, indexed
+        under `hour` unless it continues that hour.
+        """
+        if self.stream:
+            self.stream.close()  # Leaves self.file open.
+        if hour != self.hour:
+            offset = self.file.tell()
+            with open(self.path + INDEX_EXTENSION, "a") as index:
+                index.write(json.dumps({'hour': hour, 'offset': offset}) +
+                            "\n")
+        self.stream = gzip.GzipFile(fileobj=self.file, mode="wb",
+                                    compresslevel=self.compresslevel)
+        self.hour = hour
+
+    def _flush(self):
+        if self.stream:
+            self.stream.flush()
+            self.last_flush = time.time()
+
+    def _close(self, fsync=True):
+        if not self.file:
+            return
+        self.stream.close()
+        self.file.flush()
+        if fsync:
+            os.fsync(self.file.fileno())
+        self.file.close()
+        self.file = self.stream = self.path = self.hour = None
+
+
+def read_index(path):
+    """Return the list of `(hour, offset)` of the archive at `path`."""
+    index_path = path + INDEX_EXTENSION
+    if not exists(index_path):
+        return []
+    with open(index_path) as index:
+        entries = [json.loads(line) for line in index if line.strip()]
+    return [(entry['hour'], entry['offset']) for entry in entries]
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def get_writer(directory, **kwargs):
+    """Return this process's writer of `directory` and `suffix`, created with
+    the given options on first use. Writers are closed at exit.
+    """
+    key = (directory, os.getpid(), kwargs.get('suffix', ""))
+    with _writers_lock:
+        if key not in _writers:
+            _writers[key] = ArchiveWriter(directory, **kwargs)
+        return _writers[key]
+
+
+@atexit.register
+def close_writers():
+    """Close all writers returned by `get_writer` in this process. Those
+    inherited from a parent process are left to it.
+    """
+    with _writers_lock:
+        for (_, pid, _), writer in _writers.items():
+            if pid == os.getpid():
+                writer.close()
+        _writers.clear()
+
+
+def read(directory, attrs=None, predicate=None, contains=None,
+         batch_size=1000, processes=None, split_members=True):
+    """Yield lists of `batch_size` tweets read from the archives of
+    `directory`, in order. The archives are shared among `processes`
+    processes, all CPUs by default. Use 1 to read them in this process.
+
+    Each archive is read by a single process, or split in the hourly gzip
+    members of its index if `split_members` is True.
+
+    Tweets are filtered and stripped by the reading processes, before being
+    sent back to this one:
+
+        - `contains`: a list of strings, lines of JSON containing none of
+          them are skipped before being decoded. JSON escapes non-ASCII
+          characters, so should these strings;
+        - `predicate`: a function taking a tweet and returning True to keep
+          it. It must be picklable, a module-level function;
+        - `attrs`: attributes to keep, as by `cloudly.tweets.keep`.
+
+    This is a generator function.
+    """
+    tasks = [(path, start, end, attrs, predicate, contains)
+             for path, start, end in _units(directory, split_members)]
+    pool = None
+    if processes == 1:
+        results = (_read_unit(task) for task in tasks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap(_read_unit, tasks)
+
+    try:
+        batch = []
+        for tweets in results:
+            batch.extend(tweets)
+            while len(batch) >= batch_size:
+                yield batch[:batch_size]
+                batch = batch[batch_size:]
+        if batch:
+            yield batch
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+
+
+def archives(directory):
+    """Return the paths of the archives in `directory`, in order."""
+    paths = []
+    for filename in os.listdir(directory):
+        match = _archive_name.match(filename)
+        if match:
+            name, part = match.groups()
+            paths.append((name, int(part or 0), join(directory, filename)))
+    return [path for _, _, path in sorted(paths)]
+
+
+def _units(directory, split_members):
+    """Yield the `(path, start, end)` byte ranges to read, `end` being None
+    for the end of the file.
+    """
+    for path in archives(directory):
+        size = os.path.getsize(path)
+        offsets = [0]
+        if split_members:
+            offsets.extend(offset for _, offset in read_index(path))
+        offsets = sorted(set(offset for offset in offsets if offset < size))
+        for start, end in zip(offsets, offsets[1:] + [None]):
+            yield path, start, end
+
+
+def _read_unit(task):
+    """Return the tweets of a byte range of an archive, filtered and
+    stripped. Run by the reading processes.
+    """
+    path, start, end, attrs, predicate, contains = task
+    project = Projector(attrs) if attrs else None
+    tweets = []
+    with open(path, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            return tweets
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for line in _lines(_inflate(data, start, end or len(data))):
+                if contains and not any(string in line
+                                        for string in contains):
+                    continue
+                try:
+                    tweet = json.loads(line)
+                except ValueError:
+                    # Likely the last line of an archive being written.
+                    log.warning("Skipping invalid line in {}".format(path))
+                    continue
+                if predicate and not predicate(tweet):
+                    continue
+                tweets.append(project(tweet) if project else tweet)
+        finally:
+            data.close()
+    return tweets
+
+
+def _inflate(data, start, end):
+    """Yield the decompressed chunks of `data[start:end]`, made of one or
+    more gzip members.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    position = start
+    pending = ""
+    while position < end or pending:
+        if pending:
+            chunk, pending = pending, ""
+        else:
+            chunk = data[position:min(position + CHUNK_SIZE, end)]
+            position += len(chunk)
+        yield decompressor.decompress(chunk)
+        if decompressor.unused_data:
+            # Start of the next member.
+            pending = decompressor.unused_data
+            yield decompressor.flush()
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    yield decompressor.flush()
+
+
+def _lines(chunks):
+    rest = ""
+    for chunk in chunks:
+        lines = (rest + chunk).split("\n")
+        rest = lines.pop()
+        for line in lines:
+            if line:
+                yield line
+    if rest:
+        yield rest
@@ -1,13 +1,17 @@
 import os
 import sys
+import json
+import time
+import socket
+import httplib
 import itertools
-import urllib
+import threading
+import urlparse
 
 import boto
 from boto import ec2
 from boto.exception import EC2ResponseError
 
-from cloudly.decorators import Memoized
 from cloudly import logger
 
 EC2_METADATA_URL = "http://169.254.169.254/latest/meta-data/"
@@ -58,10 +62,156 @@ def get_own():
 
 def find_service_ip(service):
     """Return a list of ip addresses offering the given service. This uses the
-    'services' tag of an EC2 instance.
+    'services' tag of an EC2 instance, cf. `ServiceRegistry`.
     """
-    hosts = filter(lambda h: service in h.services, all())
-    return [get_best_ip_addresse(host) for host in hosts]
+    return registry.find(service)
+
+
+class ServiceRegistry(object):
+    """An index of the running EC2 instances offering services, i.e. having a
+    'services' tag, by service name.
+
+    The index is built with a single EC2 API call, filtered on the server
+    side, and kept `ttl` seconds. It is saved to the JSON file `path`, if
+    given, so that a new process can use it without calling the EC2 API, as
+    long as it is not older than `ttl` seconds and was built for the same
+    region and access key. Call `start` to refresh the index in a background
+    thread instead of when a lookup finds it too old.
+
+    `connection_factory` returns an EC2 connection, it defaults to
+    boto.ec2.connection.EC2Connection.
+    """
+    def __init__(self, ttl=300, path=None, connection_factory=None):
+        self.ttl = ttl
+        self.path = path
+        self.connection_factory = (connection_factory or
+                                   ec2.connection.EC2Connection)
+        self.connection = None
+        self.services = None
+        self.updated = 0
+        self.lock = threading.Lock()
+
+    def find(self, service):
+        """Return the IP addresses of hosts offering `service`: private
+        addresses when running under EC2, public ones otherwise.
+        """
+        hosts = self.hosts(service)
+        key = "private_ip" if is_running_on_ec2() else "public_ip"
+        return [host[key] for host in hosts]
+
+    def hosts(self, service):
+        """Return a list of {'id', 'private_ip', 'public_ip'} dicts, one per
+        host offering `service`.
+        """
+        with self.lock:
+            if self.services is None:
+                self._load()
+            if time.time() - self.updated >= self.ttl:
+                self._refresh()
+            return list(self.services.get(service, []))
+
+    def refresh(self):
+        """Rebuild the index from the EC2 API."""
+        with self.lock:
+            self._refresh()
+
+    def start(self, interval=None):
+        """Refresh the index every `interval` seconds (default: half the ttl)
+        in a background thread.
+        """
+        interval = interval or self.ttl / 2.
+
+        def refresher():
+            while True:
+                try:
+                    self.refresh()
+                except Exception, exception:
+                    log.error("Refreshing services failed: {}".format(
+                        exception))
+                time.sleep(interval)
+
+        thread = threading.Thread(target=refresher)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _connect(self):
+        if self.connection is None:
+            self.connection = self.connection_factory()
+        return self.connection
+
+    def _scope(self):
+        """Return the region and access key the index is built for."""
+        connection = self._connect()
+        return "{}:{}".format(connection.region.name,
+                              connection.aws_access_key_id)
+
+    def _refresh(self):
+        reservations = self._connect().get_all_instances(filters={
+            'tag-key': 'services',
+            'instance-state-name': 'running',
+        })
+        services = {}
+        for reservation in reservations:
+            for instance in reservation.instances:
+                if instance.state != "running":
+                    continue
+                host = {
+                    'id': instance.id,
+                    'private_ip': instance.private_ip_address,
+                    'public_ip': instance.ip_address,
+                }
+                names = instance.tags.get('services') or ''
+                for name in names.split(','):
+                    if name:
+                        services.setdefault(name, []).append(host)
+        self.services = services
+        self.updated = time.time()
+        log.debug("Found services {}".format(services.keys()))
+        self._save()
+
+    def _load(self):
+        self.services = {}
+        if not (self.path and os.path.exists(self.path)):
+            return
+        try:
+            with open(self.path) as cache_file:
+                saved = json.load(cache_file)
+            if saved['scope'] != self._scope():
+                return
+            self.services = saved['services']
+            self.updated = saved['updated']
+        except (IOError, ValueError, KeyError), exception:
+            log.info("Can't read {}: {}".format(self.path, exception))
+
+    def _save(self):
+        if self.path:
+            _write_json(self.path, {'scope': self._scope(),
+                                    'updated': self.updated,
+                                    'services': self.services})
+
+
+def _write_json(path, data):
+    """Save data to a JSON file, creating its directory if needed. Errors are
+    logged, the file being only a cache.
+    """
+    try:
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Write then rename, so that readers never see a partial file.
+        temporary = "{}.{}".format(path, os.getpid())
+        with open(temporary, "w") as cache_file:
+            json.dump(data, cache_file)
+        os.rename(temporary, path)
+    except (IOError, OSError), exception:
+        log.info("Can't write {}: {}".format(path, exception))
+
+
+# The index is saved to disk only if EC2_SERVICES_CACHE names a file.
+registry = ServiceRegistry(
+    ttl=int(os.environ.get("EC2_SERVICES_TTL", 300)),
+    path=os.environ.get("EC2_SERVICES_CACHE"))
 
 
 def get_hostname(service):
@@ -79,9 +229,10 @@ def get_hostname(service):
     return hosts[0] if hosts else None
 
 
-@Memoized
 def is_running_on_ec2():
-    """Return true if the current process is running on an EC2 instance."""
+    """Return true if the current process is running on an EC2 instance.
+    The answer is cached by `metadata`, a negative one only briefly.
+    """
     if _query():
         return True
     else:
@@ -106,11 +257,138 @@ def _query(meta=""):
 
         :param meta: The metadata to query.
     """
-    try:
-        metadata = urllib.urlopen(EC2_METADATA_URL + meta).read()
-    except IOError:
-        metadata = None
-    return metadata
+    return metadata.get(meta)
+
+
+class MetadataClient(object):
+    """A client of the EC2 instance metadata service, failing fast when not
+    running under EC2.
+
+    Requests time out after `timeout` seconds. A session token is used if
+    the service offers one (IMDSv2), otherwise plain requests (IMDSv1), as
+    when the token request fails: in a container with a hop limit of 1, only
+    its response is dropped.
+
+    Values are cached in-process. They are also saved to the JSON file
+    `path`, if given, along with whether the service could be reached at all,
+    so that other processes on the same host in the next `ttl` seconds don't
+    have to ask again, nor wait for a timeout when not under EC2. An
+    unreachable service is only trusted to stay so for `negative_ttl`
+    seconds.
+
+    The environment variable EC2_METADATA_URL overrides the service URL and
+    EC2_METADATA_DISABLED, if set, makes every query return None.
+    """
+    TOKEN_PATH = "/latest/api/token"
+    TOKEN_TTL = 21600
+
+    def __init__(self, url=None, timeout=0.5, path=None, ttl=3600,
+                 negative_ttl=60):
+        url = url or os.environ.get("EC2_METADATA_URL", EC2_METADATA_URL)
+        parsed = urlparse.urlparse(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.prefix = parsed.path
+        self.timeout = timeout
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.disabled = bool(os.environ.get("EC2_METADATA_DISABLED"))
+        self.values = None
+        self.reachable = None
+        self.checked = None  # When the service was found unreachable.
+        self.token = None
+        self.lock = threading.Lock()
+
+    def get(self, meta=""):
+        """Return the metadata at the given path, None if not available."""
+        if self.disabled:
+            return None
+        with self.lock:
+            if self.values is None:
+                self._load()
+            if meta in self.values:
+                return self.values[meta]
+            if self.reachable is False and \
+                    time.time() - self.checked < self.negative_ttl:
+                return None
+            try:
+                value = self._fetch(meta)
+                self.reachable = True
+            except (socket.error, httplib.HTTPException), exception:
+                log.debug("EC2 metadata unavailable: {}".format(exception))
+                self.reachable = False
+                self.checked = time.time()
+                value = None
+            if value is not None:
+                self.values[meta] = value
+            self._save()
+            return value
+
+    def _fetch(self, meta, refresh=True):
+        if self.token is None:
+            self.token = self._get_token()
+        headers = {}
+        if self.token:
+            headers['X-aws-ec2-metadata-token'] = self.token
+        status, body = self._request("GET", self.prefix + meta, headers)
+        if status == 401 and self.token and refresh:
+            # Token expired, get a new one once.
+            self.token = None
+            return self._fetch(meta, refresh=False)
+        return body if status == 200 else None
+
+    def _get_token(self):
+        """Return a session token, or '' if the service doesn't use them or
+        the request failed.
+        """
+        try:
+            status, body = self._request(
+                "PUT", self.TOKEN_PATH,
+                {'X-aws-ec2-metadata-token-ttl-seconds': str(self.TOKEN_TTL)})
+        except (socket.error, httplib.HTTPException), exception:
+            log.debug("No EC2 metadata token: {}".format(exception))
+            return ''
+        return body if status == 200 else ''
+
+    def _request(self, method, path, headers):
+        connection = httplib.HTTPConnection(self.host, self.port,
+                                            timeout=self.timeout)
+        try:
+            connection.request(method, path, headers=headers)
+            response = connection.getresponse()
+            return response.status, response.read()
+        finally:
+            connection.close()
+
+    def _load(self):
+        self.values = {}
+        if not (self.path and os.path.exists(self.path)):
+            return
+        try:
+            with open(self.path) as cache_file:
+                saved = json.load(cache_file)
+            ttl = self.ttl if saved['reachable'] is not False else \
+                self.negative_ttl
+            if saved['hostname'] == socket.gethostname() and \
+                    time.time() - saved['updated'] < ttl:
+                self.values = saved['values']
+                self.reachable = saved['reachable']
+                self.checked = saved['updated']
+        except (IOError, ValueError, KeyError), exception:
+            log.info("Can't read {}: {}".format(self.path, exception))
+
+    def _save(self):
+        if self.path:
+            _write_json(self.path, {'hostname': socket.gethostname(),
+                                    'updated': time.time(),
+                                    'reachable': self.reachable,
+                                    'values': self.values})
+
+
+metadata = MetadataClient(
+    path=os.environ.get("EC2_METADATA_CACHE",
+                        os.path.expanduser("~/.cloudly/ec2-metadata.json")))
 
 
 class TagAttribute(object):
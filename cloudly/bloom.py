@@ -0,0 +1,84 @@
+"""Bloom filters, to tell in bounded memory whether a key was seen before:
+
+    seen = RotatingBloomFilter(capacity=1000000)
+    for tweet in tweets:
+        if seen.add(tweet['id_str']):
+            continue  # Most likely a duplicate.
+
+A Bloom filter has no false negatives, and false positives at a rate of
+about `error_rate` when holding `capacity` keys.
+"""
+import math
+import struct
+import hashlib
+
+
+class BloomFilter(object):
+    """A Bloom filter of `capacity` string keys, cf. this module's doc."""
+    def __init__(self, capacity, error_rate=0.001):
+        if capacity <= 0 or not 0 < error_rate < 1:
+            raise ValueError("Invalid capacity or error rate.")
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size * math.log(2) / capacity)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def add(self, key):
+        """Add `key`. Return True if it was (probably) already there."""
+        present = True
+        bits = self.bits
+        for index in self._indices(key):
+            byte, mask = index >> 3, 1 << (index & 7)
+            if not bits[byte] & mask:
+                present = False
+                bits[byte] |= mask
+        if not present:
+            self.count += 1
+        return present
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[index >> 3] & (1 << (index & 7))
+                   for index in self._indices(key))
+
+    def __len__(self):
+        """The number of keys added, give or take false positives."""
+        return self.count
+
+    def _indices(self, key):
+        # Double hashing: the k hashes are h1 + i * h2.
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        h1, h2 = struct.unpack("<QQ", hashlib.md5(key).digest())
+        size = self.size
+        return [(h1 + i * h2) % size for i in xrange(self.hashes)]
+
+
+class RotatingBloomFilter(object):
+    """A Bloom filter remembering at least the last `capacity` keys added, in
+    bounded memory: once it holds `capacity` keys, the filter becomes the
+    previous generation, checked but not added to, and a new one is started.
+    The previous generation is then forgotten at the next rotation.
+    """
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.current = BloomFilter(capacity, error_rate)
+        self.previous = None
+
+    def add(self, key):
+        """Add `key`. Return True if it was (probably) already there."""
+        if self.previous is not None and key in self.previous:
+            return True
+        present = self.current.add(key)
+        if len(self.current) >= self.capacity:
+            self.previous = self.current
+            self.current = BloomFilter(self.capacity, self.error_rate)
+        return present
+
+    def __contains__(self, key):
+        return key in self.current or (self.previous is not None and
+                                       key in self.previous)
@@ -3,27 +3,99 @@ coating.
 """
 
 import os
+import bisect
+import hashlib
 import json
+import math
+import random
+import socket
+import struct
+import time
+import threading
+import uuid
+import Queue
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
 
-import memcache
+import memcache as memcache_client
 import redis
 
+from cloudly import serialize
 from cloudly.aws import ec2
 from cloudly.decorators import Memoized
 import cloudly.logger as logger
 
 log = logger.init(__name__)
 
+_missing = object()
+
+# Maximum number of keys sent in one command or pipeline by the bulk helpers.
+CHUNK_SIZE = 1000
+
+# In-process computations in flight, by key. Cf. get_or_compute.
+_flights = {}
+_flights_lock = threading.Lock()
+
+# Delete KEYS[1] only if its value is ARGV[1], atomically.
+RELEASE_LOCK = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
 
 @Memoized
-def get_redis_connection(hostname=None, port=None):
+def get_redis_connection(hostname=None, port=None, codec=None,
+                         compression=None, max_connections=None,
+                         connect_timeout=None, socket_timeout=None,
+                         health_check_interval=None):
     """ Get a connection to a Redis server. The priority is:
         - look for an environment variable REDISTOGO_URL (Heroku), else
         - look for an environment variable REDIS_HOST, else
         - look for an EC2 hosted server offering the service 'redis', else
         - use localhost, 127.0.0.1.
+
+    The connection has two more methods, `jset(key, obj)` and `jget(key)`,
+    which serialize objects using the given `codec` and `compression`, JSON
+    by default. Cf. cloudly.serialize. Both can be overridden per call:
+
+        server.jset(key, obj, codec="msgpack", compression="zlib")
+
+    `jget` reads whatever codec the value was written with. Cf.
+    `add_json_helpers` for other such methods.
+
+    The connection is a `RedisClient`, using a pool of at most
+    `max_connections` connections (env. REDIS_MAX_CONNECTIONS, default 50).
+    Callers wait for a free connection at most REDIS_POOL_TIMEOUT seconds
+    (default 20). Connecting times out after `connect_timeout` seconds (env.
+    REDIS_CONNECT_TIMEOUT, default 2) and socket operations after
+    `socket_timeout` seconds (env. REDIS_SOCKET_TIMEOUT, default none: a
+    pub/sub subscriber may wait for messages indefinitely). The server is
+    pinged every `health_check_interval` seconds of use (env.
+    REDIS_HEALTH_CHECK_INTERVAL, default 30) and the connection moves to
+    a new server transparently should the endpoint above change.
     """
+    def env(name, default, cast=float):
+        value = os.environ.get(name)
+        return cast(value) if value else default
+
+    server = RedisClient(
+        lambda: get_redis_url(hostname, port),
+        max_connections=(max_connections or
+                         env("REDIS_MAX_CONNECTIONS", 50, int)),
+        timeout=env("REDIS_POOL_TIMEOUT", 20),
+        socket_connect_timeout=(connect_timeout or
+                                env("REDIS_CONNECT_TIMEOUT", 2)),
+        socket_timeout=socket_timeout or env("REDIS_SOCKET_TIMEOUT", None),
+        health_check_interval=(health_check_interval or
+                               env("REDIS_HEALTH_CHECK_INTERVAL", 30)),
+    )
+    return add_json_helpers(server, codec, compression)
 
+
+def get_redis_url(hostname=None, port=None):
+    """Return the URL of the Redis server, cf. `get_redis_connection`."""
     host = (
         hostname or
         os.environ.get("REDIS_HOST") or
@@ -31,49 +103,930 @@ def get_redis_connection(hostname=None, port=None):
         "127.0.0.1"
     )
     port = port or os.environ.get("REDIS_PORT", 6379)
-    url = os.environ.get('REDISTOGO_URL',  # Set when on Heroku.
-                         'redis://{}:{}'.format(host, port))
+    return os.environ.get('REDISTOGO_URL',  # Set when on Heroku.
+                          'redis://{}:{}'.format(host, port))
+
+
+class PoolExhausted(redis.ConnectionError):
+    """Raised when no connection became available in the pool in time."""
+
+
+class InstrumentedConnectionPool(redis.BlockingConnectionPool):
+    """A blocking connection pool keeping track of its utilization and of the
+    time callers wait for a connection. Cf. `stats`. Raise `PoolExhausted` if
+    no connection is available after `timeout` seconds.
+    """
+    def __init__(self, *args, **kwargs):
+        super(InstrumentedConnectionPool, self).__init__(*args, **kwargs)
+        self.stats_lock = threading.Lock()
+        self.in_use = self.peak_in_use = self.checkouts = 0
+        self.wait_time = self.max_wait_time = 0.
+
+    def get_connection(self, command_name, *keys, **options):
+        start = time.time()
+        try:
+            connection = super(InstrumentedConnectionPool,
+                               self).get_connection(command_name, *keys,
+                                                    **options)
+        except redis.ConnectionError, exception:
+            raise PoolExhausted(str(exception))
+        waited = time.time() - start
+        with self.stats_lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            self.wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+        return connection
+
+    def release(self, connection):
+        super(InstrumentedConnectionPool, self).release(connection)
+        with self.stats_lock:
+            self.in_use -= 1
+
+    def stats(self):
+        """Return a dict of pool utilization and wait time metrics."""
+        with self.stats_lock:
+            return {
+                'max_connections': self.max_connections,
+                'created': len(self._connections),
+                'in_use': self.in_use,
+                'peak_in_use': self.peak_in_use,
+                'checkouts': self.checkouts,
+                'wait_time': self.wait_time,
+                'max_wait_time': self.max_wait_time,
+                'mean_wait_time': self.wait_time / (self.checkouts or 1),
+            }
+
 
-    log.info("Connecting to Redis server at {}".format(url))
-    server = redis.from_url(url)
+class RedisClient(redis.Redis):
+    """A Redis client whose connection pool follows the server endpoint.
 
-    # Add some utility function. These functions first
-    # serialize to/from JSON the given object, then call redis get/set.
+    `resolve` is a function returning the server URL. It is called again
+    whenever a command fails to connect or a periodic health check (a PING
+    every `health_check_interval` seconds of use) fails. If the URL changed,
+    say after a failover, the client switches to a new connection pool and a
+    failed command is retried once. Otherwise, the pool is reset and the
+    error raised.
+
+    Other keyword arguments are given to `InstrumentedConnectionPool`. TCP
+    keepalive is on.
+    """
+    def __init__(self, resolve, health_check_interval=30, **pool_options):
+        self.resolve = resolve
+        self.pool_options = dict(pool_options, socket_keepalive=True)
+        self.health_check_interval = health_check_interval
+        self.last_health_check = time.time()
+        self.url = resolve()
+        log.info("Connecting to Redis server at {}".format(self.url))
+        super(RedisClient, self).__init__(
+            connection_pool=self._make_pool(self.url))
+
+    def _make_pool(self, url):
+        return InstrumentedConnectionPool.from_url(url, **self.pool_options)
+
+    def execute_command(self, *args, **options):
+        if self.health_check_interval and \
+                time.time() - self.last_health_check >= \
+                self.health_check_interval:
+            self.check_health()
+        try:
+            return super(RedisClient, self).execute_command(*args, **options)
+        except PoolExhausted:
+            raise
+        except (redis.ConnectionError, redis.TimeoutError):
+            if not self.reconnect():
+                raise
+            return super(RedisClient, self).execute_command(*args, **options)
+
+    def check_health(self):
+        """Ping the server, reconnect if it doesn't answer."""
+        self.last_health_check = time.time()
+        try:
+            self.ping()
+        except (redis.ConnectionError, redis.TimeoutError), exception:
+            log.warning("Redis health check failed: {}".format(exception))
+            self.reconnect()
+
+    def reconnect(self):
+        """Resolve the server URL again, switch to a new connection pool if
+        it changed and return True. Otherwise, reset the pool and return
+        False.
+        """
+        url = self.resolve()
+        old_pool = self.connection_pool
+        if url == self.url:
+            old_pool.disconnect()
+            return False
+        log.warning("Redis moved from {} to {}".format(self.url, url))
+        self.url = url
+        self.connection_pool = self._make_pool(url)
+        old_pool.disconnect()
+        return True
+
+    def pool_stats(self):
+        """Cf. `InstrumentedConnectionPool.stats`."""
+        return self.connection_pool.stats()
+
+
+def add_json_helpers(server, codec=None, compression=None):
+    """Add utility functions to a Redis connection. These functions first
+    serialize to/from JSON (or another codec) the given objects, then call
+    redis:
+
+        - `jset(key, obj)` and `jget(key)`;
+        - `jmset(mapping, ttl=None)` and `jmget(keys)`, for many keys in
+          about one round-trip;
+        - `jdelete_many(keys)`;
+        - `jpipeline()`, a context manager returning a `JSONPipeline`.
+
+    Batches larger than `CHUNK_SIZE` keys are sent in chunks.
+    """
     def redis_jget(key):
         value = server.get(key)
-        return json.loads(value) if value else None
+        return serialize.loads(value) if value else None
+
+    def redis_jset(key, obj, codec=None, compression=None):
+        return server.set(key, _jdumps(server, obj, codec, compression))
+
+    def redis_jmget(keys):
+        values = []
+        for chunk in _chunks(list(keys), CHUNK_SIZE):
+            values.extend(serialize.loads(value) if value else None
+                          for value in server.mget(chunk))
+        return values
+
+    def redis_jmset(mapping, ttl=None, codec=None, compression=None):
+        with redis_jpipeline() as pipe:
+            for key, obj in mapping.iteritems():
+                pipe.jset(key, obj, ttl=ttl, codec=codec,
+                          compression=compression)
+
+    def redis_jdelete_many(keys):
+        return sum(server.delete(*chunk)
+                   for chunk in _chunks(list(keys), CHUNK_SIZE))
 
-    server.jset = lambda key, obj: server.set(key, json.dumps(obj))
+    @contextmanager
+    def redis_jpipeline(chunk_size=CHUNK_SIZE):
+        pipe = JSONPipeline(server, chunk_size)
+        yield pipe
+        pipe.execute()
+
+    server.codec = codec
+    server.compression = compression
+    server.jset = redis_jset
     server.jget = redis_jget
+    server.jmset = redis_jmset
+    server.jmget = redis_jmget
+    server.jdelete_many = redis_jdelete_many
+    server.jpipeline = redis_jpipeline
     return server
 
 
+def _jdumps(server, obj, codec=None, compression=None):
+    return serialize.dumps(
+        obj, codec=codec or getattr(server, 'codec', None),
+        compression=compression or getattr(server, 'compression', None))
+
+
+def _chunks(items, size):
+    for start in xrange(0, len(items), size):
+        yield items[start:start + size]
+
+
+class JSONPipeline(object):
+    """A non-transactional Redis pipeline with `jset` and `jget`. Any other
+    Redis command can be queued as well. Commands are sent every `chunk_size`
+    commands and when `execute` is called; their results are accumulated in
+    `results`, deserialized for `jget`:
+
+        with server.jpipeline() as pipe:
+            pipe.jget("a")
+            pipe.jset("b", {'c': 1}, ttl=60)
+            pipe.incr("d")
+        a, _, d = pipe.results
+    """
+    def __init__(self, server, chunk_size=None):
+        self.server = server
+        self.chunk_size = chunk_size or CHUNK_SIZE
+        self.pipe = server.pipeline(transaction=False)
+        self.decode = []
+        self.results = []
+
+    def jset(self, key, obj, ttl=None, codec=None, compression=None):
+        value = _jdumps(self.server, obj, codec, compression)
+        if ttl:
+            # Keyword arguments: Redis and StrictRedis differ in order.
+            self.pipe.setex(name=key, value=value, time=ttl)
+        else:
+            self.pipe.set(key, value)
+        self._queued(False)
+
+    def jget(self, key):
+        self.pipe.get(key)
+        self._queued(True)
+
+    def __getattr__(self, name):
+        command = getattr(self.pipe, name)
+
+        def queue(*args, **kwargs):
+            command(*args, **kwargs)
+            self._queued(False)
+        return queue
+
+    def _queued(self, decode):
+        self.decode.append(decode)
+        if len(self.decode) >= self.chunk_size:
+            self.execute()
+
+    def execute(self):
+        """Send queued commands, return the results of this chunk."""
+        if not self.decode:
+            return []
+        results = []
+        for decode, value in zip(self.decode, self.pipe.execute()):
+            if decode:
+                value = serialize.loads(value) if value else None
+            results.append(value)
+        self.decode = []
+        self.results.extend(results)
+        return results
+
+
+class HashCounter(object):
+    """Accumulate increments to the fields of a Redis hash in-process and send
+    them in a single pipelined round-trip when flushed.
+
+    Plain keys can also be set (see `set`), they are written in the same
+    pipeline. If `interval` is given (in seconds), `flush_if_due` will flush
+    whenever that much time has elapsed since the last flush. Counters can be
+    shared by threads.
+
+        counter = HashCounter(redis, "counts")
+        counter.incr("stream")
+        counter.incr("firehose", 10)
+        counter.flush()  # One round-trip: HINCRBY x 2.
+    """
+    def __init__(self, server, key, interval=None):
+        self.server = server
+        self.key = key
+        self.interval = interval
+        self.deltas = defaultdict(int)
+        self.values = {}
+        self.last_flush = time.time()
+        self.lock = threading.Lock()
+
+    def incr(self, field, amount=1):
+        with self.lock:
+            self.deltas[field] += amount
+
+    def set(self, key, value):
+        with self.lock:
+            self.values[key] = value
+
+    def flush(self):
+        """Send all accumulated increments and values in one pipeline."""
+        self.last_flush = time.time()
+        with self.lock:
+            if not (self.deltas or self.values):
+                return
+            deltas, self.deltas = self.deltas, defaultdict(int)
+            values, self.values = self.values, {}
+        pipe = self.server.pipeline(transaction=False)
+        for field, amount in deltas.iteritems():
+            if amount:
+                pipe.hincrby(self.key, field, amount)
+        for key, value in values.iteritems():
+            pipe.set(key, value)
+        pipe.execute()
+
+    def flush_if_due(self):
+        if self.interval is not None and \
+                time.time() - self.last_flush >= self.interval:
+            self.flush()
+
+
+class _Flight(object):
+    """A computation in progress, which other callers can wait on."""
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+def get_or_compute(key, loader, ttl, server=None, beta=1.0,
+                   serve_stale=False, stale_ttl=None, lock_ttl=10):
+    """Return the value of `key` from Redis, calling `loader()` to compute and
+    store it for `ttl` seconds when missing. This protects the backend behind
+    `loader` from cache stampedes:
+
+        - Concurrent misses are coalesced: in a process, only one thread (or
+          greenlet) calls the loader while the others wait for its result.
+          Across processes, only the holder of a short Redis lock, kept at
+          most `lock_ttl` seconds, calls the loader while the others poll for
+          the new value.
+        - Hot keys are refreshed before they expire, using probabilistic early
+          expiration (XFetch): the closer to expiry and the longer the loader
+          took last time, the more likely a caller is to refresh. A larger
+          `beta` refreshes earlier. During an early refresh, other callers
+          keep getting the current value.
+        - If `serve_stale` is True, an expired value is kept for another
+          `stale_ttl` seconds (default `ttl`) and returned to every caller
+          but the one refreshing it.
+
+    Values are stored as JSON, along with their expiry time and how long the
+    loader took. Use a dedicated key, not one written with `jset`.
+
+    Cf. Vattani, Chierichetti and Lowenstein, "Optimal Probabilistic Cache
+    Stampede Prevention", VLDB 2015.
+    """
+    server = server or get_redis_connection()
+    entry = _get_entry(server, key)
+    now = time.time()
+    if entry and not _is_due(entry, now, beta):
+        return entry['value']
+    # Can we hand out the current value while someone refreshes it?
+    usable = entry is not None and (serve_stale or now < entry['expiry'])
+
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+
+    if not leader:
+        if usable:
+            return entry['value']
+        flight.done.wait()
+        if flight.error:
+            raise flight.error
+        return flight.value
+
+    try:
+        flight.value = _compute_locked(server, key, loader, ttl, entry,
+                                       usable, serve_stale, stale_ttl,
+                                       lock_ttl)
+        return flight.value
+    except Exception, exception:
+        flight.error = exception
+        raise
+    finally:
+        with _flights_lock:
+            del _flights[key]
+        flight.done.set()
+
+
+def _get_entry(server, key):
+    value = server.get(key)
+    return json.loads(value) if value is not None else None
+
+
+def _is_due(entry, now, beta):
+    """Return True if the entry should be refreshed (XFetch)."""
+    # 1 - random() is in (0, 1], avoiding log(0).
+    gap = -entry['delta'] * beta * math.log(1 - random.random())
+    return now + gap >= entry['expiry']
+
+
+def _compute_locked(server, key, loader, ttl, entry, usable, serve_stale,
+                    stale_ttl, lock_ttl):
+    """Compute the value under a Redis lock, or wait for the lock holder."""
+    lock_key = "lock:{}".format(key)
+    token = uuid.uuid4().hex
+    if server.set(lock_key, token, nx=True, px=int(lock_ttl * 1000)):
+        try:
+            return _compute(server, key, loader, ttl, serve_stale, stale_ttl)
+        finally:
+            # Only release our own lock, it might have timed out.
+            server.eval(RELEASE_LOCK, 1, lock_key, token)
+
+    if usable:
+        return entry['value']
+
+    # Another process is computing, wait for its result.
+    deadline = time.time() + lock_ttl
+    while time.time() < deadline:
+        time.sleep(0.05)
+        entry = _get_entry(server, key)
+        if entry and time.time() < entry['expiry']:
+            return entry['value']
+        if not server.exists(lock_key):
+            break
+    log.info("Gave up waiting for {}, computing it.".format(key))
+    return _compute(server, key, loader, ttl, serve_stale, stale_ttl)
+
+
+def _compute(server, key, loader, ttl, serve_stale, stale_ttl):
+    start = time.time()
+    value = loader()
+    now = time.time()
+    entry = {'value': value, 'delta': now - start, 'expiry': now + ttl}
+    if serve_stale:
+        ttl += ttl if stale_ttl is None else stale_ttl
+    server.setex(name=key, value=json.dumps(entry),
+                 time=int(math.ceil(ttl)))
+    return value
+
+
+def get_memcache_servers():
+    """Return the list of memcache servers, as `host:port` strings. The
+    priority is:
+        - look for an environment variable MEMCACHE_SERVERS, a comma
+          delimited list of `host:port`, else
+        - look for EC2 hosted servers offering the service 'memcache', else
+        - use localhost, 127.0.0.1.
+    """
+    servers = os.environ.get("MEMCACHE_SERVERS")
+    if servers:
+        return [server.strip() for server in servers.split(",")]
+    try:
+        hosts = ec2.find_service_ip("memcache")
+    except Exception, exception:
+        # No AWS credentials in the environment. That's ok.
+        log.info(exception)
+        hosts = []
+    port = os.environ.get("MEMCACHE_PORT", 11211)
+    return ["{}:{}".format(host, port) for host in hosts or ["127.0.0.1"]]
+
+
 @Memoized
-def get_memcache_connection():
-    return memcache.Client(['127.0.0.1:11211'], debug=0)
+def get_memcache_connection(servers=None):
+    """Return a memcache client to the given servers, a tuple of `host:port`,
+    or else to those returned by `get_memcache_servers`. Keys are spread over
+    several servers by a `MemcachePool`.
+    """
+    servers = list(servers or get_memcache_servers())
+    log.info("Connecting to memcache servers {}".format(servers))
+    if len(servers) == 1:
+        return memcache_client.Client(servers, debug=0)
+    return MemcachePool(servers)
+
+
+class HashRing(object):
+    """A consistent hash ring, compatible with ketama: each node is placed at
+    `points` pseudo-random positions on a ring, a key belongs to the first node
+    found clockwise from the key's own position. Adding or removing one of N
+    nodes thus moves only about 1/N of the keys.
+    """
+    def __init__(self, nodes=(), points=160):
+        self.points = points
+        self.ring = {}
+        self.positions = []
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        for position in self._node_positions(node):
+            self.ring[position] = node
+        self.positions = sorted(self.ring)
+
+    def remove(self, node):
+        for position in self._node_positions(node):
+            self.ring.pop(position, None)
+        self.positions = sorted(self.ring)
+
+    def get_node(self, key):
+        """Return the node owning `key`, None if the ring is empty."""
+        if not self.positions:
+            return None
+        index = bisect.bisect(self.positions, self._hash(key))
+        if index == len(self.positions):
+            index = 0
+        return self.ring[self.positions[index]]
+
+    def _node_positions(self, node):
+        # Each md5 digest gives four positions.
+        for index in xrange(self.points / 4):
+            digest = hashlib.md5("{}-{}".format(node, index)).digest()
+            for offset in xrange(0, 16, 4):
+                yield struct.unpack("<I", digest[offset:offset + 4])[0]
+
+    def _hash(self, key):
+        return struct.unpack("<I", hashlib.md5(key).digest()[:4])[0]
+
+
+class MemcachePool(object):
+    """A memcache client spreading keys over several servers with a
+    `HashRing`. It has the same interface as a python-memcached client.
+
+    A server failing a request is taken out of the ring, its keys going to
+    the other servers, and put back after `retry` seconds. Each consecutive
+    failure doubles the delay, up to `max_retry` seconds.
+    """
+    def __init__(self, servers, retry=30, max_retry=600, client_factory=None):
+        client_factory = client_factory or \
+            (lambda server: memcache_client.Client([server], debug=0))
+        self.clients = {server: client_factory(server) for server in servers}
+        self.ring = HashRing(servers)
+        self.retry = retry
+        self.max_retry = max_retry
+        # Dead servers, with the time at which to retry them.
+        self.dead = {}
+        # Last ejection delay of servers that failed since their last success.
+        self._last_delay = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        return self._call(key, "get", key)
+
+    def set(self, key, obj, time=0, min_compress_len=0):
+        return self._call(key, "set", key, obj, time=time,
+                          min_compress_len=min_compress_len)
+
+    def delete(self, key):
+        return self._call(key, "delete", key)
+
+    def get_multi(self, keys):
+        values = {}
+        for server, server_keys in self._group(keys).iteritems():
+            values.update(self._call_server(server, "get_multi",
+                                            server_keys) or {})
+        return values
+
+    def set_multi(self, mapping, time=0, min_compress_len=0):
+        """Return the list of keys that could not be stored."""
+        failed = []
+        for server, keys in self._group(mapping).iteritems():
+            result = self._call_server(
+                server, "set_multi", {key: mapping[key] for key in keys},
+                time, min_compress_len=min_compress_len)
+            failed.extend(keys if result is None else result)
+        return failed
+
+    def _group(self, keys):
+        self._revive()
+        groups = defaultdict(list)
+        for key in keys:
+            groups[self.ring.get_node(key)].append(key)
+        return groups
+
+    def _call(self, key, method, *args, **kwargs):
+        self._revive()
+        return self._call_server(self.ring.get_node(key), method,
+                                 *args, **kwargs)
+
+    def _call_server(self, server, method, *args, **kwargs):
+        if server is None:
+            return None
+        client = self.clients[server]
+        try:
+            result = getattr(client, method)(*args, **kwargs)
+        except (socket.error, IOError), exception:
+            log.warning("memcache {} failed: {}".format(server, exception))
+            self._eject(server)
+            return None
+        # python-memcached doesn't raise, it marks its host as dead.
+        if any(getattr(host, 'deaduntil', 0) > time.time()
+               for host in getattr(client, 'servers', [])):
+            self._eject(server)
+            return None
+        if self._last_delay:
+            self._last_delay.pop(server, None)
+        return result
+
+    def _eject(self, server):
+        with self.lock:
+            if server in self.dead:
+                return
+            delay = min(self._last_delay.get(server, 0) * 2 or self.retry,
+                        self.max_retry)
+            self._last_delay[server] = delay
+            self.dead[server] = time.time() + delay
+            self.ring.remove(server)
+        log.warning("Ejected memcache {} for {} secs.".format(server, delay))
+
+    def _revive(self):
+        if not self.dead:
+            return
+        now = time.time()
+        with self.lock:
+            for server, retry_time in self.dead.items():
+                if retry_time <= now:
+                    del self.dead[server]
+                    self.ring.add(server)
+                    log.info("Retrying memcache {}.".format(server))
 
 
 class MemProxy(object):
-    def __init__(self):
-        self.cache = get_memcache_connection()
+    """A memcache client. By default, objects are pickled and compressed by
+    python-memcached. If a `codec` is given, objects are serialized by
+    cloudly.serialize instead, with the given `compression` above
+    `threshold` bytes. Both can be overridden per call to `set`.
+
+    The `servers` are a list of `host:port`, cf. `get_memcache_servers` for
+    the default. The connection is made on first use.
+    """
+    def __init__(self, servers=None, codec=None, compression=None,
+                 threshold=serialize.DEFAULT_THRESHOLD):
+        self.servers = tuple(servers) if servers else None
+        self._cache = None
+        self.codec = codec
+        self.compression = compression
+        self.threshold = threshold
 
-    def set(self, key, obj, time=0):
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = get_memcache_connection(self.servers)
+        return self._cache
+
+    @cache.setter
+    def cache(self, client):
+        self._cache = client
+
+    def set(self, key, obj, time=0, codec=None, compression=None):
         if key.find(" ") > -1:
             raise ValueError("A memcached key cannot contain spaces.")
+        obj, min_compress_len = self._dumps(obj, codec, compression)
         return self.cache.set(key.encode("utf-8"), obj, time=time,
-                              min_compress_len=1024)
+                              min_compress_len=min_compress_len)
 
     def get(self, key):
-        return self.cache.get(key.encode("utf-8"))
+        return self._loads(self.cache.get(key.encode("utf-8")))
 
-    def set_multi(self, mapping, time=0):
-        return self.cache.set_multi(mapping, time, min_compress_len=1024)
+    def set_multi(self, mapping, time=0, codec=None, compression=None):
+        min_compress_len = 1024
+        if codec or self.codec:
+            mapping = {key: self._dumps(obj, codec, compression)[0]
+                       for key, obj in mapping.iteritems()}
+            min_compress_len = 0
+        return self.cache.set_multi(mapping, time,
+                                    min_compress_len=min_compress_len)
 
     def get_multi(self, keys):
-        return self.cache.get_multi(keys)
+        return {key: self._loads(value)
+                for key, value in self.cache.get_multi(keys).iteritems()}
+
+    def _dumps(self, obj, codec, compression):
+        """Return the serialized object and the min_compress_len to use."""
+        codec = codec or self.codec
+        if not codec:
+            return obj, 1024
+        # Always with a header: values without one are python-memcached's.
+        data = serialize.dumps(obj, codec=codec,
+                               compression=compression or self.compression,
+                               threshold=self.threshold, header=True)
+        # Don't let python-memcached compress a second time.
+        return data, 0
+
+    def _loads(self, value):
+        if serialize.is_serialized(value):
+            return serialize.loads(value)
+        return value
 
     def delete(self, key):
         self.cache.delete(key)
 
 
 memcache = MemProxy()  # noqa
+
+
+class LRUCache(object):
+    """A thread-safe, in-process cache keeping at most `maxsize` entries. The
+    least recently used entries are evicted first and each entry can be given
+    a time-to-live in seconds.
+    """
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.data.pop(key, _missing)
+            if entry is _missing:
+                return default
+            value, expires = entry
+            if expires is not None and expires <= time.time():
+                return default
+            # Re-insert as the most recently used.
+            self.data[key] = entry
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = (value, expires)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+
+class MemcacheTier(object):
+    """Adapt a `MemProxy` to the interface of a `TieredCache` tier."""
+    def __init__(self, client):
+        self.client = client
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(key, value, time=ttl or 0)
+
+    def delete(self, key):
+        self.client.delete(key)
+
+
+class RedisTier(object):
+    """Adapt a Redis connection to the interface of a `TieredCache` tier.
+    Values are serialized like `jset`/`jget` do, with the connection codec.
+    """
+    def __init__(self, server):
+        self.server = server
+
+    def get(self, key):
+        value = self.server.get(key)
+        return serialize.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        value = serialize.dumps(value,
+                                codec=getattr(self.server, 'codec', None),
+                                compression=getattr(self.server,
+                                                    'compression', None))
+        if ttl:
+            # Keyword arguments: Redis and StrictRedis differ in order.
+            self.server.setex(name=key, value=value, time=ttl)
+        else:
+            self.server.set(key, value)
+
+    def delete(self, key):
+        self.server.delete(key)
+
+
+class TieredCache(object):
+    """A read-through cache made of an in-process LRU cache in front of
+    memcache and/or Redis. Hot keys are served from memory, other keys are
+    looked up in memcache, then Redis, and finally computed by a loader
+    function:
+
+        cache = TieredCache("users", memcache=memcache,
+                            redis=get_redis_connection(), ttl=300)
+        user = cache.get(user_id, loader=fetch_user)
+
+    A value found in a lower tier is copied to the tiers above it.
+
+    Parameters:
+        - `namespace`: prefixed to every key, as in `namespace:key`;
+        - `local_size`: number of entries kept in-process;
+        - `local_ttl`: maximum time, in seconds, an entry is kept in-process.
+          This bounds staleness should an invalidation message be lost;
+        - `ttl`: default time-to-live, in seconds, for all tiers. Can be given
+          per key to `get` and `set`. Zero means no expiry;
+        - `loader`: default function computing the value of a missing key;
+        - `negative_ttl`: if given, a key for which the loader returned None is
+          remembered as missing for that many seconds, instead of calling the
+          loader again on every read;
+        - `write_behind`: if True, `set` only updates the in-process tier right
+          away, memcache and Redis are updated by a background thread. Call
+          `flush` to wait for pending writes. Otherwise, all tiers are written
+          before `set` returns (write-through);
+        - `channel`: name of a Redis pub/sub channel. When given (and `redis`
+          is), every `set` and `delete` is broadcast on it so that the
+          in-process tier of other processes drops its copy of the key. With
+          `write_behind`, the broadcast follows the writes to the other
+          tiers.
+    """
+    NEGATIVE = {'__cloudly_negative__': True}
+
+    def __init__(self, namespace, memcache=None, redis=None, local_size=1000,
+                 local_ttl=60, ttl=0, loader=None, negative_ttl=None,
+                 write_behind=False, channel=None):
+        self.namespace = namespace
+        self.local = LRUCache(local_size)
+        self.local_ttl = local_ttl
+        self.ttl = ttl
+        self.loader = loader
+        self.negative_ttl = negative_ttl
+        self.redis = redis
+
+        self.tiers = []
+        if memcache is not None:
+            self.tiers.append(MemcacheTier(memcache))
+        if redis is not None:
+            self.tiers.append(RedisTier(redis))
+
+        self.write_behind = write_behind
+        if write_behind:
+            self.queue = Queue.Queue()
+            self._spawn(self._write_behind)
+
+        self.origin = uuid.uuid4().hex
+        self.channel = channel if redis is not None else None
+        if self.channel:
+            self.pubsub = redis.pubsub()
+            self.pubsub.subscribe(self.channel)
+            self._spawn(self._listen)
+
+    def get(self, key, loader=None, ttl=None):
+        """Return the value of `key`, looking up each tier in turn. On a miss,
+        the value is computed by `loader` (or the default loader), stored in
+        every tier and returned. Return None if the key is missing and there
+        is no loader.
+        """
+        full_key = self._key(key)
+        value = self.local.get(full_key, _missing)
+        if value is _missing:
+            for index, tier in enumerate(self.tiers):
+                value = tier.get(full_key)
+                if value is not None:
+                    self.local.set(full_key, value, self._local_ttl(ttl))
+                    for upper in self.tiers[:index]:
+                        upper.set(full_key, value, self._ttl(ttl))
+                    break
+            else:
+                loader = loader or self.loader
+                if loader is None:
+                    return None
+                value = loader(key)
+                if value is None:
+                    if self.negative_ttl:
+                        self._store(full_key, self.NEGATIVE,
+                                    self.negative_ttl)
+                    return None
+                self._store(full_key, value, ttl)
+        return None if value == self.NEGATIVE else value
+
+    def set(self, key, value, ttl=None):
+        """Store a value in all tiers, `ttl` overrides the default
+        time-to-live.
+        """
+        full_key = self._key(key)
+        self._store(full_key, value, ttl)
+        self._broadcast(full_key)
+
+    def delete(self, key):
+        """Remove a key from all tiers, including the in-process tier of other
+        processes listening on the invalidation channel.
+        """
+        full_key = self._key(key)
+        self.local.delete(full_key)
+        for tier in self.tiers:
+            self._write(tier.delete, full_key)
+        self._broadcast(full_key)
+
+    def flush(self):
+        """Wait until all write-behind operations are done."""
+        if self.write_behind:
+            self.queue.join()
+
+    def _key(self, key):
+        return "{}:{}".format(self.namespace, key)
+
+    def _ttl(self, ttl):
+        return self.ttl if ttl is None else ttl
+
+    def _local_ttl(self, ttl):
+        ttl = self._ttl(ttl)
+        return min(ttl, self.local_ttl) if ttl else self.local_ttl
+
+    def _store(self, full_key, value, ttl):
+        self.local.set(full_key, value, self._local_ttl(ttl))
+        for tier in self.tiers:
+            self._write(tier.set, full_key, value, self._ttl(ttl))
+
+    def _write(self, operation, *args):
+        if self.write_behind:
+            self.queue.put((operation, args))
+        else:
+            operation(*args)
+
+    def _broadcast(self, full_key):
+        # Queued after the writes, lest other processes read the old value
+        # back from the lower tiers.
+        if self.channel:
+            self._write(self.redis.publish, self.channel,
+                        "{}:{}".format(self.origin, full_key))
+
+    def _spawn(self, target):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+
+    def _write_behind(self):
+        while True:
+            operation, args = self.queue.get()
+            try:
+                operation(*args)
+            except Exception, exception:
+                log.error(exception)
+            finally:
+                self.queue.task_done()
+
+    def _listen(self):
+        for message in self.pubsub.listen():
+            if message['type'] != 'message':
+                continue
+            origin, _, full_key = message['data'].partition(":")
+            if origin != self.origin:
+                self.local.delete(full_key)
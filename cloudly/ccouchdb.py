@@ -3,20 +3,37 @@ Provide CouchDB utility functions.
 
 """
 import os
+import json
+import time
+import hashlib
+import socket
+import threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from urlparse import urlsplit
+
 import yaml
 
 import couchdb
 
+from cloudly import cache
+from cloudly.bloom import RotatingBloomFilter
 from cloudly.decorators import Memoized
 import cloudly.logger as logger
 from cloudly.aws import ec2
 
 log = logger.init(__name__)
 
+# Field of design documents holding the hash of their source.
+DESIGN_HASH_FIELD = "source_hash"
+# Suffix of the id under which a design document is staged.
+STAGING_SUFFIX = "_staging"
+
 
 @Memoized
 def get_server(hostname=None, port=None, username=None, password=None,
-               protocol=None):
+               protocol=None, timeout=None, pool_size=None,
+               idle_timeout=None, cache_size=None):
     """Return a server instance.
 
     The following heuristic is used to find the server:
@@ -26,6 +43,15 @@ def get_server(hostname=None, port=None, username=None, password=None,
           server if none was found so far,
         - else use 127.0.0.1
 
+    Requests time out after `timeout` seconds (env. COUCHDB_TIMEOUT, default
+    120) and go over keep-alive connections: at most `pool_size` idle ones
+    (env. COUCHDB_POOL_SIZE, default 10) are kept, for at most
+    `idle_timeout` seconds (env. COUCHDB_IDLE_TIMEOUT, default 60). Cf.
+    `KeepAlivePool`.
+
+    The server is a `Server`: its databases have a `get_many` method and
+    a cache of `cache_size` documents (env. COUCHDB_CACHE_SIZE, default
+    1000).
     """
     host = (
         hostname or
@@ -56,7 +82,144 @@ def get_server(hostname=None, port=None, username=None, password=None,
         )
         log.info("{} port {}".format(host, port))
 
-    return couchdb.Server(url)
+    def env(name, default, cast=float):
+        value = os.environ.get(name)
+        return cast(value) if value else default
+
+    timeout = timeout or env("COUCHDB_TIMEOUT", 120)
+    session = couchdb.http.Session(timeout=timeout,
+                                   retry_delays=[0, 0.5, 2])
+    session.connection_pool = KeepAlivePool(
+        timeout,
+        max_idle=pool_size or env("COUCHDB_POOL_SIZE", 10, int),
+        idle_timeout=idle_timeout or env("COUCHDB_IDLE_TIMEOUT", 60))
+    return Server(url, session=session,
+                  cache_size=cache_size or env("COUCHDB_CACHE_SIZE", 1000,
+                                               int))
+
+
+class KeepAlivePool(couchdb.http.ConnectionPool):
+    """A pool of HTTP connections to CouchDB, reused from one request to the
+    next. At most `max_idle` idle connections are kept by host, others are
+    closed. Connections idle for more than `idle_timeout` seconds, which the
+    server may have closed, are not reused. TCP keepalive is on.
+    """
+    def __init__(self, timeout, max_idle=10, idle_timeout=60, **kwargs):
+        super(KeepAlivePool, self).__init__(timeout, **kwargs)
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.released = {}  # Time of release, by connection id.
+        self.created = 0
+
+    def get(self, url):
+        scheme, host = urlsplit(url, 'http', False)[:2]
+        now = time.time()
+        conn = None
+        with self.lock:
+            conns = self.conns.setdefault((scheme, host), [])
+            # The oldest connections come first.
+            while conns and now - self.released[id(conns[0])] > \
+                    self.idle_timeout:
+                stale = conns.pop(0)
+                del self.released[id(stale)]
+                stale.close()
+            if conns:
+                conn = conns.pop()
+                del self.released[id(conn)]
+            else:
+                self.created += 1
+        if conn is None:
+            conn = self._connect(scheme, host)
+        return conn
+
+    def _connect(self, scheme, host):
+        if scheme == 'http':
+            cls = couchdb.http.HTTPConnection
+        elif scheme == 'https':
+            cls = couchdb.http.HTTPSConnection
+            if self.disable_ssl_verification:
+                cls = couchdb.http.InsecureHTTPSConnection
+        else:
+            raise ValueError("{} is not a supported scheme".format(scheme))
+        conn = cls(host, timeout=self.timeout)
+        conn.connect()
+        conn.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        return conn
+
+    def release(self, url, conn):
+        with self.lock:
+            conns = self.conns.setdefault(urlsplit(url, 'http', False)[:2],
+                                          [])
+            if len(conns) >= self.max_idle:
+                conn.close()
+                return
+            conns.append(conn)
+            self.released[id(conn)] = time.time()
+
+
+class Server(couchdb.Server):
+    """A server returning `Database`s. Each database has a cache of at most
+    `cache_size` documents, shared by the `Database` instances of the same
+    name.
+    """
+    def __init__(self, url, full_commit=True, session=None, cache_size=1000):
+        super(Server, self).__init__(url, full_commit, session)
+        self.cache_size = cache_size
+        self.doc_caches = {}
+
+    def __getitem__(self, name):
+        doc_cache = self.doc_caches.setdefault(
+            name, cache.LRUCache(self.cache_size))
+        database = Database(self.resource(name), name, doc_cache=doc_cache)
+        database.resource.head()  # Fail now if the database is missing.
+        return database
+
+
+class Database(couchdb.Database):
+    """A database with a bulk read method, `get_many`, backed by a local
+    cache of documents, `doc_cache`.
+    """
+    def __init__(self, url, name=None, session=None, doc_cache=None):
+        super(Database, self).__init__(url, name, session)
+        self.doc_cache = doc_cache if doc_cache is not None else \
+            cache.LRUCache()
+
+    def get_many(self, ids):
+        """Return the documents of the given ids, in order, None for missing
+        ones.
+
+        The current revisions of the documents are asked first, then only
+        the documents not in the local cache at that revision: at most two
+        `_all_docs` requests. Documents are shared with the cache, don't
+        modify them.
+        """
+        ids = list(ids)
+        unique_ids = list(OrderedDict.fromkeys(ids))
+        docs = {}
+        stale = []
+        for row in self._all_docs(unique_ids):
+            value = row.get('value')
+            if not value or value.get('deleted'):
+                continue
+            cached = self.doc_cache.get(row['key'])
+            if cached and cached['_rev'] == value['rev']:
+                docs[row['key']] = cached
+            else:
+                stale.append(row['key'])
+        if stale:
+            for row in self._all_docs(stale, include_docs=True):
+                doc = row.get('doc')
+                if doc:
+                    self.doc_cache.set(row['key'], doc)
+                    docs[row['key']] = doc
+        return [docs.get(doc_id) for doc_id in ids]
+
+    def _all_docs(self, ids, include_docs=False):
+        if not ids:
+            return []
+        _, _, data = self.resource.post_json(
+            '_all_docs', body={'keys': ids}, include_docs=include_docs)
+        return data['rows']
 
 
 def get_or_create(server, database_name):
@@ -67,23 +230,392 @@ def get_or_create(server, database_name):
     return database
 
 
-def sync_design_doc(database, design_filename):
-    """Sync a design document written as a YAML file."""
+def sync_design_doc(database, design_filename, staged=True):
+    """Sync a design document written as a YAML file. Return True if it was
+    updated, False if unchanged.
+
+    The hash of the document is saved with it, under `source_hash`, and the
+    document is only written when that hash changes, since CouchDB then
+    rebuilds its views.
+
+    A new version is first saved under a temporary id, `<id>_staging`, and
+    its views built. It is then copied over the current version, reusing
+    the views built: queries never wait for the index. Set `staged` to False
+    to replace it right away.
+    """
     with open(design_filename) as design_file:
         design_doc = yaml.load(design_file)
-    # Delete old document, to avoid ResourceConflict exceptions.
-    old = database.get(design_doc['_id'])
-    if old:
-        database.delete(old)
-    database.save(design_doc)
+    design_id = design_doc['_id']
+    design_doc[DESIGN_HASH_FIELD] = _design_hash(design_doc)
+
+    old = database.get(design_id)
+    if old and old.get(DESIGN_HASH_FIELD) == design_doc[DESIGN_HASH_FIELD]:
+        log.debug("{} is up to date.".format(design_id))
+        return False
+
+    if not (old and staged and design_doc.get('views')):
+        if old:
+            design_doc['_rev'] = old['_rev']
+        database.save(design_doc)
+        return True
+
+    staging_id = design_id + STAGING_SUFFIX
+    staging_doc = dict(design_doc, _id=staging_id)
+    previous = database.get(staging_id)
+    if previous:
+        staging_doc['_rev'] = previous['_rev']
+    database.save(staging_doc)
+    log.info("Building the views of {}".format(staging_id))
+    _build_views(database, staging_id, design_doc['views'])
+
+    database.copy(staging_id, {'_id': design_id, '_rev': old['_rev']})
+    database.delete(database.get(staging_id))
+    log.info("{} updated.".format(design_id))
+    return True
+
+
+def _design_hash(design_doc):
+    content = {key: value for key, value in design_doc.iteritems()
+               if key not in ('_rev', DESIGN_HASH_FIELD)}
+    return hashlib.sha1(json.dumps(content, sort_keys=True)).hexdigest()
 
 
-def update_feed(database_name, include_docs=False):
+def _build_views(database, design_id, views):
+    """Wait for the views of a design document to be built. They share one
+    index, built by querying any of them.
+    """
+    name = "{}/{}".format(design_id[len("_design/"):], sorted(views)[0])
+    while True:
+        try:
+            list(database.view(name, limit=1))
+            return
+        except socket.timeout:
+            log.info("Still building {}".format(design_id))
+
+
+def update_feed(database_name, include_docs=False, since=None, **options):
     """Return a continuous feed of updates to the database.
-    The most recent changes are returned.
+    The most recent changes are returned, or those after the `since`
+    sequence if given. Other options, e.g. `filter`, are query parameters of
+    the changes feed. Cf. `ChangesConsumer` to resume from a checkpoint.
     """
     db = get_server()[database_name]
-    since = db.info()['update_seq']
+    if since is None:
+        since = db.info()['update_seq']
+    # Heartbeats, in milliseconds, keep the connection from timing out.
+    options.setdefault('heartbeat', 10000)
     return db.changes(feed='continuous',
                       include_docs=include_docs,
-                      since=since)
+                      since=since, **options)
+
+
+class FileCheckpoint(object):
+    """A sequence saved to a JSON file."""
+    def __init__(self, path):
+        self.path = path
+
+    def get(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as checkpoint_file:
+            return json.load(checkpoint_file)['seq']
+
+    def set(self, seq):
+        # Write then rename, so that the file is never partially written.
+        temporary = "{}.{}".format(self.path, os.getpid())
+        with open(temporary, "w") as checkpoint_file:
+            json.dump({'seq': seq}, checkpoint_file)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.rename(temporary, self.path)
+
+
+class RedisCheckpoint(object):
+    """A sequence saved to a Redis key."""
+    def __init__(self, key, server=None):
+        self.key = key
+        self.server = server or cache.get_redis_connection()
+
+    def get(self):
+        value = self.server.get(self.key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, seq):
+        self.server.set(self.key, json.dumps(seq))
+
+
+class ChangesConsumer(object):
+    """Consume the changes of a database in batches, resuming after a restart
+    where the previous run left off:
+
+        consumer = ChangesConsumer("tweets", index,
+                                   checkpoint="/var/lib/indexer/seq.json")
+        consumer.run()
+
+    `processor` is called with lists of changes, as found in the changes
+    feed, each holding its document under `doc`, None for deleted
+    documents. Batches hold at most `batch_size` changes, and are processed
+    at most `batch_interval` seconds after their first change arrived.
+    Documents are fetched in bulk, with one `_all_docs` request per batch.
+    Set `include_docs` to False to only get the changes.
+
+    `database` is a database or its name. `checkpoint` is the path of a file,
+    or an object with `get()` and `set(seq)` methods, such as a
+    `RedisCheckpoint`. The sequence of the last change of each batch is saved
+    there once the batch is processed. Without checkpoint, or a first time,
+    changes are consumed from `since`: 0 for all changes, None for changes
+    from now on.
+
+    `filter` names a server-side filter, e.g. "app/important", "_doc_ids"
+    or "_design", and `filter_params` are its query parameters.
+    """
+    def __init__(self, database, processor, checkpoint=None, since=0,
+                 batch_size=100, batch_interval=5, include_docs=True,
+                 filter=None, filter_params=None):
+        if isinstance(database, basestring):
+            database = get_server()[database]
+        if isinstance(checkpoint, basestring):
+            checkpoint = FileCheckpoint(checkpoint)
+        self.database = database
+        self.processor = processor
+        self.checkpoint = checkpoint
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.include_docs = include_docs
+        self.options = dict(filter_params or {})
+        if filter:
+            self.options['filter'] = filter
+
+        self.seq = self.saved_seq = checkpoint.get() if checkpoint else None
+        if self.seq is None:
+            self.seq = (since if since is not None else
+                        database.info()['update_seq'])
+        self.pending = []
+        self.pending_since = None
+
+    def run(self, stop_condition_fct=None):
+        """Consume changes until `stop_condition_fct()` returns True."""
+        while not (stop_condition_fct and stop_condition_fct()):
+            self.poll()
+        self.flush()
+
+    def poll(self):
+        """Wait for changes, at most until the pending batch is due, and
+        process the batches complete or due. Return the number of changes
+        received.
+        """
+        timeout = self.batch_interval
+        if self.pending:
+            timeout = max(0, self.pending_since + self.batch_interval -
+                          time.time())
+        result = self.database.changes(
+            feed='longpoll', since=self.seq,
+            limit=self.batch_size - len(self.pending),
+            timeout=int(timeout * 1000), **self.options)
+        changes = result['results']
+        if changes and not self.pending:
+            self.pending_since = time.time()
+        self.pending.extend(changes)
+        self.seq = result['last_seq']
+
+        if len(self.pending) >= self.batch_size or (
+                self.pending and
+                time.time() - self.pending_since >= self.batch_interval):
+            self.flush()
+        elif not self.pending:
+            # Changes may have been filtered out, don't go over them again.
+            self._save(self.seq)
+        return len(changes)
+
+    def flush(self):
+        """Process the pending changes, if any, and save the checkpoint."""
+        if not self.pending:
+            return
+        changes, self.pending = self.pending, []
+        if self.include_docs:
+            self._fetch_docs(changes)
+        self.processor(changes)
+        self._save(changes[-1]['seq'])
+
+    def _save(self, seq):
+        if self.checkpoint and seq != self.saved_seq:
+            self.checkpoint.set(seq)
+            self.saved_seq = seq
+
+    def _fetch_docs(self, changes):
+        ids = list(set(change['id'] for change in changes
+                       if not change.get('deleted')))
+        docs = {}
+        if ids:
+            _, _, data = self.database.resource.post_json(
+                '_all_docs', body={'keys': ids}, include_docs=True)
+            docs = {row['key']: row['doc'] for row in data['rows']
+                    if row.get('doc')}
+        for change in changes:
+            change['doc'] = docs.get(change['id'])
+
+
+class BulkWriter(object):
+    """Write documents to a database with `_bulk_docs` requests:
+
+        writer = BulkWriter(database)
+        stats = writer.write(docs)  # {'written': 998, 'existing': 2, ...}
+
+    Documents are sent in chunks of at most `max_docs` documents and
+    `max_bytes` bytes of JSON, `concurrency` chunks at a time, each over its
+    own pooled HTTP connection.
+
+    Documents failing to be written, alone or with their whole chunk, are
+    sent again up to `retries` times, waiting `retry_delay` seconds, doubled
+    at each attempt. Documents in conflict already exist: they are counted as
+    `existing`, unless `overwrite` is True, in which case they are sent
+    again with the current revision, if need be in one more attempt.
+
+    If `skip_existing` is True, the `_id`s written are kept in a
+    `cloudly.bloom.RotatingBloomFilter` of about `bloom_capacity` ids, and
+    documents whose `_id` is found there are not sent again. They are counted
+    as `skipped`. About one new document in `1 / error_rate` is then
+    mistaken for an existing one.
+    """
+    def __init__(self, database, max_docs=1000, max_bytes=4 * 1024 ** 2,
+                 concurrency=4, retries=3, retry_delay=0.5, overwrite=False,
+                 skip_existing=False, bloom_capacity=10 ** 6,
+                 error_rate=1e-6):
+        self.database = database
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.overwrite = overwrite
+        self.pool = ThreadPool(concurrency)
+        self.written_ids = None
+        self.lock = threading.Lock()
+        if skip_existing:
+            self.written_ids = RotatingBloomFilter(bloom_capacity, error_rate)
+
+    def write(self, docs):
+        """Write the given documents, without modifying them. Return a dict
+        of the number of documents `written`, `existing`, `skipped` and
+        `failed`.
+        """
+        stats = {'written': 0, 'existing': 0, 'skipped': 0, 'failed': 0}
+        encoded = []
+        for doc in docs:
+            if self.written_ids is not None and '_id' in doc and \
+                    doc['_id'] in self.written_ids:
+                stats['skipped'] += 1
+                continue
+            encoded.append((doc, json.dumps(doc)))
+
+        for chunk_stats in self.pool.imap_unordered(self._write_chunk,
+                                                    self._chunks(encoded)):
+            for key, count in chunk_stats.iteritems():
+                stats[key] += count
+        if stats['failed']:
+            log.error("Could not write {failed} documents.".format(**stats))
+        return stats
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def _chunks(self, encoded):
+        chunk, size = [], 0
+        for doc, data in encoded:
+            if chunk and (len(chunk) >= self.max_docs or
+                          size + len(data) > self.max_bytes):
+                yield chunk
+                chunk, size = [], 0
+            chunk.append((doc, data))
+            size += len(data) + 1
+        if chunk:
+            yield chunk
+
+    def _write_chunk(self, chunk):
+        """Write a chunk, retrying the documents which failed."""
+        stats = {'written': 0, 'existing': 0, 'failed': 0}
+        delay = self.retry_delay
+        attempt, attempts = 0, self.retries + 1
+        while chunk and attempt < attempts:
+            if attempt:
+                time.sleep(delay)
+                delay *= 2
+            attempt += 1
+            try:
+                results = self._post(chunk)
+            except (socket.error, couchdb.http.ServerError), exception:
+                log.warning("Bulk write of {} documents failed: {}".format(
+                    len(chunk), exception))
+                continue
+
+            failed, conflicts = [], []
+            for (doc, data), result in zip(chunk, results):
+                error = result.get('error')
+                if not error:
+                    stats['written'] += 1
+                    self._remember(result['id'])
+                elif error == 'conflict':
+                    conflicts.append((doc, data))
+                else:
+                    failed.append((doc, data))
+            if conflicts and self.overwrite:
+                try:
+                    failed.extend(self._with_revisions(conflicts))
+                    # Documents given their revision on the last attempt get
+                    # one more.
+                    if attempt == attempts == self.retries + 1:
+                        attempts += 1
+                except (socket.error, couchdb.http.ServerError):
+                    failed.extend(conflicts)
+            else:
+                stats['existing'] += len(conflicts)
+                for doc, _ in conflicts:
+                    self._remember(doc['_id'])
+            chunk = failed
+        stats['failed'] += len(chunk)
+        return stats
+
+    def _post(self, chunk):
+        body = '{"docs": [' + ",".join(data for _, data in chunk) + ']}'
+        _, _, results = self.database.resource.post_json(
+            '_bulk_docs', body=body,
+            headers={'Content-Type': "application/json"})
+        return results
+
+    def _with_revisions(self, chunk):
+        """Return the documents of `chunk`, encoded with their current
+        revision.
+        """
+        ids = [doc['_id'] for doc, _ in chunk]
+        _, _, data = self.database.resource.post_json(
+            '_all_docs', body={'keys': ids})
+        revisions = {row['key']: row['value']['rev']
+                     for row in data['rows'] if 'value' in row}
+        updated = []
+        for doc, data in chunk:
+            if doc['_id'] in revisions:
+                doc = dict(doc, _rev=revisions[doc['_id']])
+                data = json.dumps(doc)
+            updated.append((doc, data))
+        return updated
+
+    def _remember(self, doc_id):
+        if self.written_ids is not None:
+            with self.lock:
+                self.written_ids.add(doc_id)
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def get_bulk_writer(database, **kwargs):
+    """Return this process's `BulkWriter` of `database` with the given
+    options, created on first use.
+    """
+    # A writer's threads don't survive a fork.
+    key = (os.getpid(), database.resource.url, tuple(sorted(kwargs.items())))
+    with _writers_lock:
+        if key not in _writers:
+            _writers[key] = BulkWriter(database, **kwargs)
+        return _writers[key]
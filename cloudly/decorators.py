@@ -4,50 +4,164 @@ You might be interested in this decorator *cheat sheet*:
     https://gist.github.com/hdemers/5357602
 """
 import inspect
+import threading
+import time
+from collections import namedtuple, OrderedDict
 from functools import wraps, partial
 from datetime import datetime, timedelta
 import cProfile
 import pstats
 
 
+CacheInfo = namedtuple("CacheInfo",
+                       ["hits", "misses", "evictions", "maxsize", "currsize"])
+
+_missing = object()
+_kwd_mark = object()
+
+
 class Memoized(object):
     """Decorator that caches a function's return value each time it is called.
     If called later with the same arguments, the cached value is returned, and
     not re-evaluated.
 
+    By default the cache is unbounded and entries never expire. Both can be
+    changed:
+
+        @Memoized(maxsize=1000, ttl=60)
+        def f(x, y=None):
+            ...
+
+    where `maxsize` is the number of entries kept, least recently used first
+    out, and `ttl` is the number of seconds an entry is valid.
+
+    The cache can be inspected and invalidated:
+
+        f.cache_info()    # CacheInfo(hits=..., misses=..., evictions=..., ...)
+        f.invalidate(x)   # Forget the value of f(x).
+        f.cache_clear()   # Forget everything.
+
+    Arguments are matched against the function signature, so that for the
+    function above, the calls f(x), f(x, None) and f(x, y=None) all share the
+    same cache entry.
+
     Tips & trips with this memoize:
 
         1. Do not use with functions that take any sort of mutable value as an
         argument, like lists, sets or dicts, or else the underlying function
         will always get called.
 
-        2. Memoized should work with keyword values, but even then, for the
-        function:
-
-            def f(x, y=None)
-
-        the calls f(x, None), f(x) and f(x, y=None) are *NOT* equivalent and
-        will lead to f being called 3 times, so be carefull.
+        2. Concurrent calls with the same arguments are not coalesced, the
+        function may be called more than once on a cold cache.
 
     Cf. http://wiki.python.org/moin/PythonDecoratorLibrary#Memoize
     """
-    def __init__(self, func):
+    def __new__(cls, func=None, maxsize=None, ttl=None):
+        if func is None:
+            # Called with options only, i.e. @Memoized(maxsize=10).
+            return partial(cls, maxsize=maxsize, ttl=ttl)
+        return super(Memoized, cls).__new__(cls)
+
+    def __init__(self, func, maxsize=None, ttl=None):
         self.func = func
-        self.cache = {}
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.cache = OrderedDict() if maxsize is not None else {}
+        # Under gevent, a monkey-patched threading.Lock is a greenlet lock.
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+        try:
+            spec = inspect.getargspec(func)
+            self.argnames = spec.args
+            self.defaults = dict(zip(reversed(spec.args),
+                                     reversed(spec.defaults or ())))
+        except TypeError:
+            # Not a Python function, can't normalize arguments.
+            self.argnames = None
 
     def __call__(self, *args, **kwargs):
-        cache_key = (args, frozenset(kwargs.items()))  # frozenset is cacheable
         try:
-            return self.cache[cache_key]
-        except KeyError:
-            value = self.func(*args, **kwargs)
-            self.cache[cache_key] = value
-            return value
+            cache_key = self._make_key(args, kwargs)
+            hash(cache_key)
         except TypeError:
             # uncachable -- for instance, passing a list as an argument.
             # Better to not cache than to blow up entirely.
             return self.func(*args, **kwargs)
 
+        with self.lock:
+            entry = self.cache.get(cache_key, _missing)
+            if entry is not _missing:
+                value, expires = entry
+                if expires is None or expires > time.time():
+                    self.hits += 1
+                    if self.maxsize is not None:
+                        # Move to the most recently used end.
+                        del self.cache[cache_key]
+                        self.cache[cache_key] = entry
+                    return value
+                del self.cache[cache_key]
+                self.evictions += 1
+            self.misses += 1
+
+        value = self.func(*args, **kwargs)
+        expires = time.time() + self.ttl if self.ttl is not None else None
+
+        with self.lock:
+            self.cache[cache_key] = (value, expires)
+            if self.maxsize is not None:
+                while len(self.cache) > self.maxsize:
+                    self.cache.popitem(last=False)
+                    self.evictions += 1
+        return value
+
+    def _make_key(self, args, kwargs):
+        """Return a cache key where arguments are listed in the order of the
+        function signature, with default values filled in.
+        """
+        if self.argnames is None:
+            return (args, frozenset(kwargs.items()))  # frozenset is cacheable
+        nargs = len(self.argnames)
+        if not kwargs and len(args) == nargs:
+            return args
+
+        key = list(args[:nargs])
+        kwargs = dict(kwargs)
+        for name in self.argnames[len(key):]:
+            if name in kwargs:
+                key.append(kwargs.pop(name))
+            elif name in self.defaults:
+                key.append(self.defaults[name])
+            else:
+                raise TypeError("Missing argument {!r}".format(name))
+        # Extra positional arguments, i.e. *args.
+        key.extend(args[nargs:])
+        if kwargs:
+            # Extra keyword arguments, i.e. **kwargs.
+            key.append(_kwd_mark)
+            key.append(frozenset(kwargs.items()))
+        return tuple(key)
+
+    def invalidate(self, *args, **kwargs):
+        """Remove the entry cached for the given arguments, if any."""
+        try:
+            cache_key = self._make_key(args, kwargs)
+            with self.lock:
+                self.cache.pop(cache_key, None)
+        except TypeError:
+            pass
+
+    def cache_clear(self):
+        """Remove all entries and reset statistics."""
+        with self.lock:
+            self.cache.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def cache_info(self):
+        """Return hit, miss and eviction counts, as well as the cache size."""
+        with self.lock:
+            return CacheInfo(self.hits, self.misses, self.evictions,
+                             self.maxsize, len(self.cache))
+
     def __repr__(self):
         """Return the function's docstring."""
         return self.func.__doc__
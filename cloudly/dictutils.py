@@ -1,7 +1,12 @@
-import copy
+LEFT_WINS = 'left'
+RIGHT_WINS = 'right'
+CONCAT = 'concat'
+RAISE = 'raise'
 
+_missing = object()
 
-def merge(dict1, dict2):
+
+def merge(dict1, dict2, conflict=RAISE, inplace=False):
     """Merge two dicts.
     When merging, if two dicts have the same key, they are combined to form a
     new dict:
@@ -16,31 +21,78 @@ def merge(dict1, dict2):
             'd': 4
         }
 
-    There is one restriction: common keys *must* have dict-like values.
+    Common keys whose values are not both dicts are a conflict, resolved
+    according to `conflict`:
+        - RAISE: raise a ValueError, the default;
+        - LEFT_WINS: keep the value of dict1;
+        - RIGHT_WINS: keep the value of dict2;
+        - CONCAT: concatenate lists, raise a ValueError for other values;
+        - a function `f(key, value1, value2)` returning the value to keep.
+
+    Neither dict is modified, unless `inplace` is True in which case dict2 is
+    merged into dict1. Values are not copied: sub-dicts found in only one
+    of the dicts are shared with the result, only the sub-dicts being merged
+    are new. Do not modify the result's sub-dicts in place if the originals
+    must stay unchanged.
+
+    Merging is iterative, deeply nested dicts don't hit the recursion limit.
+    """
+    merged = dict1 if inplace else dict(dict1)
+    _merge_into(merged, dict2, conflict, inplace, set(), set())
+    return merged
+
+
+def merge_all(dicts, conflict=RAISE):
+    """Merge any number of dicts into a new one, in a single pass. Cf.
+    `merge` for the conflict policy.
     """
-    keys1, keys2 = dict1.viewkeys(), dict2.viewkeys()
-    intersection = keys1 & keys2
-    # if dict1 and dict2 have no commons keys, it's easy: just update
-    if not intersection:
-        merged = copy.deepcopy(dict1)
-        merged.update(dict2)
-        return merged
-    else:
-        # When common keys are present, call itself recursively with both
-        # values as the new dicts.
-        merged = {}
-        for key in intersection:
-            if (type(dict1[key]) is dict) and (type(dict2[key]) is dict):
-                merged[key] = merge(dict1[key], dict2[key])
+    merged = {}
+    created, shared = set(), set()
+    for d in dicts:
+        _merge_into(merged, d, conflict, False, created, shared)
+    return merged
+
+
+def _merge_into(merged, source, conflict, original, created, shared):
+    """Merge `source` into `merged`, which can be modified.
+
+    If `original` is True, the sub-dicts of `merged` can be modified too,
+    except for those in `shared`: values taken from a source. Otherwise, only
+    those in `created` can: copies made while merging. Other sub-dicts are
+    copied before being modified.
+    """
+    stack = [(merged, source, original)]
+    while stack:
+        target, source, original = stack.pop()
+        for key, value in source.iteritems():
+            current = target.get(key, _missing)
+            if current is _missing:
+                target[key] = value
+                if type(value) is dict:
+                    shared.add(id(value))
+            elif type(current) is dict and type(value) is dict:
+                if original and id(current) not in shared:
+                    stack.append((current, value, True))
+                else:
+                    if id(current) not in created:
+                        current = target[key] = dict(current)
+                        created.add(id(current))
+                    stack.append((current, value, False))
             else:
-                raise ValueError("Common keys must have dict-like values.")
-        # Then merge keys that are *not* common to both.
-        for key in keys1 - keys2:
-            merged[key] = dict1[key]
-        for key in keys2 - keys1:
-            merged[key] = dict2[key]
+                target[key] = _resolve(conflict, key, current, value)
+
 
-        return merged
+def _resolve(conflict, key, value1, value2):
+    if conflict == LEFT_WINS:
+        return value1
+    elif conflict == RIGHT_WINS:
+        return value2
+    elif conflict == CONCAT and type(value1) is list and \
+            type(value2) is list:
+        return value1 + value2
+    elif callable(conflict):
+        return conflict(key, value1, value2)
+    raise ValueError("Common keys must have dict-like values.")
 
 
 def find_item(keys, d, create=False):
@@ -57,11 +109,17 @@ def find_item(keys, d, create=False):
 
     """
     default = {} if create else None
-    value = d.get(keys[0], default)
-    if len(keys) > 1 and type(value) is dict:
-        return {keys[0]: find_item(keys[1:], value, create)}
-    else:
-        return {keys[0]: value}
+    item = parent = {}
+    last = len(keys) - 1
+    for index, key in enumerate(keys):
+        value = d.get(key, default)
+        if index < last and type(value) is dict:
+            parent[key] = parent = {}
+            d = value
+        else:
+            parent[key] = value
+            break
+    return item
 
 
 def find_value(keys, d, create=False):
@@ -75,8 +133,179 @@ def find_value(keys, d, create=False):
     returns: 1
     """
     default = {} if create else None
-    value = d.get(keys[0], default)
-    if len(keys) > 1 and type(value) is dict:
-        return find_value(keys[1:], value, create)
-    else:
+    last = len(keys) - 1
+    for index, key in enumerate(keys):
+        value = d.get(key, default)
+        if index < last and type(value) is dict:
+            d = value
+        else:
+            return value
+
+
+class Path(object):
+    """A compiled accessor to a possibly deeply buried value:
+
+        Path('user.screen_name')(tweet)
+
+    Path components are separated by dots. A component is:
+        - a dict key;
+        - an integer, indexing a list (or a dict key if the value is a dict),
+          negative indices count from the end: 'entities.hashtags.0.text';
+        - a wildcard, `*`, matching all items of a list or all values of a
+          dict: 'entities.hashtags.*.text'.
+
+    Without wildcard, the value is returned, or `default` if it can't be
+    found. With wildcards, the list of all values found is returned.
+    """
+    WILDCARD = '*'
+
+    def __init__(self, path):
+        self.path = path
+        self.steps = []
+        for key in path.split('.'):
+            try:
+                index = int(key)
+            except ValueError:
+                index = None
+            self.steps.append((key, index))
+        self.has_wildcard = any(key == self.WILDCARD
+                                for key, _ in self.steps)
+        self.keys = [key for key, _ in self.steps]
+        # Pick the fastest lookup for this path.
+        if self.has_wildcard:
+            self.get = self._get_all
+        elif all(index is None for _, index in self.steps):
+            self.get = self._get_keys
+        else:
+            self.get = self._get_steps
+
+    def __call__(self, d, default=None):
+        return self.get(d, default)
+
+    def _get_keys(self, d, default=None):
+        value = d
+        for key in self.keys:
+            if type(value) is not dict:
+                return default
+            value = value.get(key, _missing)
+            if value is _missing:
+                return default
+        return value
+
+    def _get_steps(self, d, default=None):
+        value = d
+        for key, index in self.steps:
+            value = _step(value, key, index)
+            if value is _missing:
+                return default
         return value
+
+    def _get_all(self, d, default=None):
+        values = [d]
+        for key, index in self.steps:
+            found = []
+            for value in values:
+                if key == self.WILDCARD:
+                    if type(value) is list:
+                        found.extend(value)
+                    elif type(value) is dict:
+                        found.extend(value.itervalues())
+                else:
+                    value = _step(value, key, index)
+                    if value is not _missing:
+                        found.append(value)
+            values = found
+        return values
+
+    def __repr__(self):
+        return "Path({!r})".format(self.path)
+
+
+def _step(value, key, index):
+    if type(value) is dict:
+        return value.get(key, _missing)
+    if index is not None and type(value) is list:
+        try:
+            return value[index]
+        except IndexError:
+            pass
+    return _missing
+
+
+def extract_many(paths, dicts, columnar=False, default=None):
+    """Extract the values of many paths, given as strings or `Path`, from
+    many dicts.
+
+    Return a generator of tuples, one per dict, of values in the order of
+    `paths`. If `columnar` is True, return instead a list of lists, one per
+    path, of values in the order of `dicts`:
+
+        ids, names = extract_many(['id_str', 'user.screen_name'], tweets,
+                                  columnar=True)
+    """
+    paths = [path if isinstance(path, Path) else Path(path)
+             for path in paths]
+    if columnar:
+        columns = [[] for _ in paths]
+        getters = [(path.get, column.append)
+                   for path, column in zip(paths, columns)]
+        for d in dicts:
+            for get, append in getters:
+                append(get(d, default))
+        return columns
+    getters = [path.get for path in paths]
+    return (tuple(get(d, default) for get in getters) for d in dicts)
+
+
+class Projector(object):
+    """Project dicts onto a subset of their, possibly deeply buried, keys.
+    Keys are given as a list of dotted paths:
+
+        project = Projector(['text', 'user.screen_name', 'user.name'])
+        project(tweet)
+        # {'text': ..., 'user': {'screen_name': ..., 'name': ...}}
+
+    The paths are compiled once into a trie, so that each dict is then
+    projected in a single pass, without any copy: the values returned are the
+    ones of the original dict.
+
+    As with `find_item`, a missing key, or a key whose value isn't a dict but
+    has sub-keys to look up, maps to its value or None:
+
+        Projector(['user.name'])({'user': None})  # {'user': None}
+
+    When both a key and one of its sub-keys are given, the whole value of the
+    key is kept.
+    """
+    def __init__(self, attrs):
+        self.trie = {}
+        for attr in attrs:
+            node = self.trie
+            keys = attr.split('.')
+            for key in keys[:-1]:
+                if key in node and node[key] is None:
+                    # The whole value is already kept.
+                    break
+                node = node.setdefault(key, {})
+            else:
+                node[keys[-1]] = None
+
+    def __call__(self, d):
+        return _project(self.trie, d)
+
+    def many(self, dicts):
+        """Project each dict of the given iterable. This is a generator."""
+        trie = self.trie
+        for d in dicts:
+            yield _project(trie, d)
+
+
+def _project(trie, d):
+    projected = {}
+    for key, subtrie in trie.iteritems():
+        value = d.get(key)
+        if subtrie is None or type(value) is not dict:
+            projected[key] = value
+        else:
+            projected[key] = _project(subtrie, value)
+    return projected
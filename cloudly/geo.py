@@ -0,0 +1,189 @@
+"""Client-side geographic filtering of tweets over many named regions.
+
+Twitter only filters on bounding boxes, and a stream connection is better
+shared by many consumers. A `GeoFilter` tags each tweet with the names of
+the regions, bounding boxes or polygons, it falls in:
+
+    regions = {
+        'montreal': [-73.98, 45.41, -73.47, 45.70],
+        'triangle': [(-75, 45), (-74, 46), (-73, 45)],
+    }
+    geo_filter = GeoFilter(regions)
+    for tweet in geo_filter.filter(tweets):
+        print tweet['regions']
+
+Points are tested a batch at a time, with NumPy: a grid index over the
+regions finds candidate regions for each point, bounding boxes are then
+tested exactly and polygons with a vectorized ray casting algorithm.
+
+NumPy is required.
+"""
+import math
+from collections import defaultdict
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from cloudly.tweetbatch import TweetBatch
+
+
+class Region(object):
+    """A named region: a bounding box `[lng1, lat1, lng2, lat2]`, a polygon
+    given as a list of `(lng, lat)` vertices, or a GeoJSON Polygon (its outer
+    ring only).
+    """
+    def __init__(self, name, shape):
+        self.name = name
+        if isinstance(shape, dict):
+            shape = shape['coordinates'][0]
+        if len(shape) == 4 and not hasattr(shape[0], '__len__'):
+            self.polygon = None
+            self.bbox = list(shape)
+        else:
+            self.polygon = np.array(shape, dtype='float64')
+            lngs, lats = self.polygon[:, 0], self.polygon[:, 1]
+            self.bbox = [lngs.min(), lats.min(), lngs.max(), lats.max()]
+
+    def contains(self, lng, lat):
+        """Return a boolean array, True for the points in this region."""
+        lng1, lat1, lng2, lat2 = self.bbox
+        inside = (lng >= lng1) & (lng <= lng2) & (lat >= lat1) & (lat <= lat2)
+        if self.polygon is None or not inside.any():
+            return inside
+        # Ray casting, only for the points inside the bounding box.
+        indices = np.nonzero(inside)[0]
+        x, y = lng[indices], lat[indices]
+        crossings = np.zeros(len(indices), dtype=bool)
+        vertices = self.polygon
+        for (xi, yi), (xj, yj) in zip(vertices, np.roll(vertices, 1, axis=0)):
+            if yi == yj:
+                continue
+            crosses = ((yi > y) != (yj > y)) & \
+                (x < (xj - xi) * (y - yi) / (yj - yi) + xi)
+            crossings ^= crosses
+        inside[indices] = crossings
+        return inside
+
+
+class GeoFilter(object):
+    """Match points against many named regions, cf. this module's doc.
+
+    `regions` is a dict of region name to shape, cf. `Region`. The grid index
+    has cells of `cell_size` degrees.
+    """
+    def __init__(self, regions, cell_size=1.0):
+        if np is None:
+            raise ImportError("GeoFilter requires numpy.")
+        self.regions = [Region(name, shape)
+                        for name, shape in sorted(regions.iteritems())]
+        self.names = [region.name for region in self.regions]
+        self.cell_size = float(cell_size)
+        self.columns = int(math.ceil(360 / self.cell_size)) + 1
+        self.grid = defaultdict(list)
+        for index, region in enumerate(self.regions):
+            for cell in self._cells(region.bbox):
+                self.grid[cell].append(index)
+
+    @property
+    def bounding_boxes(self):
+        """The bounding boxes of all regions, flattened, as expected by the
+        `coordinates` parameter of `Tweets.having`.
+        """
+        return [value for region in self.regions for value in region.bbox]
+
+    def match(self, lng, lat):
+        """Return a boolean matrix, one row per point and one column per
+        region (in the order of `names`), True where the point is in the
+        region. Missing coordinates are NaN.
+        """
+        lng = np.asarray(lng, dtype='float64')
+        lat = np.asarray(lat, dtype='float64')
+        matches = np.zeros((len(lng), len(self.regions)), dtype=bool)
+        located = np.nonzero(~(np.isnan(lng) | np.isnan(lat)))[0]
+        if not len(located):
+            return matches
+
+        cells = self._cell(lng[located], lat[located])
+        unique_cells, inverse = np.unique(cells, return_inverse=True)
+        # For each region, which of the cells seen hold candidate points.
+        candidate_cells = defaultdict(lambda: np.zeros(len(unique_cells),
+                                                       dtype=bool))
+        for position, cell in enumerate(unique_cells):
+            for index in self.grid.get(cell, ()):
+                candidate_cells[index][position] = True
+
+        for index, cells_mask in candidate_cells.iteritems():
+            candidates = located[cells_mask[inverse]]
+            inside = self.regions[index].contains(lng[candidates],
+                                                  lat[candidates])
+            matches[candidates[inside], index] = True
+        return matches
+
+    def tag(self, tweets, key='regions'):
+        """Set `tweet[key]` to the list of region names each tweet is in, for
+        a list of tweets or a `TweetBatch`. Return the boolean matrix of
+        `match`.
+        """
+        if isinstance(tweets, TweetBatch):
+            lng, lat = tweets.lng, tweets.lat
+        else:
+            lng, lat = _coordinates(tweets)
+        matches = self.match(lng, lat)
+        names = self.names
+        for tweet, row in zip(tweets, matches):
+            tweet[key] = [names[index] for index in np.nonzero(row)[0]]
+        return matches
+
+    def filter(self, tweets, batch_size=100, key='regions'):
+        """Yield the tweets found in at least one region, tagged as by
+        `tag`. Tweets are processed `batch_size` at a time. This is a
+        generator.
+        """
+        for batch in _bursts(tweets, batch_size):
+            matches = self.tag(batch, key)
+            for tweet, matched in zip(batch, matches.any(axis=1)):
+                if matched:
+                    yield tweet
+
+    def _cell(self, lng, lat):
+        """Return the grid cell numbers of the given points."""
+        return (np.floor((lat + 90) / self.cell_size).astype('int64') *
+                self.columns +
+                np.floor((lng + 180) / self.cell_size).astype('int64'))
+
+    def _cells(self, bbox):
+        """Return the grid cell numbers covering a bounding box."""
+        lng1, lat1, lng2, lat2 = bbox
+        column1 = int(math.floor((lng1 + 180) / self.cell_size))
+        column2 = int(math.floor((lng2 + 180) / self.cell_size))
+        row1 = int(math.floor((lat1 + 90) / self.cell_size))
+        row2 = int(math.floor((lat2 + 90) / self.cell_size))
+        return [row * self.columns + column
+                for row in xrange(row1, row2 + 1)
+                for column in xrange(column1, column2 + 1)]
+
+
+def _coordinates(tweets):
+    lng = np.full(len(tweets), np.nan)
+    lat = np.full(len(tweets), np.nan)
+    for index, tweet in enumerate(tweets):
+        coordinates = tweet.get('coordinates')
+        if coordinates:
+            lng[index], lat[index] = coordinates['coordinates']
+    return lng, lat
+
+
+def _bursts(tweets, length):
+    """Like `decorators.burst_generator`, also yielding the last, partial
+    burst.
+    """
+    burst = []
+    for tweet in tweets:
+        burst.append(tweet)
+        if len(burst) >= length:
+            yield burst
+            burst = []
+    if burst:
+        yield burst
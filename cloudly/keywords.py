@@ -0,0 +1,143 @@
+"""Match tweets against many track phrases, client-side.
+
+Twitter ORs the `wordlist` and `coordinates` of a filter, and a stream
+connection is better shared by many consumers, so tweets have to be matched
+again on our side. A `KeywordMatcher` is compiled once from the phrases of
+each subscriber, with Twitter's semantics: the terms of a phrase are ANDed,
+phrases are ORed, case is ignored.
+
+    matcher = KeywordMatcher({
+        'weather': ["snow storm", "flood"],
+        'traffic': ["traffic montreal", "#mtltraffic"],
+    })
+    matcher.route(tweet)  # e.g. set(['weather'])
+
+All terms are found in a single pass over the text, with an Aho-Corasick
+automaton, whatever the number of phrases. A term matches a whole word only:
+`storm` matches "Storm!" and "#storm" but not "storms".
+"""
+from collections import defaultdict, deque
+
+
+class KeywordMatcher(object):
+    """Route text or tweets to subscribers, cf. this module's doc.
+
+    `subscriptions` is a dict of subscriber to list of phrases, each phrase
+    being in the format of the `wordlist` of `Tweets.having`.
+    """
+    def __init__(self, subscriptions):
+        self.subscriptions = subscriptions
+        self.term_ids = {}
+        # term id -> indices of the phrases containing it
+        self.term_phrases = []
+        # phrase index -> (subscriber, number of distinct terms)
+        self.phrases = []
+        for subscriber, phrases in sorted(subscriptions.iteritems()):
+            for phrase in phrases:
+                terms = set(phrase.lower().split())
+                if not terms:
+                    raise ValueError(
+                        "Empty phrase for subscriber {}".format(subscriber))
+                index = len(self.phrases)
+                self.phrases.append((subscriber, len(terms)))
+                for term in terms:
+                    self.term_phrases[self._term_id(term)].append(index)
+        self._build()
+
+    @property
+    def wordlist(self):
+        """All phrases, as expected by `Tweets.having`."""
+        return sorted(set(
+            phrase for phrases in self.subscriptions.itervalues()
+            for phrase in phrases))
+
+    def terms(self, text):
+        """Return the set of ids of the terms found in `text`."""
+        text = text.lower()
+        goto, fail, output = self.goto, self.fail, self.output
+        length = len(text)
+        found = set()
+        state = 0
+        for end, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if not output[state]:
+                continue
+            after = end + 1
+            if after < length and _is_word(text[after]):
+                continue
+            for term, size in output[state]:
+                before = end - size
+                if before < 0 or not _is_word(text[before]):
+                    found.add(term)
+        return found
+
+    def match(self, text):
+        """Return the set of subscribers with a phrase matching `text`."""
+        subscribers = set()
+        counts = defaultdict(int)
+        phrases, term_phrases = self.phrases, self.term_phrases
+        for term in self.terms(text):
+            for index in term_phrases[term]:
+                counts[index] += 1
+                subscriber, size = phrases[index]
+                if counts[index] == size:
+                    subscribers.add(subscriber)
+        return subscribers
+
+    def route(self, tweet):
+        """Return the set of subscribers with a phrase matching the tweet."""
+        return self.match(_text(tweet))
+
+    def _term_id(self, term):
+        if term not in self.term_ids:
+            self.term_ids[term] = len(self.term_ids)
+            self.term_phrases.append([])
+        return self.term_ids[term]
+
+    def _build(self):
+        """Build the automaton: a trie of the terms (`goto`), its failure
+        links (`fail`) and the terms ending at each state (`output`), as
+        `(term id, term length)` pairs.
+        """
+        self.goto, self.fail, self.output = [{}], [0], [[]]
+        for term, term_id in self.term_ids.iteritems():
+            state = 0
+            for char in term:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.output[state].append((term_id, len(term)))
+
+        queue = deque(self.goto[0].itervalues())
+        while queue:
+            state = queue.popleft()
+            for char, child in self.goto[state].iteritems():
+                queue.append(child)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                fail = self.goto[fallback].get(char, 0)
+                self.fail[child] = fail if fail != child else 0
+                self.output[child] = (self.output[child] +
+                                      self.output[self.fail[child]])
+
+
+def _is_word(char):
+    return char.isalnum() or char == "_"
+
+
+def _text(tweet):
+    """Return the text a tweet is matched on: its full text and expanded
+    URLs.
+    """
+    extended = tweet.get('extended_tweet') or {}
+    texts = [extended.get('full_text') or tweet.get('text') or u""]
+    for url in (tweet.get('entities') or {}).get('urls') or []:
+        if url.get('expanded_url'):
+            texts.append(url['expanded_url'])
+    return u"\n".join(texts)
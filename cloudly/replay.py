@@ -0,0 +1,109 @@
+"""Replay recorded stream messages, to run a `StreamManager` offline:
+
+    source = Replay("/data/tweets", speed=10)
+    manager.run(source)
+
+Messages are read from gzipped or plain files of JSON documents, one per
+line, like the archives written by `tweets.persist_file`. Tweets and `limit`
+messages are replayed alike. `record` writes such a file from a live stream.
+
+Pacing follows the messages' timestamps (`timestamp_ms`, or the tweets'
+`created_at`):
+
+    - `speed=None`: as fast as possible;
+    - `speed=1`: real-time, as originally received;
+    - `speed=N`: N times faster than real-time.
+"""
+import os
+import gzip
+import json
+import time
+from datetime import datetime
+
+from cloudly import archive, logger
+from cloudly.tweetbatch import TWITTER_TIME_FORMAT
+from cloudly.utctime import utcdt2epoch
+
+log = logger.init(__name__)
+
+
+class Replay(object):
+    """An iterable of the messages found at `source`: a file, a directory of
+    archives (cf. `cloudly.archive.archives`) or a list of either.
+
+    Messages are paced at `speed` times real-time, cf. this module's doc. If
+    `loop` is True, messages are replayed over and over.
+    """
+    def __init__(self, source, speed=None, loop=False):
+        self.sources = source if isinstance(source, list) else [source]
+        self.speed = speed
+        self.loop = loop
+        self.count = 0
+
+    @property
+    def paths(self):
+        paths = []
+        for source in self.sources:
+            if os.path.isdir(source):
+                paths.extend(archive.archives(source))
+            else:
+                paths.append(source)
+        return paths
+
+    def __iter__(self):
+        while True:
+            start = first = None
+            for message in self.messages():
+                if self.speed:
+                    timestamp = _timestamp(message)
+                    if timestamp is not None:
+                        if first is None:
+                            start, first = time.time(), timestamp
+                        delay = (start + (timestamp - first) / self.speed -
+                                 time.time())
+                        if delay > 0:
+                            time.sleep(delay)
+                self.count += 1
+                yield message
+            if not self.loop:
+                return
+
+    def messages(self):
+        """Yield the messages of all files, without pacing."""
+        for path in self.paths:
+            log.debug("Replaying {}".format(path))
+            opener = gzip.open if path.endswith(".gz") else open
+            with opener(path, "rb") as f:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+
+
+def record(generator, path, limit=None):
+    """Write the messages of `generator`, e.g. `Tweets.having`, to `path`,
+    gzipped if it ends with .gz, until `limit` messages if given. Tweets and
+    `limit` messages are recorded.
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    count = 0
+    with opener(path, "wb") as f:
+        for message in generator:
+            f.write(json.dumps(dict(message)) + "\n")
+            count += 1
+            if limit and count >= limit:
+                break
+    return count
+
+
+def _timestamp(message):
+    """Return the time a message was sent, in seconds since the epoch, or
+    None if unknown.
+    """
+    if 'limit' in message:
+        message = message['limit']
+    if 'timestamp_ms' in message:
+        return int(message['timestamp_ms']) / 1000.
+    if 'created_at' in message:
+        return float(utcdt2epoch(datetime.strptime(message['created_at'],
+                                                   TWITTER_TIME_FORMAT)))
+    return None
@@ -0,0 +1,138 @@
+"""Serialize objects for storage in Redis or memcache.
+
+Several codecs are available, as well as compression above a size threshold:
+
+    data = dumps(tweets, codec="msgpack", compression="lz4")
+    tweets = loads(data)
+
+Codecs:
+    - `json`: the standard library json module;
+    - `fastjson`: ujson, or simplejson, whichever is installed;
+    - `msgpack`: requires the msgpack package;
+    - `pickle`: cPickle, using the highest protocol.
+
+Compression, applied only to payloads longer than `threshold` bytes:
+    - `zlib`;
+    - `lz4`: requires the lz4 package.
+
+Every payload starts with a 3-byte header naming its codec and compression, so
+`loads` reads any of them whatever the codec used to write it. The exception
+is uncompressed `json`, which is written without header so that it stays
+readable by anyone, and so that data written by older versions of this
+library is still read as JSON.
+"""
+import json
+import zlib
+import cPickle as pickle
+
+try:
+    import ujson as fastjson
+except ImportError:
+    try:
+        import simplejson as fastjson
+    except ImportError:
+        fastjson = json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+
+MAGIC = "\x00"
+DEFAULT_THRESHOLD = 1024
+
+
+def _msgpack_dumps(obj):
+    _require(msgpack, "msgpack")
+    return msgpack.packb(obj, use_bin_type=True)
+
+
+def _msgpack_loads(data):
+    _require(msgpack, "msgpack")
+    return msgpack.unpackb(data, raw=False)
+
+
+def _lz4_compress(data):
+    _require(lz4, "lz4")
+    return lz4.compress(data)
+
+
+def _lz4_decompress(data):
+    _require(lz4, "lz4")
+    return lz4.decompress(data)
+
+
+def _require(module, name):
+    if module is None:
+        raise ValueError("Install the {} package to use it.".format(name))
+
+
+# name: (header byte, serialize, deserialize)
+CODECS = {
+    'json': ("j", json.dumps, json.loads),
+    'fastjson': ("f", fastjson.dumps, fastjson.loads),
+    'msgpack': ("m", _msgpack_dumps, _msgpack_loads),
+    'pickle': ("p", lambda obj: pickle.dumps(obj, pickle.HIGHEST_PROTOCOL),
+               pickle.loads),
+}
+
+COMPRESSIONS = {
+    None: ("-", None, None),
+    'zlib': ("z", zlib.compress, zlib.decompress),
+    'lz4': ("4", _lz4_compress, _lz4_decompress),
+}
+
+_codecs_by_byte = {byte: loads for byte, _, loads in CODECS.itervalues()}
+_decompressions_by_byte = {byte: decompress for byte, _, decompress
+                           in COMPRESSIONS.itervalues()}
+
+
+def dumps(obj, codec="json", compression=None, threshold=DEFAULT_THRESHOLD,
+          header=False):
+    """Serialize `obj` with the given codec, compressing the result if it is
+    longer than `threshold` bytes. Uncompressed json gets a header only if
+    `header` is True.
+    """
+    try:
+        codec_byte, serialize, _ = CODECS[codec or "json"]
+        compression_byte, compress, _ = COMPRESSIONS[compression]
+    except KeyError, exception:
+        raise ValueError("Unknown codec or compression {}".format(exception))
+
+    data = serialize(obj)
+    if isinstance(data, unicode):
+        data = data.encode("utf-8")
+    if compress and len(data) > threshold:
+        data = compress(data)
+    else:
+        compression_byte = "-"
+
+    if codec_byte == "j" and compression_byte == "-" and not header:
+        return data
+    return MAGIC + codec_byte + compression_byte + data
+
+
+def loads(data):
+    """Deserialize data written by `dumps`, whatever its codec."""
+    if not is_serialized(data):
+        return json.loads(data)
+    codec_byte, compression_byte = data[1], data[2]
+    try:
+        deserialize = _codecs_by_byte[codec_byte]
+        decompress = _decompressions_by_byte[compression_byte]
+    except KeyError:
+        raise ValueError("Unknown header {!r}".format(data[:3]))
+    data = data[3:]
+    if decompress:
+        data = decompress(data)
+    return deserialize(data)
+
+
+def is_serialized(data):
+    """Return True if `data` starts with a header written by `dumps`."""
+    return isinstance(data, str) and data[:1] == MAGIC
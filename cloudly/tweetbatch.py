@@ -0,0 +1,162 @@
+"""A columnar representation of a batch of tweets, backed by NumPy arrays.
+
+Tweet processors can then compute on whole columns instead of walking each
+tweet dict:
+
+    batch = TweetBatch()
+    for tweet in tweets:
+        batch.append(tweet)
+
+    geolocated = batch.select(batch.has_coordinates)
+    in_canada = (batch.lng > -141) & (batch.lng < -52)
+    print batch.ids[in_canada]
+
+NumPy is required.
+"""
+from datetime import datetime
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from cloudly.utctime import utcdt2epoch
+
+TWITTER_TIME_FORMAT = "%a %b %d %H:%M:%S +0000 %Y"
+
+# Fixed-width columns: (name, dtype, missing value)
+COLUMNS = [
+    ('ids', 'int64', 0),
+    ('created_at', 'int64', 0),
+    ('lng', 'float64', float('nan')),
+    ('lat', 'float64', float('nan')),
+    ('user_ids', 'int64', 0),
+    ('retweet_counts', 'int32', 0),
+]
+
+
+def _column(name):
+    return property(lambda self: self.columns[name][:self.size],
+                    doc="The {} of the tweets, a NumPy array.".format(name))
+
+
+class TweetBatch(object):
+    """A batch of tweets, stored column-wise:
+
+        - `ids`, `created_at` (seconds since the epoch), `lng`, `lat` (NaN
+          when not geolocated), `user_ids` and `retweet_counts` are NumPy
+          arrays;
+        - texts are stored UTF-8 encoded, one after the other, in a single
+          buffer. Cf. `text`;
+        - the original tweet dicts are kept as is. They are returned when
+          indexing or iterating, so a batch can be used wherever a list of
+          tweets is expected.
+
+    Arrays grow as tweets are appended, starting at `capacity` rows.
+    """
+    ids = _column('ids')
+    created_at = _column('created_at')
+    lng = _column('lng')
+    lat = _column('lat')
+    user_ids = _column('user_ids')
+    retweet_counts = _column('retweet_counts')
+
+    def __init__(self, capacity=100):
+        if np is None:
+            raise ImportError("TweetBatch requires numpy.")
+        self.capacity = max(capacity, 1)
+        self.size = 0
+        self.columns = {name: np.full(self.capacity, missing, dtype=dtype)
+                        for name, dtype, missing in COLUMNS}
+        self.text_buffer = bytearray()
+        self.text_offsets = np.zeros(self.capacity + 1, dtype='int64')
+        self.tweets = []
+
+    def append(self, tweet):
+        if self.size == self.capacity:
+            self._grow()
+        index = self.size
+        columns = self.columns
+
+        columns['ids'][index] = tweet.get('id') or int(tweet.get('id_str', 0))
+        columns['created_at'][index] = _epoch(tweet)
+        coordinates = tweet.get('coordinates')
+        if coordinates:
+            # GeoJSON order: longitude, latitude.
+            lng, lat = coordinates['coordinates']
+            columns['lng'][index] = lng
+            columns['lat'][index] = lat
+        user = tweet.get('user') or {}
+        columns['user_ids'][index] = user.get('id') or 0
+        columns['retweet_counts'][index] = tweet.get('retweet_count') or 0
+
+        self.text_buffer.extend((tweet.get('text') or u"").encode("utf-8"))
+        self.text_offsets[index + 1] = len(self.text_buffer)
+
+        self.tweets.append(tweet)
+        self.size += 1
+
+    def extend(self, tweets):
+        for tweet in tweets:
+            self.append(tweet)
+
+    def text(self, index):
+        """Return the text of the tweet at `index`."""
+        if index < 0:
+            index += self.size
+        start, end = self.text_offsets[index], self.text_offsets[index + 1]
+        return self.text_buffer[start:end].decode("utf-8")
+
+    @property
+    def has_coordinates(self):
+        """A boolean array, True for geolocated tweets."""
+        return ~np.isnan(self.lng)
+
+    def select(self, selector):
+        """Return a new batch of the tweets selected by a boolean mask or an
+        array of indices.
+        """
+        indices = np.arange(self.size)[selector]
+        selected = TweetBatch(len(indices))
+        for name, _, _ in COLUMNS:
+            selected.columns[name][:len(indices)] = \
+                self.columns[name][indices]
+        for index in indices:
+            selected.text_buffer.extend(
+                self.text_buffer[self.text_offsets[index]:
+                                 self.text_offsets[index + 1]])
+            selected.text_offsets[len(selected.tweets) + 1] = \
+                len(selected.text_buffer)
+            selected.tweets.append(self.tweets[index])
+        selected.size = len(indices)
+        return selected
+
+    def _grow(self):
+        capacity = self.capacity * 2
+        for name, dtype, missing in COLUMNS:
+            column = np.full(capacity, missing, dtype=dtype)
+            column[:self.capacity] = self.columns[name]
+            self.columns[name] = column
+        offsets = np.zeros(capacity + 1, dtype='int64')
+        offsets[:self.capacity + 1] = self.text_offsets
+        self.text_offsets = offsets
+        self.capacity = capacity
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return iter(self.tweets)
+
+    def __getitem__(self, index):
+        return self.tweets[index]
+
+
+def _epoch(tweet):
+    """Return the creation time of a tweet in seconds since the epoch."""
+    if 'timestamp_ms' in tweet:
+        return int(tweet['timestamp_ms']) // 1000
+    created_at = tweet.get('created_at')
+    if not created_at:
+        return 0
+    return utcdt2epoch(datetime.strptime(created_at, TWITTER_TIME_FORMAT))
@@ -1,18 +1,24 @@
 import os
-from os.path import join
-from datetime import date, datetime
-import gzip
+from datetime import datetime
 import json
+import threading
 
 from twitter import TwitterStream, OAuth
-from cloudly import rqworker, logger, cache
+from cloudly import rqworker, logger, cache, archive, workpool, ccouchdb
+from cloudly.bloom import RotatingBloomFilter
 from cloudly.decorators import throttle
-from cloudly.dictutils import merge, find_item
+from cloudly.dictutils import Projector
+from cloudly.geo import GeoFilter
+from cloudly.keywords import KeywordMatcher
 from cloudly.timer import Timer
+from cloudly.tweetbatch import TweetBatch
 
 
 log = logger.init(__name__)
 
+# Maximum number of bounding boxes in the `locations` of a Twitter filter.
+MAX_LOCATIONS = 25
+
 
 class Tweets(object):
     """Encapsulate a TwitterStream.
@@ -71,6 +77,9 @@ class Tweets(object):
 
             [lng1, lat1, lng2, lat2]
 
+        Several bounding boxes, up to 25, can be given one after the other in
+        the same list.
+
         This is a generator function.
         """
         track = ",".join(wordlist) if wordlist else None
@@ -100,6 +109,32 @@ class Tweets(object):
         for tweet in self.having(coordinates=self.default_coordinates):
             yield tweet
 
+    def in_regions(self, regions, batch_size=100):
+        """Yield geolocated tweets falling in any of the given named regions,
+        bounding boxes or polygons, with the list of region names in
+        `tweet['regions']`:
+
+            regions = {
+                'montreal': [-73.98, 45.41, -73.47, 45.70],
+                'triangle': [(-75, 45), (-74, 46), (-73, 45)],
+            }
+
+        Twitter is asked for tweets in the regions' bounding boxes, then
+        tweets are matched against the regions `batch_size` at a time. Cf.
+        `cloudly.geo.GeoFilter`.
+
+        This is a generator function.
+        """
+        geo_filter = GeoFilter(regions)
+        boxes = geo_filter.bounding_boxes
+        if len(boxes) > 4 * MAX_LOCATIONS:
+            # Too many for Twitter, ask for the box containing them all.
+            boxes = [min(boxes[0::4]), min(boxes[1::4]),
+                     max(boxes[2::4]), max(boxes[3::4])]
+        tweets = self.having(coordinates=boxes)
+        for tweet in geo_filter.filter(tweets, batch_size):
+            yield tweet
+
 
 class StreamManager(object):
     """Manage a stream of Twitter messages by dividing the stream into two:
@@ -131,12 +166,81 @@ class StreamManager(object):
 
     Finally, you have to provide a name for the manager. It is used as a redis
     namespace key for counting and resuming between calls.
+
+    Messages usually come from `Tweets.having`. To run offline, e.g. to
+    measure throughput, replay recorded messages with `cloudly.replay.Replay`.
+
+    Counting normally costs a couple of Redis round-trips per message. Set
+    `batch_counts` to True to add up counts in-process instead and send them
+    to Redis in one pipeline at each batch boundary (every `cache_length`
+    tweets) and, if given, every `counts_interval` seconds. The `counts_<name>`
+    hash keeps the same meaning, it only lags by at most one batch.
+
+    If `columnar` is True, the tweet processor receives a
+    `cloudly.tweetbatch.TweetBatch` instead of a list: ids, timestamps,
+    coordinates, etc. are then available as NumPy arrays. It can still be
+    iterated and indexed like a list of tweets.
+
+    Tweets can also be routed to several tweet processors, each receiving
+    only the tweets matching its phrases. Give `keywords` as a dict of
+    subscriber name to list of phrases, and `tweet_processor` as a dict of
+    subscriber name to function:
+
+        manager = StreamManager(
+            "alerts",
+            {'weather': weather_processor, 'traffic': traffic_processor},
+            keywords={'weather': ["snow storm", "flood"],
+                      'traffic': ["traffic montreal"]})
+        manager.run(Tweets().having(manager.matcher.wordlist))
+
+    Each subscriber then has its own batch of `cache_length` tweets. Tweets
+    matching no phrase are counted in the stream but not processed. Cf.
+    `cloudly.keywords.KeywordMatcher` for the matching rules.
+
+    Without queuing, batches are processed inline, and a slow tweet processor
+    delays reading the stream, which Twitter answers by disconnecting. Set
+    `workers` to hand batches off to that many threads instead, or processes
+    if `worker_kind` is "process". At most `queue_size` batches wait in
+    memory. When the workers fall behind, `backpressure` decides: wait
+    ("block", the default), spill batches to `spill_directory` ("spill") or
+    drop the oldest batch ("drop_oldest"), losing its tweets, cf.
+    `cloudly.workpool.WorkPool`. The metadata counts then also hold the
+    number of batches `queued` and `dropped`. `run` returns once the queued
+    batches are processed, and can be called again, e.g. after a
+    disconnection. Call `close` to stop the workers.
+
+    Tweets can be delivered twice, typically after a reconnection. Set
+    `dedup_capacity` to skip tweets whose `id_str` was seen among about that
+    many recent ones, using a `cloudly.bloom.RotatingBloomFilter`. A tiny
+    fraction of new tweets, about 0.1%, are then mistaken for duplicates.
+    Skipped tweets are counted as `duplicate`.
+
+    If `checkpoint` is True, the manager also resumes where a previous run
+    of the same name left off: the id of the last tweet handed off for
+    processing, with no older tweet still waiting in a batch, is saved to
+    Redis under `checkpoint_<name>`, and older tweets are skipped as
+    duplicates. Tweet ids are assumed to grow with time, as Twitter's do.
+    With `workers`, batches count as handed off once processed without
+    error, and the backpressure policy must not drop any: "block" or
+    "spill". A batch failing to process holds the checkpoint back for the
+    rest of the run, so that its tweets are not skipped on restart. When
+    queuing, batches count as handed off once enqueued: failed jobs are left
+    to RQ's failed queue.
     """
     __attrs__ = ['tweet_processor_fct', 'metadata_processor_fct'
                  'name', 'metadata_cache_key', 'firehose_count_key']
 
     def __init__(self, name, tweet_processor, metadata_processor=None,
-                 is_queuing=False, cache_length=100):
+                 is_queuing=False, cache_length=100, batch_counts=False,
+                 counts_interval=None, columnar=False, keywords=None,
+                 workers=0, worker_kind="thread", queue_size=10,
+                 backpressure=workpool.BLOCK, spill_directory=None,
+                 dedup_capacity=None, checkpoint=False):
+
+        if checkpoint and workers and not is_queuing and \
+                backpressure == workpool.DROP_OLDEST:
+            raise ValueError("A checkpoint requires a backpressure policy "
+                             "dropping no batch.")
 
         self.name = name
         self.metadata_cache_key = "counts_{}".format(self.name)
@@ -149,9 +253,45 @@ class StreamManager(object):
         self.metadata_processor_fct = metadata_processor
         self.is_queuing = is_queuing
         self.previous_queue_time = None
+        self.workpool = None
+        if workers and not is_queuing:
+            function = self.tweet_processor
+            if worker_kind == "process":
+                function = _process_batch
+            self.workpool = workpool.WorkPool(
+                function, workers=workers, kind=worker_kind,
+                maxsize=queue_size, policy=backpressure,
+                spill_directory=spill_directory,
+                callback=self.batch_processed if checkpoint else None)
 
-        self.tweet_cache = []
         self.cache_length = cache_length
+        self.columnar = columnar
+        self.matcher = KeywordMatcher(keywords) if keywords else None
+        # Batches of tweets by subscriber, None when not routing.
+        subscribers = sorted(keywords) if keywords else [None]
+        self.tweet_caches = {subscriber: self.new_cache()
+                             for subscriber in subscribers}
+
+        self.seen = None
+        if dedup_capacity:
+            self.seen = RotatingBloomFilter(dedup_capacity)
+        self.checkpoint_key = None
+        # First tweet ids of the batches given to workers, with counts.
+        self.in_flight = {}
+        self.checkpoint_lock = threading.Lock()
+        self.resume_id = self.last_id = -1
+        if checkpoint:
+            self.checkpoint_key = "checkpoint_{}".format(self.name)
+            self.resume_id = int(self.redis.get(self.checkpoint_key) or -1)
+            self.last_id = self.resume_id
+
+        # The key firehose_count_key was just deleted, it's zero.
+        self.firehose_count = 0
+        self.counter = None
+        if batch_counts:
+            self.counter = cache.HashCounter(self.redis,
+                                             self.metadata_cache_key,
+                                             interval=counts_interval)
 
     def run(self, generator, stop_condition_fct=None):
         """Gather tweets and either enqueue them for processing later by a
@@ -162,7 +302,7 @@ class StreamManager(object):
         for data in generator:
             if stop_condition_fct and stop_condition_fct():
                 log.debug("Stopped.")
-                return
+                break
             # For some reason, sometime we can't jsonify TwitterResponseWrapper
             data = dict(data)
 
@@ -175,46 +315,149 @@ class StreamManager(object):
                     # add that to the firehose count. This allows us to keep a
                     # correct count in-between connections.
                     firehose_count = data['limit']['track']
-                    firehose_delta = firehose_count - int(
-                        (self.redis.getset(self.firehose_count_key,
-                                           firehose_count) or 0))
-
-                    self.redis.hincrby(self.metadata_cache_key, 'firehose',
-                                       firehose_delta)
+                    if self.counter:
+                        # We are the only writer of firehose_count_key, keep
+                        # its value locally rather than asking Redis.
+                        firehose_delta = firehose_count - self.firehose_count
+                        self.firehose_count = firehose_count
+                        self.counter.set(self.firehose_count_key,
+                                         firehose_count)
+                    else:
+                        firehose_delta = firehose_count - int(
+                            (self.redis.getset(self.firehose_count_key,
+                                               firehose_count) or 0))
+                    self.incr('firehose', firehose_delta)
+            elif self.is_duplicate(data):
+                self.incr('duplicate')
             else:
-                self.tweet_cache.append(data)
+                if self.matcher:
+                    for subscriber in self.matcher.route(data):
+                        self.cache_tweet(data, subscriber)
+                else:
+                    self.cache_tweet(data)
                 # Increment the total number of tweets in the stream.
-                self.redis.hincrby(self.metadata_cache_key, "stream", 1)
+                self.incr("stream")
                 # Increment the total number of tweets in the firehose.
                 # Remember, the firehose count provided by Twitter (track)
                 # is the number of undelivered tweets:
                 # Total = undelivered + delivered
-                self.redis.hincrby(self.metadata_cache_key, 'firehose', 1)
-
-                if len(self.tweet_cache) >= self.cache_length:
-                    if self.is_queuing:
-                        rqworker.enqueue(self.tweet_processor,
-                                         self.tweet_cache)
-                        now = datetime.now()
-                        if self.previous_queue_time:
-                            delta_time = now - self.previous_queue_time
-                            log.debug(
-                                "Queued {}. Elapsed {:2.2f} secs.".format(
-                                    len(self.tweet_cache),
-                                    delta_time.total_seconds()))
-                        self.previous_queue_time = now
-                    else:
-                        self.tweet_processor(self.tweet_cache)
-                    # Empty cache for next batch.
-                    self.tweet_cache = []
+                self.incr('firehose')
+
+            if self.counter:
+                self.counter.flush_if_due()
 
             # We might not receive limit message, be sure to call
             # metadata_processor. Don't have to worry calling it too often,
             # it's throttled.
             if self.metadata_processor_fct:
                 self.metadata_processor()
+        if self.workpool:
+            self.workpool.join()
+        if self.counter:
+            self.counter.flush()
         log.debug("Terminating.")
 
+    def close(self):
+        """Stop the workers once all queued batches are processed."""
+        if self.workpool:
+            self.workpool.close()
+
+    @property
+    def tweet_cache(self):
+        """The batch of tweets being gathered, when not routing."""
+        return self.tweet_caches.get(None)
+
+    def cache_tweet(self, tweet, subscriber=None):
+        """Add a tweet to the batch of the given subscriber, sending the
+        batch for processing once full.
+        """
+        tweet_cache = self.tweet_caches[subscriber]
+        tweet_cache.append(tweet)
+        if len(tweet_cache) < self.cache_length:
+            return
+
+        if self.is_queuing:
+            rqworker.enqueue(self.tweet_processor, tweet_cache, subscriber)
+            now = datetime.now()
+            if self.previous_queue_time:
+                delta_time = now - self.previous_queue_time
+                log.debug("Queued {}. Elapsed {:2.2f} secs.".format(
+                    len(tweet_cache), delta_time.total_seconds()))
+            self.previous_queue_time = now
+        elif self.workpool:
+            if self.checkpoint_key:
+                first_id = int(tweet_cache[0]['id_str'])
+                with self.checkpoint_lock:
+                    self.in_flight[first_id] = \
+                        self.in_flight.get(first_id, 0) + 1
+            if self.workpool.processes:
+                self.workpool.put(self, tweet_cache, subscriber)
+            else:
+                self.workpool.put(tweet_cache, subscriber)
+        else:
+            self.tweet_processor(tweet_cache, subscriber)
+        # Empty cache for next batch.
+        self.tweet_caches[subscriber] = self.new_cache()
+        if self.checkpoint_key:
+            self.save_checkpoint()
+        if self.counter:
+            self.counter.flush()
+
+    def is_duplicate(self, tweet):
+        """Return True if the tweet was seen already, cf. `dedup_capacity`
+        and `checkpoint`.
+        """
+        id_str = tweet.get('id_str')
+        if id_str is None:
+            return False
+        if self.checkpoint_key:
+            tweet_id = int(id_str)
+            if tweet_id <= self.resume_id:
+                return True
+            self.last_id = max(self.last_id, tweet_id)
+        return self.seen is not None and self.seen.add(id_str)
+
+    def save_checkpoint(self):
+        """Save the id of the last tweet such that it and all older ones
+        were handed off for processing.
+        """
+        with self.checkpoint_lock:
+            pending = [int(tweet_cache[0]['id_str'])
+                       for tweet_cache in self.tweet_caches.itervalues()
+                       if len(tweet_cache)]
+            pending.extend(self.in_flight)
+            checkpoint = min(pending) - 1 if pending else self.last_id
+            if self.counter:
+                self.counter.set(self.checkpoint_key, checkpoint)
+            else:
+                self.redis.set(self.checkpoint_key, checkpoint)
+
+    def batch_processed(self, *args):
+        """Called by the workers once a batch, given as to `WorkPool.put`, is
+        processed: move the checkpoint past it.
+        """
+        first_id = int(args[-2][0]['id_str'])
+        with self.checkpoint_lock:
+            self.in_flight[first_id] -= 1
+            if not self.in_flight[first_id]:
+                del self.in_flight[first_id]
+        self.save_checkpoint()
+
+    def new_cache(self):
+        """Return an empty batch of tweets."""
+        if self.columnar:
+            return TweetBatch(self.cache_length)
+        return []
+
+    def incr(self, field, amount=1):
+        """Increment the given count, either right away in Redis or in the
+        counter buffer if counts are batched.
+        """
+        if self.counter:
+            self.counter.incr(field, amount)
+        else:
+            self.redis.hincrby(self.metadata_cache_key, field, amount)
+
     def __getstate__(self):
         return {attr: getattr(self, attr, None) for attr in self.__attrs__}
 
@@ -223,17 +466,22 @@ class StreamManager(object):
             setattr(self, attr, value)
 
         self.redis = cache.get_redis_connection()
-
-    def tweet_processor(self, tweets):
-        """Process tweets by calling the user provided function. Note that the
-        function must return the number of positive detections, or else you
-        won't have a count of detections.
+        # Counts are batched by the manager only, not by workers.
+        self.counter = None
+
+    def tweet_processor(self, tweets, subscriber=None):
+        """Process tweets by calling the user provided function, the one of
+        the given subscriber when routing. Note that the function must return
+        the number of positive detections, or else you won't have a count of
+        detections.
         """
+        function = self.tweet_processor_fct
+        if subscriber is not None:
+            function = function[subscriber]
         with Timer() as timer:
-            detection_count = self.tweet_processor_fct(tweets) or 0
+            detection_count = function(tweets) or 0
             # Increment the total number of detections.
-            self.redis.hincrby(self.metadata_cache_key, 'detection',
-                               detection_count)
+            self.incr('detection', detection_count)
 
         log.debug("Processed {} tweets in {:2.3f} secs.".format(
             len(tweets), timer.interval))
@@ -245,10 +493,17 @@ class StreamManager(object):
         makes sure we don't queue too often by waiting for the given amount of
         time between successive calls.
         """
+        if self.counter:
+            self.counter.flush()
         counts = {key: int(value) for key, value in
                   self.redis.hgetall(self.metadata_cache_key).iteritems()}
 
-        counts['cached'] = len(self.tweet_cache)
+        counts['cached'] = sum(len(tweet_cache) for tweet_cache
+                               in self.tweet_caches.itervalues())
+        if self.workpool:
+            stats = self.workpool.stats()
+            counts['queued'] = stats['depth']
+            counts['dropped'] = stats['dropped']
 
         metadata = {'counts': counts}
         log.debug(metadata)
@@ -259,29 +514,72 @@ class StreamManager(object):
             self.metadata_processor_fct(metadata)
 
 
-def persist_db(database, tweets):
-    """Write to a CouchDB database the given list of tweets."""
+def _process_batch(manager, tweets, subscriber):
+    """Process a batch in a worker process, cf. `StreamManager`."""
+    manager.tweet_processor(tweets, subscriber)
+
+
+def persist_db(database, tweets, **kwargs):
+    """Write to a CouchDB database the given list of tweets, with their
+    `id_str` as `_id`. Tweets are left untouched.
+
+    Writes go through the `cloudly.ccouchdb.BulkWriter` of the database,
+    created with the given options on first call. Return its counts of
+    tweets written, existing, skipped and failed.
+    """
     log.debug("{} tweets to db".format(len(tweets)))
 
-    for tweet in tweets:
-        tweet['_id'] = tweet['id_str']
-    database.update(tweets)
+    docs = [dict(tweet, _id=tweet['id_str']) for tweet in tweets]
+    return ccouchdb.get_bulk_writer(database, **kwargs).write(docs)
+
 
+def persist_file(tweets, directory, close=True, **kwargs):
+    """Persist given tweets to a gzipped file of the day in `directory`, cf.
+    `cloudly.archive.ArchiveWriter`, created with the given options on first
+    call.
 
-def persist_file(tweets, directory):
-    """Persist given tweets to a gzipped file."""
+    The file is closed after each call, without fsync, unless `close` is
+    False: it is then kept open, and closed at exit, which saves reopening
+    it and starting a new gzip member for each batch. Processes exiting
+    without running exit handlers, like the work horses forked by RQ for
+    each job, must not do so. Kept open, the file is this process's own: its
+    name ends with the pid.
+    """
     log.debug("{} tweets to gzipped file".format(len(tweets)))
 
-    filename = join(directory, "{}.gz".format(date.today()))
-    with gzip.open(filename, "a+") as f:
-        write(tweets, f)
+    if not close:
+        kwargs.setdefault('suffix', "-{}".format(os.getpid()))
+    writer = archive.get_writer(directory, **kwargs)
+    writer.write(tweets)
+    if close:
+        writer.close(fsync=False)
+
+
+def read_archives(directory, attrs=None, predicate=None, contains=None,
+                  batch_size=1000, processes=None):
+    """Yield batches of the tweets persisted by `persist_file` in
+    `directory`, in order. Tweets are decoded, filtered and stripped in
+    parallel, cf. `cloudly.archive.read`:
+
+        def is_geolocated(tweet):
+            return bool(tweet.get('coordinates'))
+
+        for batch in read_archives("/data/tweets", ['id_str', 'text'],
+                                   predicate=is_geolocated,
+                                   contains=['"coordinates": {']):
+            process(batch)
+
+    This is a generator function.
+    """
+    return archive.read(directory, attrs, predicate, contains, batch_size,
+                        processes)
 
 
 def write(tweets, f=None):
     """Write to the console or to the given file descriptor."""
-    jsoned = [json.dumps(tweet) + '\n' for tweet in tweets]
     if f:
-        f.writelines(jsoned)
+        for tweet in tweets:
+            f.write(json.dumps(tweet) + '\n')
     else:
         print "\n-------------\n".join([tweet['text'] for tweet in tweets])
 
@@ -301,11 +599,8 @@ def keep(attrs, tweets):
                 'name': "john_doe"
             }
         }
+
+    Tweets can be a list or a generator, a list is returned. Cf.
+    `dictutils.Projector` to strip tweets lazily.
     """
-    new_tweets = []
-    for tweet in tweets:
-        stripped = {}
-        for attr in attrs:
-            stripped = merge(stripped, find_item(attr.split('.'), tweet))
-        new_tweets.append(stripped)
-    return new_tweets
+    return list(Projector(attrs).many(tweets))
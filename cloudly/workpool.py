@@ -0,0 +1,198 @@
+"""Hand work off to a pool of workers through a bounded in-process queue, so
+that the producer, e.g. a stream reader, does not wait on processing:
+
+    pool = WorkPool(process_tweets, workers=4, maxsize=10, policy=SPILL,
+                    spill_directory="/var/spool/tweets")
+    for batch in batches:
+        pool.put(batch)
+    pool.close()
+
+`policy` says what `put` does when the queue is full:
+
+    - `BLOCK`: wait for room. The producer is slowed down to the pace of
+      the workers;
+    - `DROP_OLDEST`: drop the oldest item of the queue, counted in
+      `dropped` and logged as a warning. Data is lost;
+    - `SPILL`: pickle the item to a file of `spill_directory`. Spilled items
+      are processed, in order, once the queue is drained.
+
+Workers are threads, calling the function in-process, or, with
+`kind="process"`, threads dispatching each call to a pool of as many
+processes. The function and its arguments must then be picklable. Threads
+are greenlets when gevent monkey-patches the standard library.
+"""
+import os
+import threading
+import multiprocessing
+import cPickle as pickle
+from collections import deque
+from os.path import join
+
+from cloudly import logger
+
+log = logger.init(__name__)
+
+BLOCK = "block"
+DROP_OLDEST = "drop_oldest"
+SPILL = "spill"
+POLICIES = [BLOCK, DROP_OLDEST, SPILL]
+KINDS = ["thread", "process"]
+
+
+class WorkPool(object):
+    """Call `function` on the items given to `put`, by `workers` workers.
+    Cf. this module's doc.
+
+    `put(*args)` queues a call `function(*args)`. At most `maxsize` calls
+    are queued in memory. If given, `callback(*args)` is then called by the
+    worker thread, in-process, once the call returned without error.
+    """
+    def __init__(self, function, workers=4, kind="thread", maxsize=10,
+                 policy=BLOCK, spill_directory=None, callback=None):
+        if policy not in POLICIES:
+            raise ValueError("Unknown policy {}".format(policy))
+        if kind not in KINDS:
+            raise ValueError("Unknown kind of worker {}".format(kind))
+        if policy == SPILL and not spill_directory:
+            raise ValueError("The spill policy requires a spill_directory.")
+
+        self.function = function
+        self.callback = callback
+        self.maxsize = maxsize
+        self.policy = policy
+        self.spill_directory = spill_directory
+        self.queue = deque()
+        self.spilled = deque()  # Paths of spilled items, oldest first.
+        self.condition = threading.Condition()
+        self.closed = False
+        self.busy = 0
+        self.processed = self.failed = self.dropped = 0
+        self.spill_count = self.peak_depth = 0
+
+        self.processes = None
+        if kind == "process":
+            self.processes = multiprocessing.Pool(workers)
+        self.threads = []
+        for _ in xrange(workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    @property
+    def depth(self):
+        """The number of items waiting, in memory or spilled."""
+        return len(self.queue) + len(self.spilled)
+
+    def stats(self):
+        """Return a dict of queue depth and counts of items."""
+        with self.condition:
+            return {
+                'depth': self.depth,
+                'peak_depth': self.peak_depth,
+                'spilled': len(self.spilled),
+                'busy': self.busy,
+                'processed': self.processed,
+                'failed': self.failed,
+                'dropped': self.dropped,
+            }
+
+    def put(self, *args):
+        """Queue a call `function(*args)`, applying the backpressure policy
+        if the queue is full.
+        """
+        with self.condition:
+            if self.closed:
+                raise ValueError("Pool closed.")
+            if self.policy == BLOCK:
+                while len(self.queue) >= self.maxsize:
+                    self.condition.wait()
+            elif self.policy == DROP_OLDEST:
+                if len(self.queue) >= self.maxsize:
+                    self.queue.popleft()
+                    self.dropped += 1
+                    log.warning("Queue full, dropped the oldest item, {} "
+                                "so far.".format(self.dropped))
+            elif self.spilled or len(self.queue) >= self.maxsize:
+                # Spill after any item already spilled, to keep the order.
+                self._spill(args)
+                args = None
+            if args is not None:
+                self.queue.append(args)
+            self.peak_depth = max(self.peak_depth, self.depth)
+            self.condition.notify_all()
+
+    def join(self):
+        """Wait for all queued items to be processed."""
+        with self.condition:
+            while self.depth or self.busy:
+                self.condition.wait()
+
+    def close(self, wait=True):
+        """Stop the workers, after processing all queued items if `wait` is
+        True. Spilled items are otherwise left on disk.
+        """
+        if wait:
+            self.join()
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        if self.processes:
+            self.processes.close()
+            self.processes.join()
+
+    def _work(self):
+        while True:
+            args = self._take()
+            if args is None:
+                return
+            try:
+                if self.processes:
+                    self.processes.apply(self.function, args)
+                else:
+                    self.function(*args)
+                outcome = 'processed'
+            except Exception:
+                log.exception("Could not process {}".format(self.function))
+                outcome = 'failed'
+            if self.callback and outcome == 'processed':
+                try:
+                    self.callback(*args)
+                except Exception:
+                    log.exception("Callback {} failed".format(self.callback))
+            with self.condition:
+                setattr(self, outcome, getattr(self, outcome) + 1)
+                self.busy -= 1
+                self.condition.notify_all()
+
+    def _take(self):
+        """Return the next item to process, None if closing."""
+        with self.condition:
+            while not self.depth:
+                if self.closed:
+                    return None
+                self.condition.wait()
+            if self.queue:
+                args = self.queue.popleft()
+            else:
+                args = self._unspill()
+            self.busy += 1
+            self.condition.notify_all()
+            return args
+
+    def _spill(self, args):
+        path = join(self.spill_directory,
+                    "{}-{:012d}.pickle".format(os.getpid(), self.spill_count))
+        self.spill_count += 1
+        with open(path, "wb") as f:
+            pickle.dump(args, f, pickle.HIGHEST_PROTOCOL)
+        self.spilled.append(path)
+
+    def _unspill(self):
+        path = self.spilled.popleft()
+        with open(path, "rb") as f:
+            args = pickle.load(f)
+        os.remove(path)
+        return args
@@ -0,0 +1,84 @@
+"""Benchmarks, run as modules, e.g.:
+
+    python -m tests.benchmarks.keep
+"""
+import random
+from datetime import datetime, timedelta
+
+WORDS = ("the quick brown fox jumps over lazy dog storm flood fire traffic "
+         "montreal ottawa rain snow power outage alert news breaking").split()
+
+
+def make_tweet(n, start=datetime(2013, 6, 1), geo_ratio=0.3):
+    """Return a tweet, as delivered by the streaming API, with most of the
+    fields and nesting of the real thing.
+    """
+    rnd = random.Random(n)
+    created_at = start + timedelta(seconds=n / 10.)
+    user_id = rnd.randint(1, 10 ** 6)
+    coordinates = None
+    if rnd.random() < geo_ratio:
+        coordinates = {'type': "Point",
+                       'coordinates': [rnd.uniform(-180, 180),
+                                       rnd.uniform(-90, 90)]}
+    text = " ".join(rnd.choice(WORDS) for _ in xrange(rnd.randint(5, 20)))
+    return {
+        'created_at': created_at.strftime("%a %b %d %H:%M:%S +0000 %Y"),
+        'id': 340000000000000000 + n,
+        'id_str': str(340000000000000000 + n),
+        'text': text,
+        'source': "<a href=\"http://twitter.com\">Twitter for iPhone</a>",
+        'truncated': False,
+        'in_reply_to_status_id': None,
+        'in_reply_to_status_id_str': None,
+        'in_reply_to_user_id': None,
+        'in_reply_to_user_id_str': None,
+        'in_reply_to_screen_name': None,
+        'user': {
+            'id': user_id,
+            'id_str': str(user_id),
+            'name': "User {}".format(user_id),
+            'screen_name': "user_{}".format(user_id),
+            'location': "Montreal",
+            'url': None,
+            'description': text,
+            'protected': False,
+            'followers_count': rnd.randint(0, 5000),
+            'friends_count': rnd.randint(0, 5000),
+            'listed_count': 0,
+            'created_at': "Mon Jan 10 12:00:00 +0000 2011",
+            'favourites_count': 12,
+            'utc_offset': -14400,
+            'time_zone': "Eastern Time (US & Canada)",
+            'geo_enabled': True,
+            'verified': False,
+            'statuses_count': rnd.randint(0, 50000),
+            'lang': "en",
+            'profile_background_color': "C0DEED",
+            'profile_image_url': "http://a0.twimg.com/profile_images/1.png",
+            'default_profile': True,
+            'following': None,
+            'follow_request_sent': None,
+            'notifications': None,
+        },
+        'geo': None,
+        'coordinates': coordinates,
+        'place': None,
+        'contributors': None,
+        'retweet_count': rnd.randint(0, 100),
+        'favorite_count': 0,
+        'entities': {
+            'hashtags': [{'text': rnd.choice(WORDS), 'indices': [0, 5]}],
+            'symbols': [],
+            'urls': [],
+            'user_mentions': [],
+        },
+        'favorited': False,
+        'retweeted': False,
+        'filter_level': "medium",
+        'lang': "en",
+    }
+
+
+def make_tweets(count, **kwargs):
+    return [make_tweet(n, **kwargs) for n in xrange(count)]
@@ -0,0 +1,60 @@
+"""Benchmark reading tweet archives back, line by line with gzip.open and
+with archive.read, in parallel.
+
+    python -m tests.benchmarks.archive --tweets 100000 --processes 4
+"""
+import os
+import gzip
+import json
+import shutil
+import argparse
+import tempfile
+
+from mock import patch
+
+from cloudly import archive
+from cloudly.archive import ArchiveWriter
+from cloudly.timer import Timer
+from tests.benchmarks import make_tweets
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tweets", type=int, default=100000)
+    parser.add_argument("--days", type=int, default=4)
+    parser.add_argument("--processes", type=int, default=None)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        batch = make_tweets(args.tweets)
+        writer = ArchiveWriter(directory)
+        per_hour = max(len(batch) / (args.days * 24), 1)
+        with patch.object(archive.time, 'time') as now:
+            for hour, n in enumerate(xrange(0, len(batch), per_hour)):
+                now.return_value = 1370088000 + hour * 3600
+                writer.write(batch[n:n + per_hour])
+            writer.close()
+
+        with Timer() as timer:
+            count = 0
+            for path in archive.archives(directory):
+                with gzip.open(path) as f:
+                    tweets = [json.loads(line) for line in f]
+                    count += len(tweets)
+        print "{:<12} {:>10.0f} tweets/sec".format(
+            "gzip.open", count / timer.interval)
+
+        with Timer() as timer:
+            count = sum(len(tweets) for tweets in archive.read(
+                directory, processes=args.processes))
+        print "{:<12} {:>10.0f} tweets/sec ({} processes)".format(
+            "read", count / timer.interval,
+            args.processes or os.sysconf("SC_NPROCESSORS_ONLN"))
+        assert count == len(batch)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
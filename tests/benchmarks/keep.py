@@ -0,0 +1,41 @@
+"""Benchmark tweets.keep, which uses a compiled dictutils.Projector, against
+the original merge-per-attribute implementation.
+
+    python -m tests.benchmarks.keep --tweets 20000
+"""
+import argparse
+
+from cloudly import tweets
+from cloudly.timer import Timer
+from tests.benchmarks import make_tweets
+from tests.unittests.cloudly.test_dictutils import merge_keep
+
+ATTRS = ['id_str', 'text', 'created_at', 'lang', 'retweet_count',
+         'coordinates.coordinates', 'place',
+         'entities.hashtags', 'entities.urls', 'user.id_str', 'user.name',
+         'user.screen_name', 'user.location', 'user.lang', 'user.time_zone',
+         'user.followers_count', 'user.friends_count', 'user.statuses_count',
+         'user.created_at']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tweets", type=int, default=20000)
+    args = parser.parse_args()
+
+    batch = make_tweets(args.tweets)
+    with Timer() as timer:
+        original = [merge_keep(ATTRS, tweet) for tweet in batch]
+    print "{:<12} {:>10.0f} tweets/sec".format(
+        "merge", len(batch) / timer.interval)
+
+    with Timer() as timer:
+        projected = tweets.keep(ATTRS, batch)
+    print "{:<12} {:>10.0f} tweets/sec".format(
+        "projector", len(batch) / timer.interval)
+
+    assert projected == original
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""Benchmark keywords.KeywordMatcher against checking each phrase in turn.
+
+    python -m tests.benchmarks.keywords --phrases 2000 --tweets 5000
+"""
+import argparse
+import random
+
+from cloudly.keywords import KeywordMatcher
+from cloudly.timer import Timer
+from tests.benchmarks import make_tweets, WORDS
+from tests.unittests.cloudly.test_keywords import naive_match
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--phrases", type=int, default=2000)
+    parser.add_argument("--subscribers", type=int, default=50)
+    parser.add_argument("--tweets", type=int, default=5000)
+    args = parser.parse_args()
+
+    rnd = random.Random(0)
+    vocabulary = WORDS + ["word{}".format(n) for n in xrange(args.phrases)]
+    subscriptions = {}
+    for n in xrange(args.phrases):
+        phrase = " ".join(rnd.sample(vocabulary, rnd.randint(1, 3)))
+        subscriptions.setdefault(n % args.subscribers, []).append(phrase)
+    batch = make_tweets(args.tweets)
+
+    with Timer() as timer:
+        expected = [naive_match(subscriptions, tweet['text'])
+                    for tweet in batch]
+    print "{:<12} {:>10.0f} tweets/sec".format(
+        "per phrase", len(batch) / timer.interval)
+
+    with Timer() as timer:
+        matcher = KeywordMatcher(subscriptions)
+    print "{:<12} {:>10.3f} secs".format("compile", timer.interval)
+
+    with Timer() as timer:
+        routed = [matcher.route(tweet) for tweet in batch]
+    print "{:<12} {:>10.0f} tweets/sec".format(
+        "automaton", len(batch) / timer.interval)
+
+    assert routed == expected
+
+
+if __name__ == '__main__':
+    main()
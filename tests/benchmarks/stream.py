@@ -0,0 +1,129 @@
+"""Benchmark StreamManager.run end to end, offline: recorded tweets and limit
+messages are replayed through a manager with processors taking
+`--processing` milliseconds per batch, and an in-process Redis stand-in
+simulating a round-trip of `--latency` milliseconds.
+
+    python -m tests.benchmarks.stream --tweets 20000 --latency 0.2
+    python -m tests.benchmarks.stream --source /data/tweets --speed 10
+
+Reports, for a few manager configurations, tweets/sec, batch latency (from
+the first tweet of a batch read from the source to the batch processed) and
+Redis commands and round-trips per tweet.
+"""
+import os
+import time
+import shutil
+import argparse
+import tempfile
+
+from mock import patch
+
+from cloudly import tweets
+from cloudly.replay import Replay, record
+from cloudly.timer import Timer
+from tests.benchmarks import make_tweet
+from tests.fakes import FakeRedis
+
+CONFIGURATIONS = [
+    ("per message", {}),
+    ("batched", {'batch_counts': True}),
+    ("columnar", {'batch_counts': True, 'columnar': True}),
+    ("4 workers", {'batch_counts': True, 'workers': 4,
+                   'backpressure': "block"}),
+]
+ROW = ("{:<12} {rate:>12.0f} {p50:>9.1f}/{p99:<8.1f} {commands:>14.3f} "
+       "{round_trips:>14.3f}")
+
+
+def make_messages(count, limit_every=100):
+    """Yield tweets, with a limit message every `limit_every` tweets."""
+    track = 0
+    for n in xrange(count):
+        tweet = make_tweet(n)
+        yield tweet
+        if n % limit_every == 0:
+            track += limit_every / 2
+            yield {'limit': {'track': track}}
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, len(values) * percent / 100)]
+
+
+def bench(source, speed, latency, cache_length, processing, **options):
+    redis = FakeRedis(latency=latency / 1000.)
+    arrivals = {}
+    latencies = []
+
+    def timed(messages):
+        for message in messages:
+            if 'id_str' in message:
+                arrivals[message['id_str']] = time.time()
+            yield message
+
+    def processor(batch):
+        if processing:
+            time.sleep(processing / 1000.)
+        latencies.append(time.time() - arrivals.pop(batch[0]['id_str']))
+        return 0
+
+    with patch.object(tweets.cache, 'get_redis_connection',
+                      return_value=redis):
+        manager = tweets.StreamManager("bench", processor,
+                                       metadata_processor=lambda meta: None,
+                                       cache_length=cache_length, **options)
+        replay = Replay(source, speed=speed)
+        redis.commands = redis.round_trips = 0
+        with Timer() as timer:
+            manager.run(timed(replay))
+    ntweets = int(redis.hgetall("counts_bench").get('stream', 0))
+    return {
+        'rate': ntweets / timer.interval,
+        'p50': percentile(latencies, 50) * 1000,
+        'p99': percentile(latencies, 99) * 1000,
+        'commands': float(redis.commands) / ntweets,
+        'round_trips': float(redis.round_trips) / ntweets,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--source",
+                        help="File or directory of recorded messages. "
+                        "Generated if not given.")
+    parser.add_argument("--tweets", type=int, default=20000)
+    parser.add_argument("--speed", type=float, default=None,
+                        help="Times real-time, as fast as possible if not "
+                        "given.")
+    parser.add_argument("--latency", type=float, default=0.2,
+                        help="Simulated round-trip in milliseconds.")
+    parser.add_argument("--cache-length", type=int, default=100)
+    parser.add_argument("--processing", type=float, default=0,
+                        help="Time to process a batch, in milliseconds.")
+    args = parser.parse_args()
+
+    directory = None
+    source = args.source
+    if not source:
+        directory = tempfile.mkdtemp()
+        source = os.path.join(directory, "messages.gz")
+        record(make_messages(args.tweets), source)
+
+    try:
+        print "{:<12} {:>12} {:>18} {:>14} {:>14}".format(
+            "", "tweets/sec", "batch p50/p99 ms", "commands/tw",
+            "round-trips/tw")
+        for label, options in CONFIGURATIONS:
+            result = bench(source, args.speed, args.latency,
+                           args.cache_length, args.processing, **options)
+            print ROW.format(label, **result)
+    finally:
+        if directory:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""Benchmark the Redis counting of StreamManager.run, with and without
+batched counts, against an in-process Redis stand-in simulating a network
+round-trip of `--latency` milliseconds.
+
+    python -m tests.benchmarks.stream_counts --tweets 20000 --latency 0.2
+"""
+import argparse
+
+from mock import patch
+
+from cloudly import tweets
+from cloudly.timer import Timer
+from tests.fakes import FakeRedis
+from tests.unittests.cloudly.test_tweets import make_stream
+
+
+def bench(ntweets, latency, cache_length, **kwargs):
+    redis = FakeRedis(latency=latency / 1000.)
+    with patch.object(tweets.cache, 'get_redis_connection',
+                      return_value=redis):
+        manager = tweets.StreamManager("bench", lambda batch: 0,
+                                       metadata_processor=lambda meta: None,
+                                       cache_length=cache_length, **kwargs)
+        with Timer() as timer:
+            manager.run(make_stream(ntweets))
+    return ntweets / timer.interval, redis.round_trips
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tweets", type=int, default=20000)
+    parser.add_argument("--latency", type=float, default=0.2,
+                        help="Simulated round-trip in milliseconds.")
+    parser.add_argument("--cache-length", type=int, default=100)
+    args = parser.parse_args()
+
+    for label, options in [("per message", {}),
+                           ("batched", {'batch_counts': True})]:
+        rate, round_trips = bench(args.tweets, args.latency,
+                                  args.cache_length, **options)
+        print "{:<12} {:>10.0f} tweets/sec {:>8} round-trips".format(
+            label, rate, round_trips)
+
+
+if __name__ == '__main__':
+    main()
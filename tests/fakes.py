@@ -0,0 +1,351 @@
+"""In-process stand-ins for the servers cloudly talks to.
+
+`FakeRedis` implements the subset of the redis-py client used by cloudly. Each
+command (or pipeline execution) counts as one round-trip and optionally sleeps
+for `latency` seconds, to mimic a network hop. Servers sharing the same `data`
+dict see the same keys, like clients of a single server would.
+
+`FakeMemcache` has the interface of `cloudly.cache.MemProxy`, and of the
+python-memcached client it wraps.
+
+`FakeCouchDatabase` answers the CouchDB requests of cloudly.ccouchdb at the
+level of couchdb-python's `Resource`, from a dict of documents.
+"""
+import json
+import time
+import uuid
+import socket
+import threading
+import Queue
+
+import couchdb
+from boto.regioninfo import RegionInfo
+
+from cloudly import cache
+
+
+class FakeRedis(object):
+    def __init__(self, latency=0, data=None, channels=None):
+        self.latency = latency
+        self.data = data if data is not None else {}
+        self.channels = channels if channels is not None else {}
+        self.round_trips = 0
+        self.commands = 0
+
+    def clone(self):
+        """Return a new client connected to the same server."""
+        return FakeRedis(self.latency, self.data, self.channels)
+
+    def _hop(self):
+        self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _call(self, _command, *args, **kwargs):
+        self._hop()
+        return self._apply(_command, *args, **kwargs)
+
+    def _apply(self, _command, *args, **kwargs):
+        self.commands += 1
+        return getattr(self, "_" + _command)(*args, **kwargs)
+
+    def __getattr__(self, name):
+        if hasattr(type(self), "_" + name):
+            return lambda *args, **kwargs: self._call(name, *args, **kwargs)
+        raise AttributeError(name)
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def pubsub(self):
+        return FakePubSub(self)
+
+    # Commands.
+    def _get(self, key):
+        return self.data.get(key)
+
+    def _set(self, key, value, ex=None, px=None, nx=False, xx=False):
+        if (nx and key in self.data) or (xx and key not in self.data):
+            return None
+        self.data[key] = str(value)
+        return True
+
+    def _mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def _incr(self, key, amount=1):
+        self.data[key] = str(int(self.data.get(key, 0)) + amount)
+        return int(self.data[key])
+
+    def _exists(self, key):
+        return key in self.data
+
+    def _setex(self, name, value, time):
+        return self._set(name, value)
+
+    def _publish(self, channel, message):
+        subscribers = self.channels.get(channel, [])
+        for subscriber in subscribers:
+            subscriber.messages.put(
+                {'type': 'message', 'channel': channel, 'data': message})
+        return len(subscribers)
+
+    def _getset(self, key, value):
+        old = self.data.get(key)
+        self.data[key] = str(value)
+        return old
+
+    def _delete(self, *keys):
+        return sum(1 for key in keys if self.data.pop(key, None) is not None)
+
+    def _hincrby(self, key, field, amount=1):
+        hash_ = self.data.setdefault(key, {})
+        hash_[field] = int(hash_.get(field, 0)) + amount
+        return hash_[field]
+
+    def _hgetall(self, key):
+        return {field: str(value)
+                for field, value in self.data.get(key, {}).iteritems()}
+
+    def _eval(self, script, numkeys, *keys_and_args):
+        """Run the Python equivalent of one of cloudly's Lua scripts."""
+        keys, args = keys_and_args[:numkeys], keys_and_args[numkeys:]
+        return getattr(self, "_" + SCRIPTS[script])(keys, args)
+
+    def _release_lock(self, keys, args):
+        if self.data.get(keys[0]) == str(args[0]):
+            return self._delete(keys[0])
+        return 0
+
+
+SCRIPTS = {cache.RELEASE_LOCK: "release_lock"}
+
+
+class FakePipeline(object):
+    def __init__(self, server):
+        self.server = server
+        self.queue = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.queue.append((name, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        self.server._hop()
+        results = [self.server._apply(name, *args, **kwargs)
+                   for name, args, kwargs in self.queue]
+        self.queue = []
+        return results
+
+
+class FakePubSub(object):
+    def __init__(self, server):
+        self.server = server
+        self.messages = Queue.Queue()
+
+    def subscribe(self, channel):
+        self.server.channels.setdefault(channel, []).append(self)
+        self.messages.put({'type': 'subscribe', 'channel': channel,
+                           'data': 1})
+
+    def listen(self):
+        while True:
+            yield self.messages.get()
+
+
+class FakeMemcache(object):
+    """Set `down` to True to make every request fail."""
+    def __init__(self):
+        self.data = {}
+        self.down = False
+
+    def _check(self):
+        if self.down:
+            raise socket.error("Connection refused")
+
+    def get(self, key):
+        self._check()
+        return self.data.get(key)
+
+    def set(self, key, obj, time=0, min_compress_len=0):
+        self._check()
+        self.data[key] = obj
+        return True
+
+    def get_multi(self, keys):
+        self._check()
+        return {key: self.data[key] for key in keys if key in self.data}
+
+    def set_multi(self, mapping, time=0, min_compress_len=0):
+        self._check()
+        self.data.update(mapping)
+        return []
+
+    def delete(self, key):
+        self._check()
+        self.data.pop(key, None)
+
+
+class FakeInstance(object):
+    def __init__(self, id, services, state="running", private_ip=None,
+                 public_ip=None):
+        self.id = id
+        self.state = state
+        self.tags = {'services': ",".join(services)} if services else {}
+        self.private_ip_address = private_ip
+        self.ip_address = public_ip
+
+
+class FakeReservation(object):
+    def __init__(self, instances):
+        self.instances = instances
+
+
+class FakeEC2Connection(object):
+    """An EC2 connection serving the given instances. Supports the
+    `tag-key` and `instance-state-name` filters.
+    """
+    def __init__(self, instances, region="us-east-1",
+                 access_key="AKIAFAKE"):
+        self.instances = instances
+        self.region = RegionInfo(name=region)
+        self.aws_access_key_id = access_key
+        self.calls = 0
+
+    def get_all_instances(self, filters=None):
+        self.calls += 1
+        filters = filters or {}
+        instances = [
+            instance for instance in self.instances
+            if ('tag-key' not in filters or
+                filters['tag-key'] in instance.tags) and
+            filters.get('instance-state-name', instance.state) ==
+            instance.state]
+        return [FakeReservation([instance]) for instance in instances]
+
+
+class FakeCouchDatabase(object):
+    """A database holding `docs`, by id. Requests raise a socket.error while
+    `failures` is positive, decrementing it, and writing an id of `errors`
+    fails with that error.
+
+    The changes feed is served from `log`, without waiting. Filters are
+    python functions of `filters`, called with a document and the query
+    parameters.
+    """
+    def __init__(self, name="fake"):
+        self.docs = {}
+        self.failures = 0
+        self.errors = {}
+        self.requests = []
+        self.log = []
+        self.filters = {}
+        self.lock = threading.Lock()
+        self.resource = FakeResource(self, "http://fake:5984/" + name)
+
+    def info(self):
+        return {'update_seq': len(self.log)}
+
+    def get(self, doc_id):
+        doc = self.docs.get(doc_id)
+        return dict(doc) if doc else None
+
+    def save(self, doc):
+        self.requests.append(('save', doc['_id']))
+        result, = self.resource._bulk_docs({'docs': [doc]})
+        if 'error' in result:
+            raise couchdb.http.ResourceConflict(result['error'])
+        doc['_rev'] = result['rev']
+        return doc['_id'], doc['_rev']
+
+    def delete(self, doc):
+        self.requests.append(('delete', doc['_id']))
+        self.resource._bulk_docs({'docs': [dict(doc, _deleted=True)]})
+
+    def copy(self, src, dest):
+        self.requests.append(('copy', src, dest['_id']))
+        doc = dict(self.docs[src], _id=dest['_id'], _rev=dest.get('_rev'))
+        result, = self.resource._bulk_docs({'docs': [doc]})
+        return result['rev']
+
+    def view(self, name, **options):
+        self.requests.append(('view', name))
+        return []
+
+    def changes(self, since=0, limit=None, filter=None, **params):
+        self.requests.append('_changes')
+        params.pop('feed', None)
+        params.pop('timeout', None)
+        results = []
+        for seq, change in enumerate(self.log[since:], since + 1):
+            # Only the latest change of a document is listed.
+            if any(later['id'] == change['id']
+                   for later in self.log[seq:]):
+                continue
+            doc = self.docs.get(change['id'], {'_deleted': True})
+            if filter and not self.filters[filter](doc, params):
+                continue
+            results.append(dict(change, seq=seq))
+        results = results[:limit] if limit else results
+        last_seq = results[-1]['seq'] if limit and len(results) == limit \
+            else len(self.log)
+        return {'results': results, 'last_seq': last_seq}
+
+
+class FakeResource(object):
+    def __init__(self, database, url):
+        self.database = database
+        self.url = url
+
+    def post_json(self, path=None, body=None, headers=None, **params):
+        database = self.database
+        with database.lock:
+            database.requests.append(path)
+            if database.failures:
+                database.failures -= 1
+                raise socket.error("Connection reset")
+            if isinstance(body, basestring):
+                body = json.loads(body)
+            handler = getattr(self, "_" + path.lstrip("_"))
+            return 201, {}, handler(body, **params)
+
+    def _bulk_docs(self, body):
+        results = []
+        for doc in body['docs']:
+            doc_id = doc.get('_id') or uuid.uuid4().hex
+            error = self.database.errors.get(doc_id)
+            current = self.database.docs.get(doc_id)
+            if not error and current and \
+                    current['_rev'] != doc.get('_rev'):
+                error = 'conflict'
+            if error:
+                results.append({'id': doc_id, 'error': error,
+                                'reason': error})
+                continue
+            revision = int(current['_rev'].split("-")[0]) if current else 0
+            doc = dict(doc, _id=doc_id,
+                       _rev="{}-{}".format(revision + 1, uuid.uuid4().hex))
+            change = {'id': doc_id, 'changes': [{'rev': doc['_rev']}]}
+            if doc.get('_deleted'):
+                self.database.docs.pop(doc_id, None)
+                change['deleted'] = True
+            else:
+                self.database.docs[doc_id] = doc
+            self.database.log.append(change)
+            results.append({'ok': True, 'id': doc_id, 'rev': doc['_rev']})
+        return results
+
+    def _all_docs(self, body, include_docs=False):
+        rows = []
+        for key in body['keys']:
+            doc = self.database.docs.get(key)
+            if doc is None:
+                rows.append({'key': key, 'error': "not_found"})
+                continue
+            row = {'id': key, 'key': key, 'value': {'rev': doc['_rev']}}
+            if include_docs:
+                row['doc'] = doc
+            rows.append(row)
+        return {'total_rows': len(self.database.docs), 'rows': rows}
@@ -0,0 +1,172 @@
+import time
+import threading
+from os.path import join
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from mock import patch
+
+from cloudly.aws import ec2
+from cloudly.timer import Timer
+from tests.fakes import FakeEC2Connection, FakeInstance
+
+connection = FakeEC2Connection([
+    FakeInstance("i-1", ["redis", "couchdb"], private_ip="10.0.0.1",
+                 public_ip="1.1.1.1"),
+    FakeInstance("i-2", ["redis"], private_ip="10.0.0.2",
+                 public_ip="1.1.1.2"),
+    FakeInstance("i-3", ["redis"], state="stopped"),
+    FakeInstance("i-4", None),
+])
+
+
+@patch.object(ec2, "is_running_on_ec2", return_value=False)
+def test_service_registry(is_running_on_ec2, tmpdir):
+    path = join(str(tmpdir), "services.json")
+    registry = ec2.ServiceRegistry(path=path,
+                                   connection_factory=lambda: connection)
+    assert registry.find("redis") == ["1.1.1.1", "1.1.1.2"]
+    assert registry.find("couchdb") == ["1.1.1.1"]
+    assert registry.find("cube") == []
+    assert connection.calls == 1
+
+    is_running_on_ec2.return_value = True
+    assert registry.find("couchdb") == ["10.0.0.1"]
+
+    # A new process reads the saved index, without calling EC2.
+    registry = ec2.ServiceRegistry(path=path,
+                                   connection_factory=lambda: connection)
+    assert registry.find("redis") == ["10.0.0.1", "10.0.0.2"]
+    assert connection.calls == 1
+
+    # Unless it is too old.
+    registry = ec2.ServiceRegistry(ttl=0, path=path,
+                                   connection_factory=lambda: connection)
+    registry.find("redis")
+    assert connection.calls == 2
+
+    # Nor built for another region.
+    other = FakeEC2Connection(connection.instances, region="eu-west-1")
+    registry = ec2.ServiceRegistry(path=path,
+                                   connection_factory=lambda: other)
+    registry.find("redis")
+    assert other.calls == 1
+
+
+class MetadataHandler(BaseHTTPRequestHandler):
+    requests = []
+
+    def do_PUT(self):
+        self.requests.append(("PUT", self.path))
+        self.reply(200, "token")
+
+    def do_GET(self):
+        self.requests.append(("GET", self.path))
+        if self.headers.get('X-aws-ec2-metadata-token') != "token":
+            self.reply(401, "")
+        elif self.path == "/latest/meta-data/instance-id":
+            self.reply(200, "i-1")
+        else:
+            self.reply(404, "")
+
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_metadata_client(tmpdir):
+    server = HTTPServer(("127.0.0.1", 0), MetadataHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = "http://127.0.0.1:{}/latest/meta-data/".format(server.server_port)
+    path = join(str(tmpdir), "metadata.json")
+
+    client = ec2.MetadataClient(url, path=path)
+    assert client.get("instance-id") == "i-1"
+    assert client.get("instance-id") == "i-1"
+    assert client.get("missing") is None
+    assert MetadataHandler.requests == [
+        ("PUT", "/latest/api/token"),
+        ("GET", "/latest/meta-data/instance-id"),
+        ("GET", "/latest/meta-data/missing")]
+
+    # Another process reads the saved values.
+    assert ec2.MetadataClient(url, path=path).get("instance-id") == "i-1"
+    assert len(MetadataHandler.requests) == 3
+    server.shutdown()
+
+
+def test_metadata_client_unreachable(tmpdir):
+    path = join(str(tmpdir), "metadata.json")
+    # Nothing listens on this port.
+    url = "http://127.0.0.1:1/latest/meta-data/"
+    with Timer() as timer:
+        assert ec2.MetadataClient(url, path=path).get() is None
+        # Another process knows not to try.
+        client = ec2.MetadataClient(url, path=path)
+        assert client.get() is None
+    assert client.reachable is False
+    assert timer.interval < 1
+
+
+class NoTokenHandler(MetadataHandler):
+    """The response to the token request is lost, as in a container."""
+    def do_PUT(self):
+        time.sleep(0.5)
+
+    def do_GET(self):
+        self.requests.append(("GET", self.path))
+        self.reply(200, "i-1")
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def test_metadata_client_no_token(tmpdir):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), NoTokenHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = "http://127.0.0.1:{}/latest/meta-data/".format(server.server_port)
+    path = join(str(tmpdir), "metadata.json")
+
+    # The service was found unreachable recently.
+    ec2.MetadataClient("http://127.0.0.1:1/", path=path).get()
+    assert ec2.MetadataClient(url, path=path).get("instance-id") is None
+
+    # But not that recently: plain requests are made, without a token.
+    client = ec2.MetadataClient(url, timeout=0.2, path=path, negative_ttl=0)
+    assert client.get("instance-id") == "i-1"
+    assert client.reachable is True
+    assert client.token == ''
+    server.shutdown()
+
+
+class RejectingHandler(MetadataHandler):
+    """Tokens are always rejected."""
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(("GET", self.path))
+        self.reply(401, "")
+
+
+def test_metadata_client_rejected_token():
+    server = HTTPServer(("127.0.0.1", 0), RejectingHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = "http://127.0.0.1:{}/latest/meta-data/".format(server.server_port)
+
+    assert ec2.MetadataClient(url).get("instance-id") is None
+    # A single new token is asked for.
+    assert [method for method, _ in RejectingHandler.requests] == \
+        ["PUT", "GET", "PUT", "GET"]
+    server.shutdown()
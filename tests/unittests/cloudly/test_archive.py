@@ -0,0 +1,118 @@
+import os
+import gzip
+import json
+import zlib
+from os.path import join
+
+from mock import patch
+
+from cloudly import archive, tweets
+from cloudly.archive import ArchiveWriter, read_index
+from tests.benchmarks import make_tweets
+
+HOUR = 3600
+START = 1370088000  # 2013-06-01T12:00:00Z
+
+
+def read(path):
+    with gzip.open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def read_from(path, offset):
+    """Decompress one gzip member starting at `offset`."""
+    with open(path, "rb") as f:
+        f.seek(offset)
+        data = f.read()
+    return zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(data)
+
+
+def test_writer(tmpdir):
+    batches = [make_tweets(50)[n * 10:(n + 1) * 10] for n in xrange(5)]
+    writer = ArchiveWriter(str(tmpdir), time_format="%Y-%m-%d")
+    with patch.object(archive.time, 'time') as now:
+        for n, batch in enumerate(batches):
+            # Two batches an hour.
+            now.return_value = START + n * HOUR / 2
+            writer.write(batch)
+        writer.close()
+
+    path = join(str(tmpdir), "2013-06-01.gz")
+    assert read(path) == sum(batches, [])
+    index = read_index(path)
+    assert [hour for hour, _ in index] == \
+        ["2013-06-01T12", "2013-06-01T13", "2013-06-01T14"]
+    # Each member holds the tweets of one hour.
+    lines = read_from(path, index[1][1]).splitlines()
+    assert [json.loads(line) for line in lines] == batches[2] + batches[3]
+
+
+def test_rotation(tmpdir):
+    batch = make_tweets(100)
+    writer = ArchiveWriter(str(tmpdir), max_size=2000, flush_interval=0,
+                           background=True)
+    for n in xrange(0, 100, 10):
+        writer.write(batch[n:n + 10])
+    writer.close()
+
+    paths = sorted(tmpdir.listdir(lambda path: path.ext == ".gz"),
+                   key=lambda path: (len(path.basename), path.basename))
+    assert len(paths) > 1
+    assert sum((read(str(path)) for path in paths), []) == batch
+    for path in paths:
+        assert [offset for _, offset in read_index(str(path))] == [0]
+
+
+def test_persist_file(tmpdir):
+    batch = make_tweets(20)
+    tweets.persist_file(batch[:10], str(tmpdir))
+    tweets.persist_file(batch[10:], str(tmpdir))
+    path, = tmpdir.listdir(lambda path: path.ext == ".gz")
+    assert read(str(path)) == batch
+    # The second call continues the hour of the first.
+    assert len(read_index(str(path))) == 1
+    assert sum(archive.read(str(tmpdir), processes=1), []) == batch
+
+    # Kept open, the file is this process's own.
+    tweets.persist_file(batch, str(tmpdir), close=False)
+    archive.close_writers()
+    path, = tmpdir.listdir(lambda path: path.basename.endswith(
+        "-{}.gz".format(os.getpid())))
+    assert read(str(path)) == batch
+
+
+def is_geolocated(tweet):
+    return bool(tweet['coordinates'])
+
+
+def test_read(tmpdir):
+    batch = make_tweets(300)
+    writer = ArchiveWriter(str(tmpdir))
+    with patch.object(archive.time, 'time') as now:
+        for n in xrange(0, 200, 20):
+            now.return_value = START + n * HOUR / 40
+            writer.write(batch[n:n + 20])
+        writer.close()
+    # The day after, written the old way: a gzip member per batch.
+    for n in xrange(200, 300, 25):
+        with gzip.open(join(str(tmpdir), "2013-06-02.gz"), "a+") as f:
+            tweets.write(batch[n:n + 25], f)
+    tmpdir.join("2013-06-01.gz.idx.tmp").write("")
+
+    assert archive.archives(str(tmpdir)) == [
+        join(str(tmpdir), "2013-06-01.gz"), join(str(tmpdir), "2013-06-02.gz")]
+    assert len(list(archive._units(str(tmpdir), True))) == 6
+
+    for processes in [1, 2]:
+        batches = list(tweets.read_archives(str(tmpdir), batch_size=64,
+                                            processes=processes))
+        assert [len(tweets_) for tweets_ in batches] == [64] * 4 + [44]
+        assert sum(batches, []) == batch
+
+    geolocated = [tweet for tweet in batch if tweet['coordinates']]
+    batches = list(tweets.read_archives(
+        str(tmpdir), attrs=['id_str', 'coordinates.coordinates'],
+        predicate=is_geolocated, contains=['"coordinates": {'],
+        processes=2))
+    assert sum(batches, []) == tweets.keep(
+        ['id_str', 'coordinates.coordinates'], geolocated)
@@ -0,0 +1,30 @@
+import pytest
+
+from cloudly.bloom import BloomFilter, RotatingBloomFilter
+
+
+def test_bloom_filter():
+    bloom = BloomFilter(10000, error_rate=0.01)
+    keys = [str(n) for n in xrange(10000)]
+    assert sum(bloom.add(key) for key in keys) < 100
+    assert all(key in bloom for key in keys)
+    assert all(bloom.add(key) for key in keys)
+    assert len(bloom) > 9900
+
+    false_positives = sum(str(n) in bloom for n in xrange(10000, 20000))
+    print false_positives
+    assert false_positives < 200
+    assert u"caf\xe9" not in bloom
+
+    with pytest.raises(ValueError):
+        BloomFilter(0)
+
+
+def test_rotating_bloom_filter():
+    bloom = RotatingBloomFilter(100)
+    for n in xrange(250):
+        assert not bloom.add(str(n))
+    # The last 100 keys at least are remembered, the first forgotten.
+    assert all(str(n) in bloom for n in xrange(150, 250))
+    assert not any(str(n) in bloom for n in xrange(100))
+    assert len(bloom.current) == 50
@@ -0,0 +1,254 @@
+import json
+import threading
+from collections import Counter
+from time import sleep
+
+import pytest
+import redis
+
+from cloudly.cache import (TieredCache, LRUCache, MemProxy, get_or_compute,
+                           add_json_helpers, HashRing, MemcachePool,
+                           RedisClient, PoolExhausted)
+from tests.fakes import FakeRedis, FakeMemcache
+
+
+def test_lru_cache():
+    lru = LRUCache(maxsize=2)
+    lru.set('a', 1)
+    lru.set('b', 2, ttl=0.05)
+    lru.get('a')
+    lru.set('c', 3)  # Evicts 'b'.
+    assert (lru.get('a'), lru.get('b'), lru.get('c')) == (1, None, 3)
+    lru.set('d', 4, ttl=0.05)
+    sleep(0.1)
+    assert lru.get('d') is None
+
+
+def test_tiered_cache():
+    redis, memcache = FakeRedis(), FakeMemcache()
+    calls = []
+
+    def loader(key):
+        calls.append(key)
+        return {'key': key} if key != 'missing' else None
+
+    cache = TieredCache("test", memcache=memcache, redis=redis,
+                        loader=loader, negative_ttl=10)
+    assert cache.get('a') == {'key': 'a'}
+    assert cache.get('a') == {'key': 'a'}
+    assert calls == ['a']
+    assert 'test:a' in memcache.data and 'test:a' in redis.data
+
+    # Served from Redis, then copied to memcache and the local tier.
+    other = TieredCache("test", memcache=FakeMemcache(), redis=redis)
+    assert other.get('a') == {'key': 'a'}
+    assert 'test:a' in other.tiers[0].client.data
+
+    # Negative caching.
+    assert cache.get('missing') is None
+    assert cache.get('missing') is None
+    assert calls == ['a', 'missing']
+
+    cache.delete('a')
+    assert cache.get('a', loader=lambda key: 'b') == 'b'
+
+
+def test_tiered_cache_write_behind():
+    redis = FakeRedis()
+    cache = TieredCache("test", redis=redis, write_behind=True)
+    cache.set('a', [1, 2], ttl=5)
+    assert cache.get('a') == [1, 2]
+    cache.flush()
+    assert redis.get('test:a') == '[1, 2]'
+
+
+def test_tiered_cache_invalidation():
+    redis = FakeRedis()
+    first = TieredCache("test", redis=redis, channel="invalidate")
+    second = TieredCache("test", redis=redis.clone(), channel="invalidate")
+
+    first.set('a', 1)
+    assert second.get('a') == 1
+    first.set('a', 2)
+    sleep(0.1)
+    assert second.get('a') == 2
+    assert first.get('a') == 2
+
+
+def test_tiered_cache_write_behind_invalidation():
+    redis = FakeRedis()
+    cache = TieredCache("test", redis=redis, channel="invalidate",
+                        write_behind=True)
+    published = []
+    publish = redis._publish
+
+    def check_publish(channel, message):
+        # Other processes must read the new value once invalidated.
+        published.append(redis.data.get('test:a'))
+        return publish(channel, message)
+
+    redis._publish = check_publish
+    cache.set('a', 1)
+    cache.delete('a')
+    cache.flush()
+    assert published == ['1', None]
+
+
+def test_get_or_compute():
+    redis = FakeRedis()
+    calls = []
+
+    def loader():
+        calls.append(1)
+        sleep(0.1)
+        return len(calls)
+
+    threads = [threading.Thread(target=get_or_compute,
+                                args=('key', loader, 60, redis))
+               for _ in range(10)]
+    [thread.start() for thread in threads]
+    [thread.join() for thread in threads]
+    assert len(calls) == 1
+    assert get_or_compute('key', loader, 60, redis) == 1
+
+    # Another process holds the lock: the stale value is served.
+    entry = json.loads(redis.get('key'))
+    entry['expiry'] = 0
+    redis.set('key', json.dumps(entry))
+    redis.set('lock:key', 'other')
+    assert get_or_compute('key', loader, 60, redis, serve_stale=True) == 1
+    assert len(calls) == 1
+
+    # Early refresh: with a huge beta, the value is always due.
+    redis.delete('lock:key')
+    assert get_or_compute('key', loader, 60, redis, beta=1e9) == 2
+    assert not redis.exists('lock:key')
+
+    # A lock taken over by another process, after ours expired, is kept.
+    def take_over():
+        return redis.set('lock:other', 'other')
+
+    get_or_compute('other', take_over, 60, redis)
+    assert redis.get('lock:other') == 'other'
+
+
+def test_memproxy_codec():
+    proxy = MemProxy(codec="pickle", compression="zlib")
+    proxy.cache = FakeMemcache()
+    proxy.set("key", {'a': [1] * 1000})
+    assert proxy.cache.data["key"][:3] == "\x00pz"
+    assert proxy.get("key") == {'a': [1] * 1000}
+    proxy.cache.data["legacy"] = {'a': 1}
+    assert proxy.get("legacy") == {'a': 1}
+
+    # Small or uncompressed json payloads are decoded too.
+    proxy.set("small", {'x': 1})
+    assert proxy.get("small") == {'x': 1}
+    proxy = MemProxy(codec="json")
+    proxy.cache = FakeMemcache()
+    proxy.set("key", {'x': 1})
+    assert proxy.get("key") == {'x': 1}
+    proxy.set_multi({"a": [1], "b": "text"})
+    assert proxy.get_multi(["a", "b"]) == {"a": [1], "b": "text"}
+
+
+def test_memproxy_default_client():
+    # Nothing listens on port 1: python-memcached reports misses.
+    proxy = MemProxy(servers=["127.0.0.1:1"])
+    assert proxy.get("key") is None
+    assert not proxy.set("key", 1)
+    proxy = MemProxy(servers=["127.0.0.1:1", "127.0.0.1:2"])
+    assert isinstance(proxy.cache, MemcachePool)
+    assert proxy.get("key") is None
+
+
+def test_bulk_helpers():
+    redis = add_json_helpers(FakeRedis())
+    mapping = {"key{}".format(n): {'n': n} for n in range(2500)}
+    redis.jmset(mapping, ttl=60)
+    keys = sorted(mapping) + ["missing"]
+    assert redis.jmget(keys) == [mapping[key] for key in keys[:-1]] + [None]
+    # Chunks of CHUNK_SIZE keys: 3 pipelines and 3 MGET.
+    assert redis.round_trips == 6
+
+    with redis.jpipeline() as pipe:
+        pipe.jget("key1")
+        pipe.jset("other", [1])
+        pipe.incr("counter")
+    assert pipe.results == [{'n': 1}, True, 1]
+
+    assert redis.jdelete_many(keys) == 2500
+    assert redis.jget("key1") is None
+
+
+def test_hash_ring():
+    keys = ["key{}".format(n) for n in range(10000)]
+    ring = HashRing(["a:1", "b:1", "c:1", "d:1"])
+    before = {key: ring.get_node(key) for key in keys}
+    counts = Counter(before.values())
+    print counts
+    assert min(counts.values()) > 1500
+
+    ring.remove("d:1")
+    moved = [key for key in keys if ring.get_node(key) != before[key]]
+    # Only the keys of the removed node move.
+    assert set(before[key] for key in moved) == set(["d:1"])
+    ring.add("d:1")
+    assert all(ring.get_node(key) == before[key] for key in keys)
+
+
+def test_memcache_pool():
+    nodes = {}
+
+    def factory(server):
+        nodes[server] = FakeMemcache()
+        return nodes[server]
+
+    pool = MemcachePool(["a:1", "b:1", "c:1"], retry=0.05,
+                        client_factory=factory)
+    keys = ["key{}".format(n) for n in range(100)]
+    assert pool.set_multi({key: key for key in keys}) == []
+    assert all(len(node.data) > 10 for node in nodes.values())
+    assert pool.get_multi(keys) == {key: key for key in keys}
+
+    nodes["a:1"].down = True
+    lost = [key for key in keys if key in nodes["a:1"].data]
+    assert pool.get(lost[0]) is None  # Ejected.
+    assert "a:1" in pool.dead
+    pool.set(lost[0], "value")
+    assert pool.get(lost[0]) == "value"
+
+    sleep(0.06)
+    nodes["a:1"].down = False
+    assert pool.get(lost[1]) == lost[1]  # Back in the ring.
+    assert not pool.dead
+
+
+def test_redis_client_reconnect():
+    # Nothing listens on these ports.
+    urls = ["redis://127.0.0.1:1", "redis://127.0.0.1:2"]
+    client = RedisClient(lambda: urls[0], max_connections=2, timeout=0.1,
+                         socket_connect_timeout=0.5)
+    assert client.url == urls[0]
+
+    with pytest.raises(redis.ConnectionError):
+        client.get("key")
+    assert client.url == urls[0]
+
+    # The endpoint moved: the pool follows, and the command is retried.
+    urls.pop(0)
+    with pytest.raises(redis.ConnectionError):
+        client.get("key")
+    assert client.url == urls[0]
+    assert client.connection_pool.connection_kwargs['port'] == 2
+
+    stats = client.pool_stats()
+    print stats
+    # A new pool, used once.
+    assert stats['checkouts'] == 1 and stats['in_use'] == 0
+
+    # Exhausting the pool doesn't count as a server failure.
+    client.connection_pool.get_connection("get")
+    client.connection_pool.get_connection("get")
+    with pytest.raises(PoolExhausted):
+        client.get("key")
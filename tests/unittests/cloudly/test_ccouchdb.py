@@ -0,0 +1,261 @@
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+import couchdb
+from mock import Mock, patch
+
+from cloudly import ccouchdb, tweets
+from cloudly.ccouchdb import (BulkWriter, ChangesConsumer, Database,
+                              KeepAlivePool)
+from tests.benchmarks import make_tweets
+from tests.fakes import FakeCouchDatabase, FakeRedis, FakeResource
+
+
+def make_docs(count, start=0):
+    return [{'_id': str(n), 'n': n} for n in xrange(start, start + count)]
+
+
+def test_bulk_writer():
+    database = FakeCouchDatabase()
+    writer = BulkWriter(database, max_docs=10, max_bytes=150, concurrency=3,
+                        retry_delay=0)
+    docs = make_docs(50)
+    assert writer.write(docs) == {'written': 50, 'existing': 0,
+                                  'skipped': 0, 'failed': 0}
+    assert sorted(database.docs) == sorted(doc['_id'] for doc in docs)
+    assert all('_rev' not in doc for doc in docs)
+    # Chunks of at most 150 bytes of JSON: 6 documents of 22 or 23 bytes.
+    assert database.requests.count('_bulk_docs') == 9
+
+    # Failed requests and documents are retried, conflicts are not.
+    database.requests = []
+    database.failures = 1
+    database.errors = {'52': "forbidden"}
+    stats = writer.write(make_docs(15, start=45))
+    assert stats == {'written': 9, 'existing': 5, 'skipped': 0, 'failed': 1}
+    # 3 chunks, one sent again after a failure, and 3 retries of '52'.
+    assert len(database.requests) == 3 + 1 + 3
+    writer.close()
+
+
+def test_bulk_writer_overwrite():
+    database = FakeCouchDatabase()
+    writer = BulkWriter(database, overwrite=True, retry_delay=0)
+    writer.write(make_docs(10))
+    docs = [dict(doc, n=-doc['n']) for doc in make_docs(20)]
+    stats = writer.write(docs)
+    assert stats == {'written': 20, 'existing': 0, 'skipped': 0,
+                     'failed': 0}
+    assert database.docs['3']['n'] == -3
+    assert database.docs['3']['_rev'].startswith("2-")
+
+    # Conflicts on the last attempt are sent again with their revision.
+    writer = BulkWriter(database, overwrite=True, retries=0)
+    assert writer.write(make_docs(5))['written'] == 5
+
+
+def test_bulk_writer_skip_existing():
+    database = FakeCouchDatabase()
+    writer = BulkWriter(database, skip_existing=True)
+    writer.write(make_docs(10))
+    database.requests = []
+    stats = writer.write(make_docs(20))
+    assert stats == {'written': 10, 'existing': 0, 'skipped': 10,
+                     'failed': 0}
+    # Documents known to exist were not sent.
+    assert database.requests == ['_bulk_docs']
+
+
+def test_get_bulk_writer():
+    database = FakeCouchDatabase("tweets")
+    writer = ccouchdb.get_bulk_writer(database, max_docs=10)
+    assert ccouchdb.get_bulk_writer(database, max_docs=10) is writer
+    assert ccouchdb.get_bulk_writer(database, max_docs=20) is not writer
+    # A forked process gets writers of its own.
+    with patch.object(ccouchdb.os, 'getpid', return_value=-1):
+        assert ccouchdb.get_bulk_writer(database, max_docs=10) is not writer
+
+
+def test_persist_db():
+    database = FakeCouchDatabase("tweets")
+    batch = make_tweets(30)
+    stats = tweets.persist_db(database, batch)
+    assert stats['written'] == 30
+    assert sorted(database.docs) == sorted(tweet['id_str'] for tweet in batch)
+    assert '_id' not in batch[0]
+
+
+def test_changes_consumer(tmpdir):
+    database = FakeCouchDatabase()
+    writer = BulkWriter(database)
+    writer.write(make_docs(25))
+    checkpoint = str(tmpdir.join("seq.json"))
+    batches = []
+
+    def consume(**kwargs):
+        consumer = ChangesConsumer(database, batches.append,
+                                   checkpoint=checkpoint, batch_size=10,
+                                   **kwargs)
+        # Until caught up.
+        while consumer.poll():
+            pass
+        consumer.flush()
+
+    consume()
+    assert [len(batch) for batch in batches] == [10, 10, 5]
+    assert [change['doc']['n'] for change in batches[0]] == range(10)
+    # One request for the changes and one for the documents, by batch.
+    assert database.requests.count('_all_docs') == 3
+    assert ccouchdb.FileCheckpoint(checkpoint).get() == 25
+
+    # Resumes after the checkpoint.
+    del batches[:]
+    writer.write([dict(database.docs['3'], _deleted=True)])
+    writer.write(make_docs(3, start=25))
+    consume()
+    assert [(change['id'], change['doc']) for change in batches[0]] == [
+        ('3', None), ('25', {'_id': '25', 'n': 25,
+                             '_rev': database.docs['25']['_rev']}),
+        ('26', database.docs['26']), ('27', database.docs['27'])]
+
+
+def test_changes_consumer_filter():
+    database = FakeCouchDatabase()
+    database.filters['app/even'] = \
+        lambda doc, params: doc.get('n', 0) % int(params['modulo']) == 0
+    BulkWriter(database).write(make_docs(30))
+    batches = []
+    redis = FakeRedis()
+    checkpoint = ccouchdb.RedisCheckpoint("seq", redis)
+    consumer = ChangesConsumer(database, batches.append,
+                               checkpoint=checkpoint, batch_size=100,
+                               batch_interval=0, include_docs=False,
+                               filter="app/even",
+                               filter_params={'modulo': 3})
+    consumer.poll()
+    assert [change['id'] for change in batches[0]] == \
+        [str(n) for n in xrange(0, 30, 3)]
+    assert checkpoint.get() == 28
+    assert '_all_docs' not in database.requests
+
+
+def test_sync_design_doc(tmpdir):
+    database = FakeCouchDatabase()
+    design = tmpdir.join("design.yaml")
+    design.write(DESIGN.format(view="count"))
+
+    assert ccouchdb.sync_design_doc(database, str(design))
+    assert database.requests == [('save', "_design/tweets")]
+    assert not ccouchdb.sync_design_doc(database, str(design))
+    assert len(database.requests) == 1
+
+    database.requests = []
+    design.write(DESIGN.format(view="total"))
+    assert ccouchdb.sync_design_doc(database, str(design))
+    assert database.requests == [
+        ('save', "_design/tweets_staging"),
+        ('view', "tweets_staging/by_user"),
+        ('copy', "_design/tweets_staging", "_design/tweets"),
+        ('delete', "_design/tweets_staging"),
+    ]
+    assert sorted(database.docs) == ["_design/tweets"]
+    assert database.docs["_design/tweets"]['views']['by_user']['reduce'] == \
+        "_total"
+    assert not ccouchdb.sync_design_doc(database, str(design))
+
+
+DESIGN = """
+_id: _design/tweets
+language: javascript
+views:
+  by_user:
+    map: |
+      function(doc) {{ emit(doc.user.id_str, null); }}
+    reduce: _{view}
+"""
+
+
+def test_get_many():
+    fake = FakeCouchDatabase()
+    BulkWriter(fake).write(make_docs(5))
+    database = Database(FakeResource(fake, "http://fake/fake"), "fake")
+
+    docs = database.get_many(["3", "1", "missing", "3"])
+    assert [doc and doc['n'] for doc in docs] == [3, 1, None, 3]
+    # Revisions, then the documents.
+    assert fake.requests[-2:] == ['_all_docs', '_all_docs']
+    assert len(database.doc_cache) == 2
+
+    # Current cached documents are not fetched again.
+    fake.requests = []
+    assert [doc['n'] for doc in database.get_many(["1", "3"])] == [1, 3]
+    assert fake.requests == ['_all_docs']
+
+    # Changed documents are.
+    BulkWriter(fake, overwrite=True).write([{'_id': "1", 'n': 10}])
+    fake.requests = []
+    assert [doc['n'] for doc in database.get_many(["1", "3"])] == [10, 3]
+    assert fake.requests == ['_all_docs', '_all_docs']
+    assert database.get_many([]) == []
+
+
+class CouchHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    connections = set()
+
+    def do_GET(self):
+        self.connections.add(self.client_address)
+        body = '{"ok": true}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def test_keep_alive_pool():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), CouchHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = "http://127.0.0.1:{}/".format(server.server_port)
+
+    pool = KeepAlivePool(5, max_idle=2, idle_timeout=60)
+    session = couchdb.http.Session(timeout=5)
+    session.connection_pool = pool
+    resource = couchdb.http.Resource(url, session)
+    for _ in xrange(5):
+        assert resource.get_json("db")[2] == {'ok': True}
+    # One connection, reused.
+    assert pool.created == 1
+    assert len(CouchHandler.connections) == 1
+
+    # Idle connections are not reused past the idle timeout.
+    pool.idle_timeout = 0
+    resource.get_json("db")
+    assert pool.created == 2
+    server.shutdown()
+
+
+@patch.object(KeepAlivePool, '_connect', side_effect=lambda *args: Mock())
+def test_keep_alive_pool_threads(connect):
+    url = "http://couchdb:5984/db"
+    pool = KeepAlivePool(5)
+    for _ in xrange(4):
+        pool.release(url, Mock())
+    conns = []
+    threads = [threading.Thread(target=lambda: conns.append(pool.get(url)))
+               for _ in xrange(8)]
+    [thread.start() for thread in threads]
+    [thread.join() for thread in threads]
+    # Each connection is handed out once.
+    assert len(set(map(id, conns))) == 8
+    assert pool.created == connect.call_count == 4
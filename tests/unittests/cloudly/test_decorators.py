@@ -1,7 +1,52 @@
 from time import sleep
 from datetime import datetime, timedelta
 
-from cloudly.decorators import burst, throttle, profile, line_profile
+from cloudly.decorators import (burst, throttle, profile, line_profile,
+                                Memoized)
+
+
+def test_memoized():
+    calls = []
+
+    @Memoized
+    def func(x, y=None):
+        calls.append(x)
+        return x
+
+    assert func(1) == func(1, None) == func(1, y=None) == func(x=1) == 1
+    assert len(calls) == 1
+    info = func.cache_info()
+    print info
+    assert (info.hits, info.misses, info.currsize) == (3, 1, 1)
+
+    func.invalidate(1)
+    func(1)
+    assert len(calls) == 2
+
+    func.cache_clear()
+    assert func.cache_info().currsize == 0
+
+    # Uncachable arguments are passed through.
+    assert func([1]) == [1]
+    assert len(calls) == 3
+
+
+def test_memoized_bounded():
+    @Memoized(maxsize=2, ttl=0.1)
+    def func(x):
+        return x
+
+    func(1)
+    func(2)
+    func(1)
+    func(3)  # Evicts 2, the least recently used.
+    assert sorted(func.cache) == [(1,), (3,)]
+    assert func.cache_info().evictions == 1
+
+    sleep(0.15)
+    func(1)  # Expired.
+    info = func.cache_info()
+    assert (info.hits, info.misses, info.evictions) == (1, 4, 2)
 
 
 def test_burst():
@@ -0,0 +1,133 @@
+import pytest
+
+from cloudly.dictutils import (merge, merge_all, find_item, find_value,
+                               Projector, Path, extract_many, LEFT_WINS,
+                               RIGHT_WINS, CONCAT)
+
+tweet = {
+    'id_str': "1",
+    'text': "This is a tweet.",
+    'coordinates': None,
+    'user': {'screen_name': "john_doe", 'name': "John Doe",
+             'entities': {'url': {'urls': []}}},
+    'entities': {'hashtags': [], 'urls': []},
+}
+
+
+def merge_keep(attrs, d):
+    """The original implementation of tweets.keep."""
+    stripped = {}
+    for attr in attrs:
+        stripped = merge(stripped, find_item(attr.split('.'), d))
+    return stripped
+
+
+def test_projector():
+    for attrs in [
+            ['text'],
+            ['text', 'user.screen_name', 'user.name'],
+            ['user.entities.url', 'entities', 'id_str'],
+            ['coordinates.coordinates', 'missing', 'user.missing'],
+            ['missing.key', 'text.key']]:
+        projected = Projector(attrs)(tweet)
+        print attrs, projected
+        assert projected == merge_keep(attrs, tweet)
+
+    # A key and one of its sub-keys: keep the whole value.
+    assert Projector(['user.name', 'user'])(tweet) == \
+        Projector(['user', 'user.name'])(tweet) == {'user': tweet['user']}
+
+    projected = list(Projector(['user.name']).many(iter([tweet, {}])))
+    assert projected == [{'user': {'name': "John Doe"}}, {'user': None}]
+
+
+def test_merge():
+    d1 = {'a': {'b': 1}, 'b': 4, 'c': {'b': 2}, 'e': {'f': {'g': 1}}}
+    d2 = {'a': {'c': 2, 'g': {'a': 2}}, 'c': {'g': 6}, 'd': 4}
+    merged = merge(d1, d2)
+    assert merged == {
+        'a': {'b': 1, 'c': 2, 'g': {'a': 2}},
+        'b': 4,
+        'c': {'b': 2, 'g': 6},
+        'd': 4,
+        'e': {'f': {'g': 1}},
+    }
+    # Inputs are untouched, untouched sub-dicts are shared.
+    assert d1['a'] == {'b': 1} and d2['a'] == {'c': 2, 'g': {'a': 2}}
+    assert merged['e'] is d1['e'] and merged['a']['g'] is d2['a']['g']
+
+    with pytest.raises(ValueError):
+        merge({'a': 1}, {'a': 2})
+
+
+def test_merge_conflicts():
+    d1 = {'a': {'b': [1], 'c': 1}}
+    d2 = {'a': {'b': [2], 'c': 2}}
+    assert merge(d1, d2, LEFT_WINS) == {'a': {'b': [1], 'c': 1}}
+    assert merge(d1, d2, RIGHT_WINS) == {'a': {'b': [2], 'c': 2}}
+    assert merge(d1, d2, lambda key, v1, v2: v1 + v2) == \
+        {'a': {'b': [1, 2], 'c': 3}}
+    assert merge({'a': [1]}, {'a': [2]}, CONCAT) == {'a': [1, 2]}
+    with pytest.raises(ValueError):
+        merge(d1, d2, CONCAT)
+
+
+def test_merge_inplace_and_deep():
+    d1 = {'a': {'b': 1}}
+    inner = d1['a']
+    assert merge(d1, {'a': {'c': 2}}, inplace=True) is d1
+    assert d1['a'] is inner and inner == {'b': 1, 'c': 2}
+
+    deep1, deep2 = {}, {}
+    node1, node2 = deep1, deep2
+    for level in xrange(5000):
+        node1 = node1.setdefault('k', {})
+        node2 = node2.setdefault('k', {})
+    node1['x'], node2['y'] = 1, 2
+    merged = merge(deep1, deep2)
+    for level in xrange(5001):
+        merged = merged['k'] if level < 5000 else merged
+    assert merged == {'x': 1, 'y': 2}
+    assert node1 == {'x': 1}
+
+
+def test_merge_all():
+    dicts = [{'a': {'b': 1}}, {'a': {'c': 2}}, {'a': {'d': 3}, 'e': 4}]
+    assert merge_all(dicts) == {'a': {'b': 1, 'c': 2, 'd': 3}, 'e': 4}
+    assert dicts[0] == {'a': {'b': 1}} and dicts[1] == {'a': {'c': 2}}
+    assert merge_all([{'a': 1}, {'a': 2}, {'a': 3}], RIGHT_WINS) == {'a': 3}
+
+
+def test_find():
+    d = {'a': {'b': 1, 'c': 3, 'd': {'e': 5}}, 'b': 4}
+    assert find_item(['a', 'b'], d) == {'a': {'b': 1}}
+    assert find_item(['a', 'd', 'e'], d) == {'a': {'d': {'e': 5}}}
+    assert find_item(['b', 'c'], d) == {'b': 4}
+    assert find_item(['x', 'y'], d) == {'x': None}
+    assert find_item(['x', 'y'], d, create=True) == {'x': {'y': {}}}
+    assert find_value(['a', 'd', 'e'], d) == 5
+    assert find_value(['a', 'x'], d) is None
+    assert find_value(['x', 'y'], d, create=True) == {}
+
+
+def test_path():
+    assert Path('user.screen_name')(tweet) == "john_doe"
+    assert Path('user.missing')(tweet) is None
+    assert Path('coordinates.coordinates')(tweet, default=0) == 0
+
+    d = {'tags': [{'text': "a"}, {'text': "b"}, {}], 'map': {'x': 1, 'y': 2}}
+    assert Path('tags.0.text')(d) == "a"
+    assert Path('tags.-2.text')(d) == "b"
+    assert Path('tags.5.text')(d) is None
+    assert Path('tags.*.text')(d) == ["a", "b"]
+    assert sorted(Path('map.*')(d)) == [1, 2]
+    assert Path('missing.*')(d) == []
+
+
+def test_extract_many():
+    docs = [tweet, {'id_str': "2"}]
+    paths = ['id_str', Path('user.screen_name')]
+    assert list(extract_many(paths, iter(docs))) == \
+        [("1", "john_doe"), ("2", None)]
+    assert extract_many(paths, docs, columnar=True) == \
+        [["1", "2"], ["john_doe", None]]
@@ -0,0 +1,56 @@
+import numpy as np
+
+from cloudly.geo import GeoFilter
+from cloudly.tweetbatch import TweetBatch
+from tests.benchmarks import make_tweets
+
+regions = {
+    'box': [-74, 45, -73, 46],
+    'triangle': [(-75, 45), (-74, 46), (-73, 45)],
+    # A concave U shape.
+    'u': [(0, 0), (3, 0), (3, 3), (2, 3), (2, 1), (1, 1), (1, 3), (0, 3)],
+    'far': {'type': "Polygon",
+            'coordinates': [[(100, 10), (101, 10), (101, 11), (100, 11)]]},
+}
+
+
+def test_match():
+    geo_filter = GeoFilter(regions, cell_size=0.5)
+    points = [
+        (-73.8, 45.5, ['box', 'triangle']),
+        (-74.8, 45.1, ['triangle']),
+        (-74.8, 45.9, []),
+        (0.5, 2, ['u']),
+        (1.5, 2, []),
+        (1.5, 0.5, ['u']),
+        (100.5, 10.5, ['far']),
+        (np.nan, np.nan, []),
+    ]
+    lng, lat, expected = zip(*points)
+    matches = geo_filter.match(lng, lat)
+    names = [[geo_filter.names[index] for index in np.nonzero(row)[0]]
+             for row in matches]
+    assert names == [sorted(inside) for inside in expected]
+
+
+def test_filter():
+    tweets = make_tweets(1000, geo_ratio=0.8)
+    geo_filter = GeoFilter({'north': [-180, 0, 180, 90],
+                            'east': [0, -90, 180, 90]})
+    filtered = list(geo_filter.filter(iter(tweets), batch_size=64))
+    for tweet in tweets:
+        coordinates = tweet['coordinates']
+        expected = []
+        if coordinates:
+            lng, lat = coordinates['coordinates']
+            expected = [name for name, inside in
+                        [('east', lng >= 0), ('north', lat >= 0)] if inside]
+        assert tweet.get('regions', []) == expected
+    assert filtered == [tweet for tweet in tweets if tweet.get('regions')]
+
+    batch = TweetBatch()
+    batch.extend(tweets[:100])
+    matches = geo_filter.tag(batch, key='zones')
+    assert matches.shape == (100, 2)
+    assert [tweet['zones'] for tweet in batch] == \
+        [tweet['regions'] for tweet in tweets[:100]]
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import re
+
+import pytest
+
+from cloudly.keywords import KeywordMatcher
+from tests.benchmarks import make_tweets
+
+
+def naive_match(subscriptions, text):
+    """Match each term of each phrase with a regular expression."""
+    words = set(re.findall(r"\w+", text.lower(), re.UNICODE))
+    return set(
+        subscriber for subscriber, phrases in subscriptions.iteritems()
+        if any(all(term.strip("#") in words for term in phrase.lower().split())
+               for phrase in phrases))
+
+
+def test_match():
+    matcher = KeywordMatcher({
+        'weather': ["snow storm", "flood"],
+        'traffic': ["traffic montreal", "#mtltraffic", u"pont champlain"],
+        'fire': ["fire"],
+    })
+    for text, expected in [
+            ("Snow and more... STORM!", ['weather']),
+            ("storms and snow", []),
+            ("Flooded", []),
+            ("#flood in Montreal, traffic jam", ['traffic', 'weather']),
+            ("Pont Champlain closed #MtlTraffic", ['traffic']),
+            ("mtltraffic", []),
+            ("firefighters", []),
+            ("fire_alarm", []),
+            (u"Fire at the caf\xe9", ['fire']),
+            ("", []),
+    ]:
+        print text
+        assert sorted(matcher.match(text)) == expected
+
+    assert matcher.wordlist == ["#mtltraffic", "fire", "flood",
+                                "pont champlain", "snow storm",
+                                "traffic montreal"]
+    with pytest.raises(ValueError):
+        KeywordMatcher({'empty': [" "]})
+
+
+def test_overlapping_terms():
+    # Terms being prefixes, suffixes or infixes of one another.
+    matcher = KeywordMatcher({'a': ["he"], 'b': ["she"], 'c': ["hers"],
+                              'd': ["his she"], 'e': ["ushers"]})
+    assert matcher.match("ushers") == set(['e'])
+    assert matcher.match("she hers") == set(['b', 'c'])
+    assert matcher.match("he, his: she") == set(['a', 'b', 'd'])
+
+
+def test_route():
+    subscriptions = {
+        'weather': ["snow storm", "rain", "power outage"],
+        'animals': ["quick fox", "lazy dog", "fox dog"],
+        'news': ["breaking news", "alert"],
+    }
+    matcher = KeywordMatcher(subscriptions)
+    for tweet in make_tweets(500):
+        assert matcher.route(tweet) == naive_match(subscriptions,
+                                                   tweet['text'])
+
+    tweet = {'text': "Look at this", 'entities': {'urls': [
+        {'expanded_url': "http://example.com/breaking/news"}]}}
+    assert matcher.route(tweet) == set(['news'])
@@ -0,0 +1,44 @@
+from itertools import islice
+from os.path import join
+
+from mock import patch
+
+from cloudly import replay, tweets
+from cloudly.replay import Replay, record
+from tests.benchmarks import make_tweets
+
+
+def make_messages():
+    messages = [{'id_str': str(n), 'text': "tweet",
+                 'timestamp_ms': str(1370088000000 + n * 1000)}
+                for n in xrange(5)]
+    messages.insert(2, {'limit': {'track': 3,
+                                  'timestamp_ms': "1370088001500"}})
+    return messages
+
+
+def test_replay(tmpdir):
+    messages = make_messages()
+    path = join(str(tmpdir), "messages.gz")
+    assert record(iter(messages + messages), path, limit=6) == 6
+
+    assert list(Replay(path)) == messages[:6]
+    assert list(islice(Replay(path, loop=True), 8)) == \
+        messages[:6] + messages[:2]
+
+    with patch.object(replay.time, 'sleep') as sleep:
+        source = Replay(path, speed=10)
+        assert list(source) == messages[:6]
+    delays = [args[0] for args, _ in sleep.call_args_list]
+    print delays
+    assert len(delays) == 5
+    assert all(0 < delay <= 0.4 for delay in delays)
+    assert source.count == 6
+
+
+def test_replay_archives(tmpdir):
+    batch = make_tweets(30)
+    tweets.persist_file(batch, str(tmpdir), close=True)
+    with patch.object(replay.time, 'sleep') as sleep:
+        assert list(Replay(str(tmpdir), speed=10)) == batch
+    assert sleep.called
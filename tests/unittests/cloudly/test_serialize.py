@@ -0,0 +1,31 @@
+import json
+
+from cloudly import serialize
+
+
+def test_roundtrip():
+    obj = {'text': u"caf\xe9 " * 500, 'ids': range(10), 'nested': {'a': None}}
+    codecs = ['json', 'fastjson', 'pickle']
+    if serialize.msgpack:
+        codecs.append('msgpack')
+    compressions = [None, 'zlib']
+    if serialize.lz4:
+        compressions.append('lz4')
+    for codec in codecs:
+        for compression in compressions:
+            data = serialize.dumps(obj, codec=codec, compression=compression)
+            print codec, compression, len(data)
+            assert serialize.loads(data) == obj
+
+
+def test_header():
+    # Plain JSON has no header, and is read as before.
+    assert serialize.dumps([1, 2]) == json.dumps([1, 2])
+    assert serialize.loads("[1, 2]") == [1, 2]
+
+    data = serialize.dumps("x" * 2000, compression="zlib")
+    assert data[:3] == "\x00jz" and len(data) < 100
+
+    # Below the threshold, data is not compressed.
+    assert serialize.dumps([1], codec="pickle", compression="zlib")[:3] == \
+        "\x00p-"
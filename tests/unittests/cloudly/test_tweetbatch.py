@@ -0,0 +1,27 @@
+import numpy as np
+
+from cloudly.tweetbatch import TweetBatch
+from tests.benchmarks import make_tweets
+
+
+def test_tweet_batch():
+    tweets = make_tweets(250)
+    tweets[0]['text'] = u"caf\xe9"
+    batch = TweetBatch(capacity=100)
+    batch.extend(tweets)
+
+    assert len(batch) == 250 and batch.capacity == 400
+    assert list(batch) == tweets and batch[3] is tweets[3]
+    assert list(batch.ids) == [tweet['id'] for tweet in tweets]
+    assert list(batch.user_ids) == [tweet['user']['id'] for tweet in tweets]
+    assert batch.created_at[10] == 1370044801  # 2013-06-01 00:00:01
+    assert batch.text(0) == u"caf\xe9"
+    assert batch.text(-1) == tweets[-1]['text']
+
+    geolocated = [tweet for tweet in tweets if tweet['coordinates']]
+    selected = batch.select(batch.has_coordinates)
+    assert list(selected) == geolocated
+    assert np.allclose(selected.lng, [tweet['coordinates']['coordinates'][0]
+                                      for tweet in geolocated])
+    assert selected.text(1) == geolocated[1]['text']
+    assert np.isnan(batch.lat[~batch.has_coordinates]).all()
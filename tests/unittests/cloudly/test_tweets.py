@@ -0,0 +1,186 @@
+import time
+from itertools import islice
+
+import pytest
+from mock import patch
+
+from cloudly import tweets
+from tests.fakes import FakeRedis
+
+
+def make_stream(ntweets, limit_every=10):
+    track = 0
+    for n in xrange(ntweets):
+        yield {'id_str': str(n), 'text': "tweet {}".format(n)}
+        if n % limit_every == 0:
+            track += 7
+            yield {'limit': {'track': track}}
+
+
+def run_manager(**kwargs):
+    redis = FakeRedis()
+    with patch.object(tweets.cache, 'get_redis_connection',
+                      return_value=redis):
+        manager = tweets.StreamManager("test", lambda batch: len(batch),
+                                       metadata_processor=lambda meta: None,
+                                       cache_length=10, **kwargs)
+        manager.run(make_stream(95))
+    return redis
+
+
+def test_batch_counts():
+    plain = run_manager()
+    batched = run_manager(batch_counts=True)
+
+    print plain.data, batched.data
+    assert batched.hgetall("counts_test") == plain.hgetall("counts_test")
+    assert batched.get("firehose_count_test") == \
+        plain.get("firehose_count_test")
+    assert batched.round_trips * 10 < plain.round_trips
+
+
+def test_columnar():
+    batches = []
+    redis = FakeRedis()
+    with patch.object(tweets.cache, 'get_redis_connection',
+                      return_value=redis):
+        manager = tweets.StreamManager("test", batches.append,
+                                       cache_length=10, columnar=True)
+        manager.run(make_stream(25))
+    assert [len(batch) for batch in batches] == [10, 10]
+    assert list(batches[1].ids) == range(10, 20)
+
+
+def test_routing():
+    batches = []
+    redis = FakeRedis()
+    stream = [{'id_str': str(n), 'text': text} for n, text in enumerate(
+        ["snow storm", "traffic montreal", "storm snow traffic", "nothing"] *
+        5)]
+    with patch.object(tweets.cache, 'get_redis_connection',
+                      return_value=redis):
+        manager = tweets.StreamManager(
+            "test",
+            {'weather': lambda batch: batches.append(('weather', batch)),
+             'traffic': lambda batch: batches.append(('traffic', batch))},
+            cache_length=4,
+            keywords={'weather': ["snow storm"], 'traffic': ["traffic"]})
+        manager.run(iter(stream))
+
+    assert sorted((name, [tweet['id_str'] for tweet in batch])
+                  for name, batch in batches) == [
+        ('traffic', ["1", "2", "5", "6"]),
+        ('traffic', ["9", "10", "13", "14"]),
+        ('weather', ["0", "2", "4", "6"]),
+        ('weather', ["8", "10", "12", "14"]),
+    ]
+    assert redis.hgetall("counts_test")['stream'] == "20"
+    assert len(manager.tweet_caches['weather']) == 2
+    assert manager.tweet_cache is None
+
+
+def slow_processor(batch):
+    time.sleep(0.01)
+    return len(batch)
+
+
+@pytest.mark.parametrize("kind", ["thread", "process"])
+def test_workers(kind):
+    redis = FakeRedis()
+    with patch.object(tweets.cache, 'get_redis_connection',
+                      return_value=redis):
+        manager = tweets.StreamManager("test", slow_processor,
+                                       cache_length=10, workers=2,
+                                       worker_kind=kind,
+                                       backpressure="block")
+        manager.run(make_stream(95))
+        assert manager.workpool.stats()['processed'] == 9
+        # Running again, e.g. after a disconnection.
+        manager.run(make_stream(100))
+        manager.close()
+    assert manager.workpool.stats()['processed'] == 19
+    if kind == "thread":
+        # Processes count detections in the Redis of their own.
+        assert redis.hgetall("counts_test")['detection'] == "190"
+
+
+def test_dedup():
+    redis = FakeRedis()
+    batches = []
+    stream = list(make_stream(30))
+    # A reconnection redelivering the last few tweets.
+    stream += [message for message in stream[-8:] if 'id_str' in message]
+    with patch.object(tweets.cache, 'get_redis_connection',
+                      return_value=redis):
+        manager = tweets.StreamManager("test", batches.append,
+                                       cache_length=10, dedup_capacity=100)
+        manager.run(iter(stream))
+    assert [tweet['id_str'] for tweet in sum(batches, [])] == \
+        map(str, range(30))
+    assert redis.hgetall("counts_test")['duplicate'] == "8"
+
+
+@pytest.mark.parametrize("batch_counts", [False, True])
+def test_checkpoint(batch_counts):
+    redis = FakeRedis()
+    processed = []
+
+    def run(stream):
+        with patch.object(tweets.cache, 'get_redis_connection',
+                          return_value=redis):
+            manager = tweets.StreamManager(
+                "test", lambda batch: processed.extend(
+                    tweet['id_str'] for tweet in batch),
+                cache_length=10, checkpoint=True, batch_counts=batch_counts)
+            manager.run(stream)
+
+    # Crash after 25 tweets: 20 processed, 5 lost in the batch.
+    run(make_stream(25))
+    assert redis.get("checkpoint_test") == "19"
+    # On restart, Twitter delivers some tweets again.
+    run(islice(make_stream(40), 15, None))
+    assert processed == map(str, range(40))
+    assert redis.get("checkpoint_test") == "39"
+
+
+def test_checkpoint_workers():
+    redis = FakeRedis()
+    checkpoints = []
+
+    def processor(batch):
+        # Batches still queued or being processed are not checkpointed.
+        checkpoints.append((int(redis.get("checkpoint_test") or -1),
+                            int(batch[0]['id_str'])))
+        time.sleep(0.01)
+
+    with patch.object(tweets.cache, 'get_redis_connection',
+                      return_value=redis):
+        with pytest.raises(ValueError):
+            tweets.StreamManager("test", processor, workers=1,
+                                 backpressure="drop_oldest", checkpoint=True)
+        manager = tweets.StreamManager("test", processor, cache_length=10,
+                                       workers=1, backpressure="block",
+                                       checkpoint=True)
+        manager.run(make_stream(55))
+        manager.close()
+    assert len(checkpoints) == 5
+    assert all(checkpoint < first_id for checkpoint, first_id in checkpoints)
+    assert redis.get("checkpoint_test") == "49"
+
+
+def test_checkpoint_failed_batch():
+    redis = FakeRedis()
+
+    def processor(batch):
+        if batch[0]['id_str'] == "10":
+            raise ValueError("Failed")
+
+    with patch.object(tweets.cache, 'get_redis_connection',
+                      return_value=redis):
+        manager = tweets.StreamManager("test", processor, cache_length=10,
+                                       workers=1, checkpoint=True)
+        manager.run(make_stream(35))
+        manager.close()
+    # The failed batch is processed again after a restart.
+    assert manager.workpool.stats()['failed'] == 1
+    assert redis.get("checkpoint_test") == "9"
@@ -0,0 +1,74 @@
+import time
+import threading
+
+import pytest
+
+from cloudly.workpool import WorkPool, BLOCK, DROP_OLDEST, SPILL
+
+
+def test_workpool():
+    done = []
+    pool = WorkPool(lambda n, m: done.append(n * m), workers=3)
+    for n in xrange(20):
+        pool.put(n, 2)
+    pool.close()
+    assert sorted(done) == range(0, 40, 2)
+    assert pool.stats()['processed'] == 20
+
+    with pytest.raises(ValueError):
+        pool.put(1, 2)
+    with pytest.raises(ValueError):
+        WorkPool(len, policy=SPILL)
+
+
+def make_blocked_pool(policy, **kwargs):
+    """Return a pool of one worker, blocked until `release` is set, with
+    a first item being processed, and the list of processed items."""
+    release = threading.Event()
+    done = []
+
+    def process(n):
+        release.wait()
+        done.append(n)
+
+    pool = WorkPool(process, workers=1, maxsize=3, policy=policy, **kwargs)
+    pool.put(0)
+    while not pool.stats()['busy']:
+        time.sleep(0.001)
+    return pool, release, done
+
+
+@pytest.mark.parametrize("policy", [DROP_OLDEST, SPILL])
+def test_backpressure(policy, tmpdir):
+    pool, release, done = make_blocked_pool(
+        policy, spill_directory=str(tmpdir))
+    # Never waits on the blocked worker.
+    for n in xrange(1, 10):
+        pool.put(n)
+    stats = pool.stats()
+    print stats
+    assert stats['depth'] == (3 if policy == DROP_OLDEST else 9)
+    release.set()
+    pool.close()
+
+    if policy == DROP_OLDEST:
+        assert done == [0, 7, 8, 9]
+        assert pool.stats()['dropped'] == 6
+    else:
+        assert done == range(10)
+        assert pool.stats()['peak_depth'] == 9
+        assert tmpdir.listdir() == []
+
+
+def test_block():
+    pool, release, done = make_blocked_pool(BLOCK)
+    for n in xrange(1, 4):
+        pool.put(n)
+    putter = threading.Thread(target=pool.put, args=(4,))
+    putter.start()
+    putter.join(0.05)
+    assert putter.is_alive()
+    release.set()
+    putter.join()
+    pool.close()
+    assert done == range(5)